@@ -1,6 +1,5 @@
 import asyncio
 import datetime
-import json
 import os
 
 from pathlib import Path
@@ -8,25 +7,127 @@ from fastapi import Request, FastAPI, HTTPException
 from contextlib import asynccontextmanager
 from dotenv import load_dotenv
 from starlette import status
-from fastapi.responses import HTMLResponse
-from utils.mongodb import do_aggregate
-from utils.telegram import run_telebot
-
+from fastapi.responses import HTMLResponse, StreamingResponse, Response, PlainTextResponse
 
 BASE_DIR = Path(__file__).resolve().parent
+# настройки модулей utils читаются при импорте, поэтому .env загружается до их импорта
 load_dotenv(BASE_DIR / ".env")
 
+from utils.mongodb import connect, close, ensure_indexes, iter_aggregate, AGGREGATION_ENGINE
+from utils.cache import (cached_aggregate_json, cached_aggregate_metrics, aggregate_with_bucket_cache,
+                         response_cache, bucket_cache)
+from utils.encoding import loads, dumps, encode_aggregated, encode_line
+from utils.intervals import GROUP_TYPES
+from utils.metrics import parse_metrics
+from utils.batch import aggregate_batch, BATCH_MAX_SPECS
+from utils.telegram import run_telebot
+from utils.live import run_live_updates, LIVE_UPDATES
+from utils.tracing import trace_request, stage, registry, SERVER_TIMING
+
+# "app" - Телеграм-бот запускается в цикле событий приложения,
+# "worker" - бот запускается отдельным процессом (python -m utils.telegram)
+TELEGRAM_BOT_MODE = os.getenv("TELEGRAM_BOT_MODE", "app")
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    loop = asyncio.get_event_loop()
-    bot_task = loop.create_task(run_telebot())
+    # клиент MongoDB создается в цикле событий приложения, а не при импорте модулей.
+    # Движки "numpy" и "dump" читают снимок и BSON-выгрузку и не обращаются к MongoDB:
+    # клиент для них нужен только для обновления кэшей по новым документам (LIVE_UPDATES)
+    if AGGREGATION_ENGINE not in ('numpy', 'dump') or LIVE_UPDATES != 'off':
+        connect()
+    if AGGREGATION_ENGINE == 'numpy':
+        # снимок отображается в память при запуске, а не при первом запросе
+        from utils.snapshot import get_snapshot
+        get_snapshot()
+    elif AGGREGATION_ENGINE != 'dump':
+        await ensure_indexes()
+    if AGGREGATION_ENGINE == 'prefix':
+        from utils.prefix_index import get_index
+        await get_index()
+    bot_task = None
+    if TELEGRAM_BOT_MODE == 'app':
+        loop = asyncio.get_event_loop()
+        bot_task = loop.create_task(run_telebot())
+    live_task = None
+    if LIVE_UPDATES != 'off':
+        # кэши и витрина обновляются по мере поступления новых документов
+        live_task = asyncio.get_event_loop().create_task(run_live_updates())
     yield
-    bot_task.cancel()
+    if bot_task:
+        bot_task.cancel()
+    if live_task:
+        live_task.cancel()
+    close()
 
 app = FastAPI(lifespan=lifespan)
 
 
+def stream_response(dt_from, dt_upto, group_type, stream):
+    '''
+    Функция формирует потоковый ответ в формате NDJSON: по одной строке json
+    {"label": ..., "value": ...} на каждый интервал, строки передаются клиенту
+    по мере вычисления порций интервалов. Суммы берутся из кэша сумм по интервалам,
+    но в кэш не записываются: объем памяти не зависит от длины периода
+    :param stream: формат потокового ответа, поддерживается только "ndjson"
+    :return: StreamingResponse
+    '''
+    if stream != 'ndjson':
+        raise HTTPException(status_code=422, detail=f"Invalid stream format: '{stream}'")
+
+    async def read_bucket_cache(intervals, group_type):
+        return await aggregate_with_bucket_cache(intervals, group_type, store=False)
+
+    async def lines():
+        async for label, value in iter_aggregate(dt_from, dt_upto, group_type, aggregate=read_bucket_cache):
+            yield encode_line(label, value)
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
+async def aggregated_response(dt_from, dt_upto, group_type, metrics=None):
+    '''
+    Функция формирует ответ с агрегированными данными. Без параметра metrics ответ
+    содержит только суммы зарплат, иначе - также запрошенные статистики по интервалам
+    (вычисляются тем же запросом к базе данных).
+    Ответ кодируется в JSON сразу (orjson), ответ без статистик берется из кэша уже закодированным
+    :param metrics: статистики через запятую, например "count,avg,min,max,p50,p90"
+    :return: Response
+    '''
+    if not metrics:
+        content = await cached_aggregate_json(dt_from, dt_upto, group_type)
+        return Response(content=content, media_type="application/json")
+    try:
+        metrics = parse_metrics(metrics)
+    except ValueError as error:
+        raise HTTPException(status_code=422, detail=str(error))
+    try:
+        dataset, labels, values = await cached_aggregate_metrics(dt_from, dt_upto, group_type, metrics)
+    except ValueError as error:
+        # статистики не вычисляются движками без MongoDB (numpy, dump) и по датам с ненулевым смещением UTC
+        raise HTTPException(status_code=422, detail=str(error))
+    with stage('encode'):
+        content = encode_aggregated(dataset, labels, values)
+    return Response(content=content, media_type="application/json")
+
+
+async def traced_response(entry, group_type, respond):
+    '''
+    Выполняет обработку запроса с трассировкой (см. utils.tracing): длительность запроса
+    и его этапов записывается в метрики /metrics, при SERVER_TIMING=1 - также в заголовок
+    Server-Timing ответа
+    :param entry: точка входа: GET, POST, batch
+    :param group_type: тип периода агрегации
+    :param respond: корутина, возвращающая Response
+    :return: Response
+    '''
+    with trace_request(entry, group_type) as trace:
+        response = await respond
+    if SERVER_TIMING:
+        response.headers["Server-Timing"] = trace.server_timing()
+    return response
+
+
 @app.get("/", response_description="Instructions")
 async def get_root():
     '''
@@ -45,7 +146,7 @@ async def get_root():
                 Параметр "dt_from" в формате ISO - дата и время начала периода агрегации данных.<br>
                 Параметр "dt_upto" в формате ISO - дата и время конца периода агрегации данных.
             </p>
-            <p>Допустимые виды интервалов: "month", "day", "hour".</p>
+            <p>Допустимые виды интервалов: "year", "quarter", "month", "week", "day", "hour".</p>
             <p>
                 Пример отправки GET запроса:<br>
                 "http://127.0.0.1:8000/aggregated_data/?dt_from=2022-10-01T00:00:00&dt_upto=2022-11-30T23:59:00&group_type=day"<br><br>
@@ -56,6 +157,12 @@ async def get_root():
                 "dt_upto": "2022-12-31T23:59:00",<br>
                 "group_type": "month"<br>
                 }<br><br>
+                Для длинных периодов доступен потоковый ответ в формате NDJSON (по одной строке json на интервал):
+                параметр "stream=ndjson" в GET запросе или "stream": "ndjson" в теле POST запроса.<br><br>
+                Дополнительные статистики по интервалам (количество, среднее, минимум, максимум, процентили)
+                вычисляются при параметре "metrics", например "metrics=count,avg,min,max,p50,p90".<br><br>
+                Несколько запросов можно выполнить одним POST запросом к маршруту "/aggregated_data/batch":<br>
+                {"requests": [{"dt_from": ..., "dt_upto": ..., "group_type": ...}, ...]}<br><br>
                 Кроме того, вы можете воспользоваться нашим Телеграм-ботом для отправки запроса и получения ответа.<br>
                 Пример запроса в Телеграм-боте:<br>
                 {<br>
@@ -88,7 +195,9 @@ async def get_root():
                               "properties": {
                                   "dt_from": {"type": "string"},
                                   "dt_upto": {"type": "string"},
-                                  "group_type": {"type": "string"}
+                                  "group_type": {"type": "string"},
+                                  "stream": {"type": "string", "enum": ["ndjson"]},
+                                  "metrics": {"type": "string"}
                               },
                               "example": {
                                   "dt_from": "2022-10-01T00:00:00",
@@ -107,14 +216,16 @@ async def get_data_through_post(request: Request):
     Функция FAST API при обращении к маршруту 'http://0.0.0.0:8000/aggregated_data/'
     посредством отправки POST запроса. Получает входные данные из тела (body)
     запроса (request) в виде строки json.
-    В ответ возвращает агрегированные данные в формате json
+    В ответ возвращает агрегированные данные в формате json,
+    при "stream": "ndjson" в теле запроса - потоковый ответ в формате NDJSON,
+    при "metrics" - также дополнительные статистики по интервалам
     :param request:
     :return: json
     '''
     raw_body = await request.body()
     try:
-        data = json.loads(raw_body)
-    except json.decoder.JSONDecodeError:
+        data = loads(raw_body)
+    except ValueError:
         raise HTTPException(status_code=422, detail="Invalid JSON")
     if data:
         dt_from = datetime.datetime.fromisoformat(data['dt_from'])
@@ -122,26 +233,114 @@ async def get_data_through_post(request: Request):
         group_type = data['group_type']
         if dt_from > dt_upto:
             raise HTTPException(status_code=422, detail=f"Invalid dates of period: {dt_from} > {dt_upto}")
-        elif group_type not in ['month', 'day', 'hour']:
+        elif group_type not in GROUP_TYPES:
             raise HTTPException(status_code=422, detail=f"Invalid type of interval: '{group_type}'")
 
-        dataset, labels = await do_aggregate(dt_from, dt_upto, group_type)
-        return {"dataset": dataset, "labels": labels}
+        if data.get('stream'):
+            return stream_response(dt_from, dt_upto, group_type, data['stream'])
+        return await traced_response('POST', group_type,
+                                     aggregated_response(dt_from, dt_upto, group_type, data.get('metrics')))
+
+
+@app.post("/aggregated_data/batch",
+          response_description="Aggregated data for each request of the batch",
+          status_code=status.HTTP_200_OK,
+          openapi_extra={
+              "requestBody": {
+                  "content": {
+                      "application/json": {
+                          "schema": {
+                              "required": ["requests"],
+                              "properties": {
+                                  "requests": {"type": "array", "items": {"type": "object"}}
+                              },
+                              "example": {
+                                  "requests": [
+                                      {"dt_from": "2022-09-01T00:00:00", "dt_upto": "2022-12-31T23:59:00",
+                                       "group_type": "month"},
+                                      {"dt_from": "2022-10-01T00:00:00", "dt_upto": "2022-10-31T23:59:00",
+                                       "group_type": "day"}
+                                  ]
+                              }
+                          }
+                      }
+                  },
+                  "required": True,
+              },
+          },
+          )
+async def get_batch_data(request: Request):
+    '''
+    Функция FAST API при обращении к маршруту 'http://0.0.0.0:8000/aggregated_data/batch'
+    посредством отправки POST запроса. Тело запроса - строка json со списком запросов
+    {"requests": [{"dt_from": ..., "dt_upto": ..., "group_type": ...}, ...]}.
+    В ответ возвращает результаты в порядке запросов, для некорректного запроса
+    вместо результата возвращается {"error": ...}
+    :param request:
+    :return: json
+    '''
+    raw_body = await request.body()
+    try:
+        data = loads(raw_body)
+    except ValueError:
+        raise HTTPException(status_code=422, detail="Invalid JSON")
+    specs = data.get('requests') if isinstance(data, dict) else None
+    if not isinstance(specs, list):
+        raise HTTPException(status_code=422, detail="Field 'requests' must be a list")
+    if len(specs) > BATCH_MAX_SPECS:
+        raise HTTPException(status_code=422, detail=f"Too many requests in batch: {len(specs)} > {BATCH_MAX_SPECS}")
+
+    async def respond():
+        return Response(content=dumps({"results": await aggregate_batch(specs)}), media_type="application/json")
+
+    return await traced_response('batch', 'batch', respond())
 
 
 @app.get("/aggregated_data/",
           response_description="Aggregated data",
           status_code=status.HTTP_200_OK)
-async def get_data(dt_from: str, dt_upto: str, group_type: str):
+async def get_data(dt_from: str, dt_upto: str, group_type: str, stream: str = None, metrics: str = None):
     '''
     Функция FAST API для маршрута 'http://0.0.0.0:8000/aggregated_data/'
     посредством отправки GET запроса.
     Получает значения параметров из адресной строки браузера (url)
     :params dt_from, dt_upto, group_type
+    :param stream: "ndjson" - потоковый ответ в формате NDJSON
+    :param metrics: дополнительные статистики через запятую, например "count,avg,p90"
     :return: json
     '''
     dt_from = datetime.datetime.fromisoformat(dt_from)
     dt_upto = datetime.datetime.fromisoformat(dt_upto)
-    group_type = group_type
-    dataset, labels = await do_aggregate(dt_from, dt_upto, group_type)
-    return {"dataset": dataset, "labels": labels}
+    if dt_from > dt_upto:
+        raise HTTPException(status_code=422, detail=f"Invalid dates of period: {dt_from} > {dt_upto}")
+    elif group_type not in GROUP_TYPES:
+        raise HTTPException(status_code=422, detail=f"Invalid type of interval: '{group_type}'")
+    if stream:
+        return stream_response(dt_from, dt_upto, group_type, stream)
+    return await traced_response('GET', group_type, aggregated_response(dt_from, dt_upto, group_type, metrics))
+
+
+@app.get("/cache_stats/",
+         response_description="Cache statistics",
+         status_code=status.HTTP_200_OK)
+async def get_cache_stats():
+    '''
+    Функция возвращает счетчики кэша результатов агрегации:
+    количество записей, их размер, попадания, промахи, объединенные запросы, вытеснения,
+    а также счетчики кэша сумм по интервалам (buckets)
+    :return: json
+    '''
+    return {**response_cache.stats(), "buckets": bucket_cache.stats()}
+
+
+@app.get("/metrics",
+         response_description="Metrics in Prometheus text format",
+         status_code=status.HTTP_200_OK)
+async def get_metrics():
+    '''
+    Функция возвращает метрики сервиса в текстовом формате Prometheus: гистограммы длительности
+    запросов по точке входа (GET, POST, batch, bot) и типу периода, гистограммы длительности этапов,
+    счетчики запросов к базе данных, прочитанных документов, интервалов и медленных запросов
+    :return: text/plain
+    '''
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
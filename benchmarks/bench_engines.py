@@ -0,0 +1,53 @@
+'''
+Сравнение движков агрегации do_aggregate: "interval" (запрос на каждый интервал,
+последовательно и по 8 запросов одновременно) и "bucket" (один запрос на все интервалы)
+на 100, 1 000 и 10 000 интервалах.
+
+Если задана переменная окружения MONGODB_URI, замеры выполняются на локальном
+сервере MongoDB (база salary_box), иначе - на коллекции в памяти процесса
+(benchmarks.standin) с имитацией сетевой задержки на каждое обращение.
+
+Запуск: python -m benchmarks.bench_engines
+'''
+import asyncio
+import datetime
+import os
+import time
+
+from utils import mongodb
+from benchmarks.generator import generate_salaries
+from benchmarks.standin import InProcessCollection
+
+BUCKET_COUNTS = (100, 1000, 10000)
+DOCUMENT_COUNT = 20000
+DT_FROM = datetime.datetime(2022, 1, 1)
+
+
+async def measure(dt_upto, engine, repeat=3, concurrency=1):
+    mongodb.INTERVAL_CONCURRENCY = concurrency
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        await mongodb.do_aggregate(DT_FROM, dt_upto, 'hour', engine=engine)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+async def main():
+    if not os.getenv("MONGODB_URI"):
+        dt_upto = DT_FROM + datetime.timedelta(hours=max(BUCKET_COUNTS))
+        mongodb.salaries = InProcessCollection(generate_salaries(DT_FROM, dt_upto, DOCUMENT_COUNT))
+        print(f"Коллекция в памяти процесса, документов: {DOCUMENT_COUNT}")
+    print(f"{'buckets':>8} {'interval, s':>12} {'interval x8, s':>15} {'bucket, s':>10} {'speedup':>8}")
+    for count in BUCKET_COUNTS:
+        dt_upto = DT_FROM + datetime.timedelta(hours=count) - datetime.timedelta(minutes=1)
+        per_interval = await measure(dt_upto, 'interval')
+        concurrent = await measure(dt_upto, 'interval', concurrency=8)
+        single_pass = await measure(dt_upto, 'bucket')
+        print(f"{count:>8} {per_interval:>12.4f} {concurrent:>15.4f} {single_pass:>10.4f} "
+              f"{per_interval / single_pass:>7.1f}x")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
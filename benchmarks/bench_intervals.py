@@ -0,0 +1,80 @@
+'''
+Микробенчмарк формирования интервалов агрегации: прежняя реализация на relativedelta,
+генератор utils.intervals.iter_intervals и векторная форма utils.intervals.interval_arrays
+на 1 000 - 1 000 000 интервалов.
+
+Запуск: python -m benchmarks.bench_intervals
+'''
+import datetime
+import time
+
+from dateutil.relativedelta import relativedelta
+
+from utils.intervals import iter_intervals, interval_arrays
+
+BUCKET_COUNTS = (1000, 10000, 100000, 1000000)
+# прежняя реализация слишком медленная для большего количества интервалов
+REFERENCE_LIMIT = 100000
+DT_FROM = datetime.datetime(2000, 1, 1)
+STEPS = {'hour': datetime.timedelta(hours=1), 'day': datetime.timedelta(days=1)}
+
+
+def reference_intervals(dt_from, dt_upto, group_type):
+    '''
+    Прежняя реализация compile_intervals на relativedelta - эталон для сравнения
+    '''
+    intervals = []
+    if group_type == 'month':
+        months, days, hours = (1, 0, 0)
+        start_of_period = dt_from + relativedelta(day=1, hour=0, minute=0)
+        loop_count = (relativedelta(dt_upto, start_of_period).years * 12 +
+                      relativedelta(dt_upto, start_of_period).months + 1)
+    elif group_type == 'day':
+        months, days, hours = (0, 1, 0)
+        start_of_period = dt_from + relativedelta(hour=0, minute=0)
+        loop_count = (dt_upto - start_of_period).days + 1
+    else:
+        months, days, hours = (0, 0, 1)
+        start_of_period = dt_from + relativedelta(minute=0)
+        delta = dt_upto - start_of_period
+        loop_count = (delta.days * 24) + (delta.seconds // 3600) + 1
+    end_of_period = start_of_period + relativedelta(months=+months, days=+days, hours=+hours, minutes=-1)
+    intervals.append((start_of_period, end_of_period))
+    for index in range(2, loop_count+1):
+        start_of_period += relativedelta(months=+months, days=+days, hours=+hours)
+        end_of_period = start_of_period + relativedelta(months=+months, days=+days, hours=+hours, minutes=-1)
+        intervals.append((start_of_period, end_of_period))
+    return intervals
+
+
+def measure(function):
+    started = time.perf_counter()
+    function()
+    return time.perf_counter() - started
+
+
+def upto(count, group_type):
+    if group_type == 'month':
+        return DT_FROM.replace(year=DT_FROM.year + count // 12) - datetime.timedelta(minutes=1)
+    return DT_FROM + STEPS[group_type] * count - datetime.timedelta(minutes=1)
+
+
+def main():
+    interval_arrays(DT_FROM, DT_FROM, 'hour')  # импорт NumPy не входит в замеры
+    print(f"{'group_type':>10} {'buckets':>8} {'relativedelta, s':>17} {'iter_intervals, s':>18} "
+          f"{'interval_arrays, s':>19}")
+    for group_type in ('hour', 'day', 'month'):
+        for count in BUCKET_COUNTS:
+            if group_type == 'month' and count > 12 * (9999 - DT_FROM.year):
+                continue
+            dt_upto = upto(count, group_type)
+            reference = '-'
+            if count <= REFERENCE_LIMIT:
+                reference = f"{measure(lambda: reference_intervals(DT_FROM, dt_upto, group_type)):.4f}"
+            fast = measure(lambda: list(iter_intervals(DT_FROM, dt_upto, group_type)))
+            vectorized = measure(lambda: interval_arrays(DT_FROM, dt_upto, group_type))
+            print(f"{group_type:>10} {count:>8} {reference:>17} {fast:>18.4f} {vectorized:>19.4f}")
+
+
+if __name__ == '__main__':
+    main()
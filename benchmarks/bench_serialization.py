@@ -0,0 +1,60 @@
+'''
+Микробенчмарк кодирования ответа /aggregated_data/ в JSON по количеству интервалов:
+- прежний путь: метки datetime.isoformat, словарь через jsonable_encoder и JSONResponse (стандартный json);
+- новый путь: метки utils.intervals.format_labels и utils.encoding.encode_aggregated (orjson).
+При попадании в кэш результатов ответ хранится уже закодированным, и кодирование не выполняется вовсе.
+
+Запуск: python -m benchmarks.bench_serialization
+'''
+import datetime
+import random
+import time
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+from utils.encoding import encode_aggregated
+from utils.intervals import iter_intervals, format_labels
+
+BUCKET_COUNTS = (24, 744, 8760, 87600)
+DT_FROM = datetime.datetime(2000, 1, 1)
+REPEAT = 5
+
+
+def reference_encode(intervals, dataset):
+    '''
+    Прежний путь: ответ-словарь, который FastAPI кодирует через jsonable_encoder и json.dumps
+    '''
+    labels = [datetime.datetime.isoformat(interval[0]) for interval in intervals]
+    return JSONResponse(content=jsonable_encoder({"dataset": dataset, "labels": labels})).body
+
+
+def fast_encode(intervals, dataset):
+    return encode_aggregated(dataset, format_labels(intervals))
+
+
+def measure(function):
+    # лучшее время из REPEAT запусков
+    timings = []
+    for _ in range(REPEAT):
+        started = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+
+def main():
+    rnd = random.Random(0)
+    print(f"{'buckets':>8} {'json, us/bucket':>16} {'orjson, us/bucket':>18} {'speedup':>8}")
+    for count in BUCKET_COUNTS:
+        intervals = list(iter_intervals(DT_FROM, DT_FROM + datetime.timedelta(hours=count - 1), 'hour'))
+        dataset = [rnd.randint(0, 10 ** 7) for _ in intervals]
+        assert fast_encode(intervals, dataset) == reference_encode(intervals, dataset)
+        reference = measure(lambda: reference_encode(intervals, dataset))
+        fast = measure(lambda: fast_encode(intervals, dataset))
+        print(f"{count:>8} {reference / count * 10 ** 6:>16.3f} {fast / count * 10 ** 6:>18.3f} "
+              f"{reference / fast:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
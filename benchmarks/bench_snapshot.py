@@ -0,0 +1,51 @@
+'''
+Задержка ответа движка "numpy" (колоночный снимок, отображенный в память)
+на снимке из 10 000 000 синтетических документов за 2022 год.
+
+Запуск: python -m benchmarks.bench_snapshot
+'''
+import asyncio
+import datetime
+import tempfile
+import time
+
+import numpy as np
+
+from utils.mongodb import compile_intervals
+from utils.snapshot import Snapshot, write_snapshot, to_epoch_ms
+
+ROW_COUNT = 10_000_000
+DT_FROM = datetime.datetime(2022, 1, 1)
+DT_UPTO = datetime.datetime(2022, 12, 31, 23, 59)
+REQUESTS = (('month', DT_FROM, DT_UPTO),
+            ('day', DT_FROM, DT_UPTO),
+            ('hour', DT_FROM, datetime.datetime(2022, 1, 31, 23, 59)),
+            ('hour', DT_FROM, DT_UPTO))
+
+
+def measure(snapshot, intervals, repeat=20):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        snapshot.aggregate(intervals)
+        timings.append(time.perf_counter() - started)
+    return sorted(timings)[len(timings) // 2]
+
+
+def main():
+    rnd = np.random.default_rng(0)
+    timestamps = rnd.integers(to_epoch_ms(DT_FROM), to_epoch_ms(DT_UPTO), ROW_COUNT)
+    values = rnd.integers(10, 10000, ROW_COUNT)
+    with tempfile.TemporaryDirectory() as path:
+        started = time.perf_counter()
+        write_snapshot(path, timestamps, values)
+        print(f"Снимок из {ROW_COUNT} документов записан за {time.perf_counter() - started:.1f} с")
+        snapshot = Snapshot.load(path)
+        print(f"{'group_type':>10} {'buckets':>8} {'median, ms':>11}")
+        for group_type, dt_from, dt_upto in REQUESTS:
+            intervals = asyncio.run(compile_intervals(dt_from, dt_upto, group_type))
+            print(f"{group_type:>10} {len(intervals):>8} {measure(snapshot, intervals) * 1000:>11.3f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+'''
+Бенчмарк запуска процесса приложения (каждый замер - в новом интерпретаторе, как при запуске воркера uvicorn):
+- импорт app;
+- время до первого обслуженного запроса /aggregated_data/ (импорт и запрос через ASGI
+  к коллекции в памяти процесса, без обращения к MongoDB);
+- для сравнения - импорт зависимостей, которые загружаются только при использовании
+  (aiogram - при запуске бота, motor - при создании клиента MongoDB).
+
+Запуск: python -m benchmarks.bench_startup
+'''
+import subprocess
+import sys
+from pathlib import Path
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+REPEAT = 5
+
+FIRST_REQUEST = '''
+import asyncio, datetime, time
+started = time.perf_counter()
+import app
+imported = time.perf_counter()
+import httpx
+from utils import mongodb
+from benchmarks.generator import generate_salaries
+from benchmarks.standin import InProcessCollection
+mongodb.salaries = InProcessCollection(
+    generate_salaries(datetime.datetime(2022, 9, 1), datetime.datetime(2022, 9, 30, 23, 59), 1000))
+prepared = time.perf_counter()
+
+async def request():
+    transport = httpx.ASGITransport(app=app.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://benchmark") as client:
+        response = await client.get("/aggregated_data/", params={
+            "dt_from": "2022-09-01T00:00:00", "dt_upto": "2022-09-30T23:59:00", "group_type": "day"})
+        response.raise_for_status()
+
+asyncio.run(request())
+served = time.perf_counter()
+# подготовка тестовых данных не входит во время до первого запроса
+print(imported - started, served - prepared + imported - started)
+'''
+
+IMPORT = '''
+import time
+started = time.perf_counter()
+import {module}
+print(time.perf_counter() - started)
+'''
+
+
+def run(code):
+    output = subprocess.run([sys.executable, "-c", code], cwd=BASE_DIR, check=True,
+                            capture_output=True, text=True).stdout
+    return [float(value) for value in output.split()]
+
+
+def measure(code):
+    # лучшее время из REPEAT запусков для каждого значения
+    return [min(values) for values in zip(*(run(code) for _ in range(REPEAT)))]
+
+
+def main():
+    import_time, first_request = measure(FIRST_REQUEST)
+    print(f"{'import app':<36} {import_time * 1000:>9.1f} ms")
+    print(f"{'import app + first request':<36} {first_request * 1000:>9.1f} ms")
+    for module in ("aiogram", "motor.motor_asyncio"):
+        (elapsed,) = measure(IMPORT.format(module=module))
+        print(f"{'deferred: import ' + module:<36} {elapsed * 1000:>9.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+import datetime
+import os
+import random
+
+from utils import mongodb
+from benchmarks.standin import InProcessCollection
+
+# распределения дат документов во времени
+DISTRIBUTIONS = ('uniform', 'business_hours', 'bursty')
+# база данных для синтетических данных на сервере MongoDB (рабочая база salary_box не изменяется)
+BENCHMARK_DATABASE = os.getenv("BENCHMARK_DATABASE", "salary_box_benchmark")
+
+
+def generate_salaries(dt_from, dt_upto, count, seed=0, distribution='uniform'):
+    '''
+    Функция формирует синтетический набор документов коллекции salaries:
+    случайные моменты времени в диапазоне [dt_from, dt_upto] (с точностью до секунды)
+    и случайные размеры зарплат
+    :param dt_from: начало диапазона
+    :param dt_upto: конец диапазона
+    :param count: количество документов
+    :param seed: зерно генератора случайных чисел
+    :param distribution: распределение дат: "uniform" - равномерное, "business_hours" - 80% документов
+    в рабочие часы (9-18), "bursty" - 80% документов в 20 коротких всплесках
+    :return: список документов {"dt": ..., "value": ...}
+    '''
+    rnd = random.Random(seed)
+    span = int((dt_upto - dt_from).total_seconds())
+    bursts = [rnd.randint(0, span) for _ in range(20)]
+    documents = []
+    for _ in range(count):
+        offset = rnd.randint(0, span)
+        if distribution == 'business_hours' and rnd.random() < 0.8:
+            day = dt_from + datetime.timedelta(seconds=offset)
+            moment = day.replace(hour=rnd.randint(9, 17), minute=rnd.randint(0, 59), second=rnd.randint(0, 59))
+            offset = min(max(int((moment - dt_from).total_seconds()), 0), span)
+        elif distribution == 'bursty' and rnd.random() < 0.8:
+            offset = min(max(rnd.choice(bursts) + int(rnd.gauss(0, 1800)), 0), span)
+        documents.append({"dt": dt_from + datetime.timedelta(seconds=offset), "value": rnd.randint(10, 10000)})
+    return documents
+
+
+async def load_salaries(documents, round_trip=0.0005):
+    '''
+    Загружает синтетические документы в коллекцию salaries базы BENCHMARK_DATABASE
+    локального сервера MongoDB (если задана MONGODB_URI) или в коллекцию в памяти процесса
+    и подключает к ней движки агрегации
+    :param documents: документы коллекции salaries
+    :param round_trip: имитация сетевой задержки коллекции в памяти процесса (в секундах)
+    :return: коллекция
+    '''
+    if os.getenv("MONGODB_URI"):
+        collection = mongodb.client.get_database(BENCHMARK_DATABASE).get_collection("salaries")
+        await collection.drop()
+        for start in range(0, len(documents), 10000):
+            await collection.insert_many(documents[start:start + 10000])
+    else:
+        collection = InProcessCollection(documents, round_trip=round_trip)
+    mongodb.salaries = collection
+    mongodb.db = collection.database
+    await mongodb.ensure_indexes()
+    return collection
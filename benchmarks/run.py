@@ -0,0 +1,188 @@
+'''
+Набор бенчмарков и нагрузочный тест сервиса агрегации на синтетических данных:
+- формирование интервалов (compile_intervals) по типам периода;
+- do_aggregate по типам периода и движкам агрегации;
+- HTTP-нагрузка на приложение FastAPI (GET /aggregated_data/) с заданным числом одновременных
+  клиентов: задержка p50/p95/p99 и количество запросов в секунду.
+
+Данные загружаются в локальный сервер MongoDB (если задана MONGODB_URI, база BENCHMARK_DATABASE)
+или в коллекцию в памяти процесса. Приложение вызывается в том же процессе (ASGI),
+либо по адресу --url уже запущенного сервера.
+Результаты сохраняются в JSON (--output), с предыдущим файлом результатов можно сравнить (--compare).
+
+Запуск: python -m benchmarks.run --rows 100000 --output bench_results.json
+'''
+import argparse
+import asyncio
+import datetime
+import json
+import math
+import platform
+import random
+import time
+
+import httpx
+
+from utils import mongodb
+from benchmarks.generator import generate_salaries, load_salaries, DISTRIBUTIONS
+
+DT_FROM = datetime.datetime(2022, 1, 1)
+DT_UPTO = datetime.datetime(2022, 12, 31, 23, 59)
+# длина периода запроса по типам периода
+WINDOWS = {'month': datetime.timedelta(days=183), 'day': datetime.timedelta(days=62),
+           'hour': datetime.timedelta(days=3)}
+ENGINES = ('bucket', 'interval')
+# допустимое ухудшение результата при сравнении с предыдущим запуском
+REGRESSION_THRESHOLD = 1.2
+
+
+def percentile(values, q):
+    '''
+    Перцентиль q (0-100) по методу ближайшего ранга
+    '''
+    ordered = sorted(values)
+    return ordered[max(math.ceil(q / 100 * len(ordered)), 1) - 1]
+
+
+def summarize(timings, elapsed=None):
+    summary = {"count": len(timings),
+               "p50_ms": percentile(timings, 50) * 1000,
+               "p95_ms": percentile(timings, 95) * 1000,
+               "p99_ms": percentile(timings, 99) * 1000}
+    if elapsed:
+        summary["rps"] = len(timings) / elapsed
+    return summary
+
+
+def random_window(rnd, group_type):
+    span = DT_UPTO - DT_FROM - WINDOWS[group_type]
+    dt_from = DT_FROM + datetime.timedelta(minutes=rnd.randint(0, int(span.total_seconds() // 60)))
+    return dt_from, dt_from + WINDOWS[group_type]
+
+
+async def bench_compile_intervals(repeat):
+    results = {}
+    for group_type in WINDOWS:
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            await mongodb.compile_intervals(DT_FROM, DT_UPTO, group_type)
+            timings.append(time.perf_counter() - started)
+        results[group_type] = summarize(timings)
+    return results
+
+
+async def bench_do_aggregate(repeat, seed):
+    results = {}
+    for engine in ENGINES:
+        for group_type in WINDOWS:
+            rnd = random.Random(seed)
+            timings = []
+            for _ in range(repeat):
+                dt_from, dt_upto = random_window(rnd, group_type)
+                started = time.perf_counter()
+                await mongodb.do_aggregate(dt_from, dt_upto, group_type, engine=engine)
+                timings.append(time.perf_counter() - started)
+            results[f"{engine}/{group_type}"] = summarize(timings)
+    return results
+
+
+async def bench_http(requests, concurrency, seed, url=None):
+    '''
+    Нагрузочный тест: concurrency клиентов отправляют всего requests GET запросов
+    со случайными периодами и типами периода
+    '''
+    rnd = random.Random(seed)
+    queue = []
+    for _ in range(requests):
+        group_type = rnd.choice(list(WINDOWS))
+        dt_from, dt_upto = random_window(rnd, group_type)
+        queue.append({"dt_from": dt_from.isoformat(), "dt_upto": dt_upto.isoformat(), "group_type": group_type})
+    timings, errors = [], 0
+    if url:
+        client = httpx.AsyncClient(base_url=url, timeout=60)
+    else:
+        from app import app
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://benchmark", timeout=60)
+
+    async def worker():
+        nonlocal errors
+        while queue:
+            params = queue.pop()
+            started = time.perf_counter()
+            response = await client.get("/aggregated_data/", params=params)
+            timings.append(time.perf_counter() - started)
+            errors += response.status_code != 200
+
+    started = time.perf_counter()
+    async with client:
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+    result = summarize(timings, time.perf_counter() - started)
+    result["errors"] = errors
+    return result
+
+
+def compare(results, previous):
+    '''
+    Сравнивает p95 с предыдущим запуском, возвращает список ухудшений более чем в REGRESSION_THRESHOLD раз
+    '''
+    regressions = []
+    for section in ('compile_intervals', 'do_aggregate'):
+        for name, summary in results[section].items():
+            before = previous.get(section, {}).get(name)
+            if before and summary["p95_ms"] > before["p95_ms"] * REGRESSION_THRESHOLD:
+                regressions.append(f"{section} {name}: p95 {before['p95_ms']:.3f} -> {summary['p95_ms']:.3f} ms")
+    before = previous.get("http")
+    if before and results["http"]["p95_ms"] > before["p95_ms"] * REGRESSION_THRESHOLD:
+        regressions.append(f"http: p95 {before['p95_ms']:.3f} -> {results['http']['p95_ms']:.3f} ms")
+    return regressions
+
+
+async def main(arguments):
+    documents = generate_salaries(DT_FROM, DT_UPTO, arguments.rows, arguments.seed, arguments.distribution)
+    await load_salaries(documents)
+    if arguments.no_cache:
+        from utils.cache import response_cache, bucket_cache
+        response_cache.ttl = 0
+        bucket_cache.max_entries = 0
+    results = {
+        "started": datetime.datetime.now().isoformat(timespec='seconds'),
+        "python": platform.python_version(),
+        "backend": "mongodb" if arguments.url or mongodb.URI else "in-process",
+        "rows": arguments.rows,
+        "distribution": arguments.distribution,
+        "compile_intervals": await bench_compile_intervals(arguments.repeat),
+        "do_aggregate": await bench_do_aggregate(arguments.repeat, arguments.seed),
+        "http": await bench_http(arguments.requests, arguments.concurrency, arguments.seed, arguments.url),
+    }
+    for section in ('compile_intervals', 'do_aggregate'):
+        for name, summary in results[section].items():
+            print(f"{section:>17} {name:>15}  p50 {summary['p50_ms']:9.3f}  p95 {summary['p95_ms']:9.3f}  "
+                  f"p99 {summary['p99_ms']:9.3f} ms")
+    http = results["http"]
+    print(f"{'http':>17} {'GET':>15}  p50 {http['p50_ms']:9.3f}  p95 {http['p95_ms']:9.3f}  "
+          f"p99 {http['p99_ms']:9.3f} ms  {http['rps']:.1f} req/s, ошибок: {http['errors']}")
+    if arguments.output:
+        with open(arguments.output, 'w') as file:
+            json.dump(results, file, indent=2)
+    if arguments.compare:
+        with open(arguments.compare) as file:
+            regressions = compare(results, json.load(file))
+        for regression in regressions:
+            print("Ухудшение:", regression)
+        print(f"Ухудшений относительно {arguments.compare}: {len(regressions)}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Бенчмарки и нагрузочный тест сервиса агрегации")
+    parser.add_argument('--rows', type=int, default=100000, help="количество синтетических документов")
+    parser.add_argument('--distribution', choices=DISTRIBUTIONS, default='uniform')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=20, help="повторов каждого микробенчмарка")
+    parser.add_argument('--requests', type=int, default=200, help="количество HTTP запросов")
+    parser.add_argument('--concurrency', type=int, default=10, help="количество одновременных HTTP клиентов")
+    parser.add_argument('--url', help="адрес запущенного сервера вместо вызова приложения в процессе")
+    parser.add_argument('--no-cache', action='store_true', help="выключить кэши результатов")
+    parser.add_argument('--output', help="файл JSON для сохранения результатов")
+    parser.add_argument('--compare', help="файл JSON с результатами предыдущего запуска")
+    asyncio.run(main(parser.parse_args()))
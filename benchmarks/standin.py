@@ -0,0 +1,386 @@
+import asyncio
+import bisect
+import datetime
+import math
+
+from bson import ObjectId
+
+
+def _truncate(value, unit):
+    if unit == 'year':
+        return value.replace(month=1, day=1, hour=0, minute=0, second=0, microsecond=0)
+    if unit == 'month':
+        return value.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    if unit == 'day':
+        return value.replace(hour=0, minute=0, second=0, microsecond=0)
+    if unit == 'hour':
+        return value.replace(minute=0, second=0, microsecond=0)
+    if unit == 'minute':
+        return value.replace(second=0, microsecond=0)
+    raise ValueError(f"Unsupported unit: {unit}")
+
+
+def _to_ms(value):
+    if isinstance(value, datetime.datetime):
+        return value.replace(microsecond=value.microsecond // 1000 * 1000)
+    return value
+
+
+def _get_path(document, path):
+    for key in path.split('.'):
+        if not isinstance(document, dict) or key not in document:
+            return None
+        document = document[key]
+    return document
+
+
+def _evaluate(expr, document, variables):
+    '''
+    Вычисляет выражение агрегационного конвейера MongoDB для одного документа.
+    Поддерживается только подмножество операторов, используемое сервисом
+    '''
+    if isinstance(expr, str) and expr.startswith('$$'):
+        name, _, path = expr[2:].partition('.')
+        value = variables.get(name)
+        return _get_path(value, path) if path else value
+    if isinstance(expr, str) and expr.startswith('$'):
+        return _get_path(document, expr[1:])
+    if isinstance(expr, list):
+        return [_evaluate(item, document, variables) for item in expr]
+    if not isinstance(expr, dict):
+        return expr
+    if len(expr) != 1 or not next(iter(expr)).startswith('$'):
+        return {key: _evaluate(value, document, variables) for key, value in expr.items()}
+    operator, args = next(iter(expr.items()))
+    if operator == '$literal':
+        return args
+    if operator == '$let':
+        scope = dict(variables)
+        scope.update({name: _evaluate(value, document, variables)
+                      for name, value in args['vars'].items()})
+        return _evaluate(args['in'], document, scope)
+    if operator in ('$dateTrunc', '$dateToParts', '$dateFromParts'):
+        args = {key: _evaluate(value, document, variables) for key, value in args.items()}
+    else:
+        args = _evaluate(args, document, variables)
+    if operator == '$add':
+        total = args[0]
+        for item in args[1:]:
+            total = total + (datetime.timedelta(milliseconds=item)
+                             if isinstance(total, datetime.datetime) else item)
+        return total
+    if operator == '$subtract':
+        left, right = args
+        if isinstance(left, datetime.datetime) and isinstance(right, datetime.datetime):
+            return (left - right) // datetime.timedelta(milliseconds=1)
+        if isinstance(left, datetime.datetime):
+            return left - datetime.timedelta(milliseconds=right)
+        return left - right
+    if operator == '$divide':
+        return args[0] / args[1]
+    if operator == '$ln':
+        return math.log(args)
+    if operator == '$ceil':
+        return float(math.ceil(args))
+    if operator == '$dateTrunc':
+        return _truncate(args['date'], args['unit'])
+    if operator == '$dateToParts':
+        value = args['date']
+        return {"year": value.year, "month": value.month, "day": value.day,
+                "hour": value.hour, "minute": value.minute, "second": value.second,
+                "millisecond": value.microsecond // 1000}
+    if operator == '$dateFromParts':
+        return datetime.datetime(args['year'], args.get('month', 1), args.get('day', 1),
+                                 args.get('hour', 0), args.get('minute', 0),
+                                 args.get('second', 0), args.get('millisecond', 0) * 1000)
+    if operator == '$year':
+        return args.year
+    if operator == '$month':
+        return args.month
+    if operator == '$dayOfMonth':
+        return args.day
+    if operator == '$hour':
+        return args.hour
+    if operator == '$minute':
+        return args.minute
+    if operator == '$cond':
+        if isinstance(args, dict):
+            args = [args['if'], args['then'], args['else']]
+        return args[1] if args[0] else args[2]
+    if operator == '$eq':
+        return args[0] == args[1]
+    if operator == '$ne':
+        return args[0] != args[1]
+    if operator == '$gt':
+        return args[0] > args[1]
+    if operator == '$gte':
+        return args[0] >= args[1]
+    if operator == '$lte':
+        return args[0] <= args[1]
+    if operator == '$and':
+        return all(args)
+    if operator == '$or':
+        return any(args)
+    if operator == '$not':
+        return not (args[0] if isinstance(args, list) else args)
+    raise NotImplementedError(f"Operator {operator} is not supported by the stand-in")
+
+
+def _matches(document, condition):
+    for key, expected in condition.items():
+        if key == '$expr':
+            if not _evaluate(expected, document, {}):
+                return False
+            continue
+        if key == '$or':
+            if not any(_matches(document, branch) for branch in expected):
+                return False
+            continue
+        value = _get_path(document, key)
+        if not isinstance(expected, dict):
+            if value != expected:
+                return False
+            continue
+        for operator, bound in expected.items():
+            if value is None:
+                return False
+            if operator == '$gte' and not value >= _to_ms(bound):
+                return False
+            if operator == '$gt' and not value > _to_ms(bound):
+                return False
+            if operator == '$lte' and not value <= _to_ms(bound):
+                return False
+            if operator == '$lt' and not value < _to_ms(bound):
+                return False
+    return True
+
+
+class InProcessCursor:
+    def __init__(self, documents):
+        self._documents = documents
+
+    async def to_list(self, length=None):
+        return self._documents if length is None else self._documents[:length]
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for document in self._documents:
+            yield document
+
+
+class InProcessDatabase:
+    def __init__(self, version="7.0.0"):
+        self.version = version
+        self.collections = {}
+
+    def get_collection(self, name):
+        if name not in self.collections:
+            self.collections[name] = InProcessCollection([], round_trip=0, database=self, key=None, name=name)
+        return self.collections[name]
+
+    async def command(self, name, value=None, **kwargs):
+        if name == "buildInfo":
+            return {"version": self.version,
+                    "versionArray": [int(part) for part in self.version.split('.')] + [0]}
+        if name == "explain":
+            collection = self.get_collection(value["aggregate"])
+            if [("dt", 1), ("value", 1)] in [index['key'] for index in collection.indexes.values()]:
+                plan = {"stage": "PROJECTION_COVERED", "inputStage": {"stage": "IXSCAN"}}
+            else:
+                plan = {"stage": "COLLSCAN"}
+            return {"stages": [{"$cursor": {"queryPlanner": {"winningPlan": plan}}}]}
+        raise NotImplementedError(f"Command {name} is not supported by the stand-in")
+
+
+class InProcessCollection:
+    '''
+    Упрощенная замена коллекции motor, хранящая документы в памяти
+    (отсортированными по полю dt, что имитирует индекс) и выполняющая
+    подмножество агрегационного конвейера. Документам без _id, как и драйвер,
+    коллекция присваивает ObjectId. Каждое обращение к коллекции
+    задерживается на round_trip секунд, что имитирует сетевую задержку до сервера
+    '''
+    def __init__(self, documents, round_trip=0.0005, version="7.0.0", database=None, key="dt", name="salaries"):
+        self.key = key
+        self.name = name
+        self.round_trip = round_trip
+        self.database = database or InProcessDatabase(version)
+        self.database.collections.setdefault(name, self)
+        self.indexes = {"_id_": {"key": [("_id", 1)]}}
+        self.round_trips = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        for document in documents:
+            document.setdefault("_id", ObjectId())
+        self._load(documents)
+
+    def _load(self, documents):
+        if self.key:
+            self.documents = sorted(documents, key=lambda document: document[self.key])
+            self._keys = [document[self.key] for document in self.documents]
+        else:
+            self.documents = list(documents)
+
+    async def index_information(self):
+        return dict(self.indexes)
+
+    async def create_index(self, keys):
+        name = "_".join(f"{field}_{direction}" for field, direction in keys)
+        self.indexes[name] = {"key": list(keys)}
+        return name
+
+    async def insert_many(self, documents):
+        for document in documents:
+            document.setdefault("_id", ObjectId())
+        self._load(self.documents + [dict(document) for document in documents])
+
+    def find(self, condition=None, projection=None, sort=None, batch_size=None):
+        documents = self._run([{"$match": condition or {}}])
+        for field, direction in reversed(sort or []):
+            documents.sort(key=lambda document: _get_path(document, field), reverse=direction < 0)
+        if projection:
+            documents = self._run_on(documents, [{"$project": projection}])
+        return InProcessCursor(documents)
+
+    async def find_one(self, condition=None, sort=None):
+        documents = self._run([{"$match": condition or {}}])
+        for field, direction in reversed(sort or []):
+            documents.sort(key=lambda document: _get_path(document, field), reverse=direction < 0)
+        return documents[0] if documents else None
+
+    async def update_one(self, condition, update, upsert=False):
+        documents = self._run([{"$match": condition}])
+        if documents:
+            document = documents[0]
+        elif upsert:
+            document = {key: value for key, value in condition.items() if not isinstance(value, dict)}
+            self._load(self.documents + [document])
+        else:
+            return
+        document.update(update.get("$set", {}))
+        for field, delta in update.get("$inc", {}).items():
+            document[field] = document.get(field, 0) + delta
+
+    async def delete_many(self, condition):
+        removed = {id(document) for document in self._run([{"$match": condition}])}
+        self._load([document for document in self.documents if id(document) not in removed])
+
+    async def delete_one(self, condition):
+        documents = self._run([{"$match": condition}])
+        if documents:
+            self._load([document for document in self.documents if document is not documents[0]])
+
+    def _scan(self, condition):
+        bounds = condition.get(self.key) if isinstance(condition.get(self.key), dict) else {}
+        if not self.key:
+            return [document for document in self.documents if _matches(document, condition)]
+        start, stop = 0, len(self._keys)
+        if "$gte" in bounds:
+            start = bisect.bisect_left(self._keys, _to_ms(bounds["$gte"]))
+        elif "$gt" in bounds:
+            start = bisect.bisect_right(self._keys, _to_ms(bounds["$gt"]))
+        if "$lte" in bounds:
+            stop = bisect.bisect_right(self._keys, _to_ms(bounds["$lte"]))
+        elif "$lt" in bounds:
+            stop = bisect.bisect_left(self._keys, _to_ms(bounds["$lt"]))
+        return [document for document in self.documents[start:stop] if _matches(document, condition)]
+
+    def _run(self, pipeline):
+        stages = list(pipeline)
+        if stages and "$match" in stages[0]:
+            documents = self._scan(stages.pop(0)["$match"])
+        else:
+            documents = list(self.documents)
+        return self._run_on(documents, stages)
+
+    def _run_on(self, documents, stages):
+        for stage in stages:
+            operator, spec = next(iter(stage.items()))
+            if operator == '$match':
+                documents = [document for document in documents if _matches(document, spec)]
+            elif operator in ('$project', '$addFields', '$set'):
+                projected = []
+                for document in documents:
+                    result = dict(document) if operator != '$project' else {}
+                    if operator == '$project' and spec.get('_id', 1) and '_id' in document:
+                        result['_id'] = document['_id']
+                    for key, value in spec.items():
+                        if value in (0, False):
+                            result.pop(key, None)
+                        elif value in (1, True):
+                            if key in document:
+                                result[key] = document[key]
+                        else:
+                            result[key] = _evaluate(value, document, {})
+                    projected.append(result)
+                documents = projected
+            elif operator == '$group':
+                groups = {}
+                for document in documents:
+                    key = _evaluate(spec['_id'], document, {})
+                    hashable = tuple(sorted(key.items())) if isinstance(key, dict) else key
+                    group = groups.setdefault(hashable, {'_id': key})
+                    for field, accumulator in spec.items():
+                        if field == '_id':
+                            continue
+                        (name, argument), = accumulator.items()
+                        value = _evaluate(argument, document, {})
+                        if name == '$sum':
+                            group[field] = group.get(field, 0) + (value if isinstance(value, (int, float)) else 0)
+                        elif name in ('$max', '$min'):
+                            if value is not None and (group.get(field) is None or
+                                                      (value > group[field]) == (name == '$max')):
+                                group[field] = value
+                        else:
+                            raise NotImplementedError(f"Accumulator {name} is not supported by the stand-in")
+                documents = list(groups.values())
+            elif operator == '$merge':
+                target = self.database.get_collection(spec['into'])
+                merged = {document['_id']: document for document in target.documents}
+                for document in documents:
+                    if document['_id'] in merged and spec.get('whenMatched') == 'keepExisting':
+                        continue
+                    merged[document['_id']] = dict(document)
+                target._load(list(merged.values()))
+                documents = []
+            elif operator == '$facet':
+                documents = [{name: self._run_on(list(documents), branch) for name, branch in spec.items()}]
+            elif operator == '$sort':
+                for field, direction in reversed(list(spec.items())):
+                    documents.sort(key=lambda document: _get_path(document, field), reverse=direction < 0)
+            else:
+                raise NotImplementedError(f"Stage {operator} is not supported by the stand-in")
+        return documents
+
+    def aggregate(self, pipeline):
+        return _DeferredCursor(self, pipeline)
+
+
+class _DeferredCursor(InProcessCursor):
+    def __init__(self, collection, pipeline):
+        super().__init__(None)
+        self._collection = collection
+        self._pipeline = pipeline
+
+    async def _load(self):
+        if self._documents is None:
+            collection = self._collection
+            collection.round_trips += 1
+            collection.in_flight += 1
+            collection.max_in_flight = max(collection.max_in_flight, collection.in_flight)
+            try:
+                await asyncio.sleep(collection.round_trip)
+            finally:
+                collection.in_flight -= 1
+            self._documents = collection._run(self._pipeline)
+
+    async def to_list(self, length=None):
+        await self._load()
+        return await super().to_list(length)
+
+    async def _iterate(self):
+        await self._load()
+        for document in self._documents:
+            yield document
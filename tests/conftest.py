@@ -0,0 +1,25 @@
+import pytest
+
+from utils import cache, mongodb
+from utils.cache import BucketCache, ResponseCache
+from benchmarks.standin import InProcessCollection
+
+
+@pytest.fixture()
+def standin(monkeypatch):
+    '''
+    Подменяет коллекцию salaries коллекцией в памяти процесса (benchmarks.standin):
+    движок "bucket" без витрины, новые пустые кэш ответов и кэш сумм по интервалам.
+    Возвращает функцию use(documents, round_trip, bucket_entries, ttl), которая выполняет подмену
+    и возвращает коллекцию
+    '''
+    def use(documents, round_trip=0.0005, bucket_entries=1000, ttl=60):
+        collection = InProcessCollection(documents, round_trip=round_trip)
+        monkeypatch.setattr(mongodb, 'salaries', collection)
+        monkeypatch.setattr(mongodb, 'AGGREGATION_ENGINE', 'bucket')
+        monkeypatch.setattr(mongodb, 'USE_ROLLUP', False)
+        monkeypatch.setattr(cache, 'bucket_cache', BucketCache(max_entries=bucket_entries))
+        monkeypatch.setattr(cache, 'response_cache', ResponseCache(ttl=ttl))
+        return collection
+
+    return use
@@ -1,4 +1,11 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+from pathlib import Path
 import pytest
+from fastapi import HTTPException
 
 from app import get_data
 
@@ -16,7 +23,8 @@ async def test_async_get_data():
     :return:
     '''
     response = await get_data(dt_from, dt_upto, group_type)
-    assert response == {"dataset": [5906586,5515874,5889803,6092634],
+    assert response.media_type == "application/json"
+    assert json.loads(response.body) == {"dataset": [5906586,5515874,5889803,6092634],
                         "labels": ["2022-09-01T00:00:00",
                                    "2022-10-01T00:00:00",
                                    "2022-11-01T00:00:00",
@@ -24,3 +32,58 @@ async def test_async_get_data():
                        }
 
 
+
+
+@pytest.mark.asyncio
+async def test_async_get_data_stream():
+    response = await get_data(dt_from, dt_upto, group_type, stream="ndjson")
+    assert response.media_type == "application/x-ndjson"
+    lines = [json.loads(line) async for line in response.body_iterator]
+    assert lines == [{"label": "2022-09-01T00:00:00", "value": 5906586},
+                     {"label": "2022-10-01T00:00:00", "value": 5515874},
+                     {"label": "2022-11-01T00:00:00", "value": 5889803},
+                     {"label": "2022-12-01T00:00:00", "value": 6092634}]
+
+
+@pytest.mark.asyncio
+async def test_async_get_data_invalid():
+    # некорректный тип периода и период отклоняются до обращения к базе данных (как в POST запросе)
+    for stream in (None, "ndjson"):
+        with pytest.raises(HTTPException) as error:
+            await get_data(dt_from, dt_upto, "zzz", stream=stream)
+        assert error.value.status_code == 422
+    with pytest.raises(HTTPException) as error:
+        await get_data(dt_upto, dt_from, group_type)
+    assert error.value.status_code == 422
+
+
+def test_lazy_startup():
+    # импорт приложения не загружает aiogram и драйвер MongoDB, клиент создается при первом обращении
+    code = """
+import sys
+import app
+from utils import mongodb
+assert 'aiogram' not in sys.modules and 'motor' not in sys.modules
+collection = mongodb.salaries
+assert 'motor' in sys.modules and mongodb.connect() is collection
+mongodb.close()
+assert mongodb.salaries is not collection
+"""
+    subprocess.run([sys.executable, "-c", code], cwd=Path(__file__).resolve().parent.parent, check=True)
+
+
+def test_dotenv_settings(tmp_path):
+    # настройки из .env учитываются модулями utils, которые читают их при импорте
+    root = Path(__file__).resolve().parent.parent
+    shutil.copy(root / "app.py", tmp_path)
+    shutil.copytree(root / "utils", tmp_path / "utils", ignore=shutil.ignore_patterns("__pycache__"))
+    (tmp_path / ".env").write_text("AGGREGATION_ENGINE=numpy\nCACHE_TTL=7\nTELEGRAM_BOT_MODE=worker\n")
+    code = """
+import app
+from utils import cache, mongodb, telegram
+assert app.AGGREGATION_ENGINE == mongodb.AGGREGATION_ENGINE == 'numpy'
+assert cache.CACHE_TTL == 7 and app.TELEGRAM_BOT_MODE == 'worker'
+"""
+    env = {key: value for key, value in os.environ.items()
+           if key not in ("AGGREGATION_ENGINE", "CACHE_TTL", "TELEGRAM_BOT_MODE")}
+    subprocess.run([sys.executable, "-c", code], cwd=tmp_path, env=env, check=True)
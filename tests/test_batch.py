@@ -0,0 +1,122 @@
+import datetime
+import pytest
+
+from utils import batch, mongodb
+from utils.batch import parse_spec, plan_batch, aggregate_batch
+from utils.mongodb import compile_intervals, do_aggregate
+from benchmarks.generator import generate_salaries
+
+specs = [
+    {"dt_from": "2022-09-01T00:00:00", "dt_upto": "2022-12-31T23:59:00", "group_type": "month"},
+    {"dt_from": "2022-10-01T00:00:00", "dt_upto": "2022-10-03T00:00:00", "group_type": "day"},
+    {"dt_from": "2022-10-02T00:00:00", "dt_upto": "2022-10-05T00:00:00", "group_type": "day"},
+    {"dt_from": "2022-10-06T00:00:00", "dt_upto": "2022-10-07T00:00:00", "group_type": "day"},
+    {"dt_from": "2022-11-01T00:00:30", "dt_upto": "2022-11-01T05:00:00", "group_type": "hour"},
+    {"dt_from": "2022-09-01T00:00:00", "dt_upto": "2022-12-31T23:59:00", "group_type": "month"},
+]
+
+
+async def plan(specs):
+    requests = []
+    for number, spec in enumerate(specs):
+        dt_from, dt_upto, group_type = parse_spec(spec)
+        requests.append((number, await compile_intervals(dt_from, dt_upto, group_type), group_type))
+    return plan_batch(requests)
+
+
+def test_parse_spec():
+    with pytest.raises(ValueError):
+        parse_spec({"dt_from": "2022-10-01T00:00:00", "dt_upto": "2022-10-03T00:00:00", "group_type": "minute"})
+    with pytest.raises(ValueError):
+        parse_spec({"dt_from": "2022-10-03T00:00:00", "dt_upto": "2022-10-01T00:00:00", "group_type": "day"})
+    with pytest.raises(ValueError):
+        parse_spec({"dt_from": "not a date", "dt_upto": "2022-10-01T00:00:00", "group_type": "day"})
+    with pytest.raises(ValueError):
+        parse_spec({"dt_from": "2022-10-01T00:00:00"})
+
+
+@pytest.mark.asyncio()
+async def test_async_plan_batch():
+    # одинаковые, пересекающиеся и смежные запросы объединяются, запрос с другой сеткой - нет
+    groups = await plan(specs)
+    members = sorted(sorted(number for number, intervals in group[3]) for group in groups)
+    assert members == [[0, 5], [1, 2, 3], [4]]
+    days = next(group for group in groups if group[0] == 'day')
+    assert days[1:3] == (datetime.datetime(2022, 10, 1), datetime.datetime(2022, 10, 7))
+
+
+@pytest.mark.asyncio()
+async def test_async_aggregate_batch(standin):
+    # результаты пакета совпадают с результатами отдельных запросов, ошибки не влияют на остальные
+    documents = generate_salaries(datetime.datetime(2022, 9, 1), datetime.datetime(2022, 12, 31, 23, 59), 5000)
+    collection = standin(documents)
+    invalid = {"dt_from": "2022-10-01T00:00:00", "dt_upto": "2022-10-03T00:00:00", "group_type": "minute"}
+    results = await aggregate_batch(specs + [invalid])
+    assert list(results[-1]) == ["error"]
+    # все группы вычислены одним запросом к базе данных
+    assert collection.round_trips == 1
+    for spec, result in zip(specs, results):
+        dataset, labels = await do_aggregate(*parse_spec(spec), engine='interval', use_rollup=False)
+        assert result == {"dataset": dataset, "labels": labels}
+
+
+@pytest.mark.asyncio()
+async def test_async_aggregate_batch_errors(standin, monkeypatch):
+    # период у границы диапазона дат, даты со смещением UTC и без него, ошибка общего запроса
+    # не приводят к ошибке остальных запросов пакета
+    documents = generate_salaries(datetime.datetime(2022, 9, 1), datetime.datetime(2022, 12, 31, 23, 59), 5000)
+    standin(documents)
+    mixed = [
+        {"dt_from": "9999-01-01T00:00:00", "dt_upto": "9999-12-31T23:59:00", "group_type": "month"},
+        {"dt_from": "2022-10-01T00:00:00+03:00", "dt_upto": "2022-10-05T00:00:00+03:00", "group_type": "day"},
+        {"dt_from": "2022-10-01T00:00:00+00:00", "dt_upto": "2022-10-05T00:00:00+00:00", "group_type": "day"},
+    ] + specs
+    results = await aggregate_batch(mixed)
+    assert list(results[0]) == ["error"]
+    for spec, result in zip(mixed[1:], results[1:]):
+        dataset, labels = await do_aggregate(*parse_spec(spec), engine='interval', use_rollup=False)
+        assert result == {"dataset": dataset, "labels": labels}
+
+    async def aggregate_facet(groups):
+        raise RuntimeError("facet failed")
+
+    monkeypatch.setattr(batch, 'aggregate_facet', aggregate_facet)
+    assert await aggregate_batch(mixed) == results
+
+
+@pytest.mark.asyncio()
+async def test_async_aware_composite_engines(tmp_path, standin, monkeypatch):
+    # неделя, квартал и год с датами со смещением UTC: все движки, кэш сумм и пакетный запрос
+    # складывают суммы из сумм дней и месяцев по местному времени
+    import bson
+    from utils import dump, prefix_index, snapshot
+    from utils.cache import cached_aggregate
+    from utils.intervals import expand_intervals, merge_dataset, to_utc
+    documents = generate_salaries(datetime.datetime(2022, 9, 1), datetime.datetime(2022, 12, 31, 23, 59), 5000)
+    # документы внутри последней минуты дня и месяца по местному времени (+03:00)
+    documents += [{"dt": datetime.datetime(2022, 9, 7, 20, 59, 30), "value": 1000000},
+                  {"dt": datetime.datetime(2022, 9, 30, 20, 59, 30), "value": 2000000}]
+    standin(documents)
+    await snapshot.export_snapshot(tmp_path)
+    monkeypatch.setattr(snapshot, '_snapshot', snapshot.Snapshot.load(tmp_path))
+    with open(tmp_path / "salaries.bson", 'wb') as file:
+        for document in documents:
+            file.write(bson.encode(document))
+    monkeypatch.setattr(dump, 'DUMP_PATH', tmp_path / "salaries.bson")
+    monkeypatch.setattr(prefix_index, '_index', None)
+    monkeypatch.setattr(prefix_index, '_pending', None)
+    aware = [
+        {"dt_from": "2022-09-05T00:00:00+03:00", "dt_upto": "2022-12-25T00:00:00+03:00", "group_type": "week"},
+        {"dt_from": "2022-09-01T00:00:00+03:00", "dt_upto": "2022-12-31T23:59:00+03:00", "group_type": "quarter"},
+        {"dt_from": "2022-09-01T00:00:00-05:00", "dt_upto": "2022-12-31T23:59:00-05:00", "group_type": "year"},
+    ]
+    results = await aggregate_batch(aware)
+    for spec, result in zip(aware, results):
+        dt_from, dt_upto, group_type = parse_spec(spec)
+        intervals = await compile_intervals(dt_from, dt_upto, group_type)
+        base_intervals, base_type = expand_intervals(intervals, group_type)
+        expected = merge_dataset(await mongodb.aggregate_by_intervals(to_utc(base_intervals)), group_type)
+        assert result["dataset"] == expected, spec
+        assert (await cached_aggregate(dt_from, dt_upto, group_type))[0] == expected, spec
+        for engine in ('bucket', 'interval', 'numpy', 'prefix', 'dump'):
+            assert (await do_aggregate(dt_from, dt_upto, group_type, engine=engine))[0] == expected, (spec, engine)
@@ -0,0 +1,24 @@
+import datetime
+
+from benchmarks.generator import generate_salaries, DISTRIBUTIONS
+from benchmarks.run import percentile, summarize
+
+dt_from = datetime.datetime(2022, 1, 1)
+dt_upto = datetime.datetime(2022, 1, 31, 23, 59)
+
+
+def test_generate_salaries():
+    for distribution in DISTRIBUTIONS:
+        documents = generate_salaries(dt_from, dt_upto, 1000, seed=1, distribution=distribution)
+        assert len(documents) == 1000
+        assert all(dt_from <= document["dt"] <= dt_upto for document in documents)
+        assert documents == generate_salaries(dt_from, dt_upto, 1000, seed=1, distribution=distribution)
+    business_hours = generate_salaries(dt_from, dt_upto, 1000, distribution='business_hours')
+    assert sum(9 <= document["dt"].hour < 18 for document in business_hours) > 800
+
+
+def test_percentile():
+    values = [value / 1000 for value in range(1, 101)]
+    assert percentile(values, 50) == 0.05
+    assert percentile(values, 99) == 0.099
+    assert summarize(values, elapsed=2)["rps"] == 50
@@ -0,0 +1,211 @@
+import asyncio
+import datetime
+import pytest
+
+from utils import cache
+from utils.cache import (ResponseCache, BucketCache, request_key, aggregate_with_bucket_cache,
+                         cached_aggregate_json)
+from utils.mongodb import compile_intervals
+
+result = ([5906586, 5515874], ["2022-09-01T00:00:00", "2022-10-01T00:00:00"])
+
+
+async def get_key(dt_from, dt_upto, group_type):
+    return request_key(await compile_intervals(dt_from, dt_upto, group_type), group_type)
+
+
+@pytest.mark.asyncio()
+async def test_async_request_key():
+    # запросы с одинаковыми интервалами агрегации получают одинаковый ключ
+    key = await get_key(datetime.datetime(2022, 9, 1), datetime.datetime(2022, 10, 31, 23, 59), 'month')
+    assert key == await get_key(datetime.datetime(2022, 9, 15, 12, 0), datetime.datetime(2022, 10, 2), 'month')
+    assert key != await get_key(datetime.datetime(2022, 9, 1), datetime.datetime(2022, 10, 31, 23, 59), 'day')
+
+
+@pytest.mark.asyncio()
+async def test_async_single_flight():
+    # одновременные одинаковые запросы вычисляются один раз
+    cache = ResponseCache(ttl=60)
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return result
+
+    results = await asyncio.gather(*[cache.get_or_compute('key', compute) for _ in range(10)])
+    assert results == [result] * 10
+    assert calls == [1]
+    assert await cache.get_or_compute('key', compute) == result
+    assert cache.stats()["misses"] == 1 and cache.stats()["coalesced"] == 9 and cache.stats()["hits"] == 1
+
+
+@pytest.mark.asyncio()
+async def test_async_eviction_and_ttl():
+    cache = ResponseCache(max_entries=2, ttl=60)
+
+    async def compute():
+        return result
+
+    for key in ('a', 'b', 'a', 'c'):
+        await cache.get_or_compute(key, compute)
+    # запись 'b' использовалась давнее остальных и вытеснена
+    assert cache.get('b') is None and cache.get('a') == result and cache.get('c') == result
+    assert cache.stats()["evictions"] == 1
+
+    cache = ResponseCache(ttl=0.01)
+    await cache.get_or_compute('a', compute)
+    await asyncio.sleep(0.02)
+    assert cache.get('a') is None
+    assert cache.stats()["expirations"] == 1
+
+    cache = ResponseCache(max_bytes=1, ttl=60)
+    await cache.get_or_compute('a', compute)
+    assert cache.get('a') is None
+
+
+@pytest.mark.asyncio()
+async def test_async_failed_computation_is_not_cached():
+    cache = ResponseCache(ttl=60)
+
+    async def compute():
+        raise ValueError("error")
+
+    with pytest.raises(ValueError):
+        await cache.get_or_compute('a', compute)
+    assert cache.get('a') is None
+
+
+@pytest.mark.asyncio()
+async def test_async_bucket_cache(monkeypatch):
+    # при сдвиге периода запрашиваются только недостающие интервалы одним диапазоном
+    requested = []
+
+    async def aggregate_intervals(intervals, group_type):
+        requested.append([interval[0].month for interval in intervals])
+        return [interval[0].month for interval in intervals]
+
+    monkeypatch.setattr(cache, 'aggregate_intervals', aggregate_intervals)
+    monkeypatch.setattr(cache, 'bucket_cache', BucketCache(max_entries=100, open_ttl=5))
+    intervals = await compile_intervals(datetime.datetime(2022, 9, 1), datetime.datetime(2022, 12, 31), 'month')
+    assert await aggregate_with_bucket_cache(intervals, 'month') == [9, 10, 11, 12]
+    intervals = await compile_intervals(datetime.datetime(2022, 10, 1), datetime.datetime(2023, 1, 31), 'month')
+    assert await aggregate_with_bucket_cache(intervals, 'month') == [10, 11, 12, 1]
+    assert requested == [[9, 10, 11, 12], [1]]
+
+
+async def test_async_bucket_cache_composite(monkeypatch):
+    # квартал складывается из месячных сумм, уже находящихся в кэше, без запроса к базе данных
+    requested = []
+
+    async def aggregate_intervals(intervals, group_type):
+        requested.append(group_type)
+        return [interval[0].month for interval in intervals]
+
+    monkeypatch.setattr(cache, 'aggregate_intervals', aggregate_intervals)
+    monkeypatch.setattr(cache, 'bucket_cache', BucketCache(max_entries=100, open_ttl=5))
+    months = await compile_intervals(datetime.datetime(2022, 1, 1), datetime.datetime(2022, 12, 31), 'month')
+    await aggregate_with_bucket_cache(months, 'month')
+    quarters = await compile_intervals(datetime.datetime(2022, 1, 1), datetime.datetime(2022, 12, 31), 'quarter')
+    assert await aggregate_with_bucket_cache(quarters, 'quarter') == [6, 15, 24, 33]
+    assert requested == ['month']
+
+
+async def test_async_cached_aggregate_json(monkeypatch):
+    # в кэше хранится закодированный ответ, попадание в кэш возвращает те же байты без вычисления
+    requested = []
+
+    async def aggregate_intervals(intervals, group_type):
+        requested.append(group_type)
+        return [interval[0].month for interval in intervals]
+
+    monkeypatch.setattr(cache, 'aggregate_intervals', aggregate_intervals)
+    monkeypatch.setattr(cache, 'bucket_cache', BucketCache(max_entries=0))
+    monkeypatch.setattr(cache, 'response_cache', ResponseCache(ttl=60))
+    content = await cached_aggregate_json(datetime.datetime(2022, 9, 1), datetime.datetime(2022, 10, 31), 'month')
+    assert content == b'{"dataset":[9,10],"labels":["2022-09-01T00:00:00","2022-10-01T00:00:00"]}'
+    again = await cached_aggregate_json(datetime.datetime(2022, 9, 1), datetime.datetime(2022, 10, 31), 'month')
+    assert again is content and requested == ['month']
+
+
+def test_bucket_cache_open_interval():
+    # незавершенный интервал хранится в кэше ограниченное время
+    bucket_cache = BucketCache(max_entries=100, open_ttl=0)
+    now = datetime.datetime(2022, 10, 15)
+    intervals = [(datetime.datetime(2022, 9, 1), datetime.datetime(2022, 9, 30, 23, 59)),
+                 (datetime.datetime(2022, 10, 1), datetime.datetime(2022, 10, 31, 23, 59))]
+    bucket_cache.store('month', intervals, [1, 2], now)
+    assert bucket_cache.lookup('month', intervals) == [1, None]
+
+
+@pytest.mark.parametrize('offset', [0, 3])
+def test_aware_dates(standin, offset):
+    # даты со смещением UTC (ISO 8601 "+03:00") сравниваются с текущим временем в UTC,
+    # суммы интервалов совпадают с суммами по границам интервалов в UTC
+    from fastapi.testclient import TestClient
+    import app
+    from utils import mongodb
+    from utils.intervals import to_utc
+    from benchmarks.generator import generate_salaries
+    standin(generate_salaries(datetime.datetime(2022, 8, 31), datetime.datetime(2022, 10, 1, 23, 59), 3000))
+    suffix = f"+{offset:02d}:00"
+    params = {"dt_from": "2022-09-01T00:00:00" + suffix, "dt_upto": "2022-09-30T23:59:00" + suffix, "group_type": "day"}
+    tz = datetime.timezone(datetime.timedelta(hours=offset))
+    intervals = asyncio.run(compile_intervals(datetime.datetime(2022, 9, 1, tzinfo=tz),
+                                              datetime.datetime(2022, 9, 30, 23, 59, tzinfo=tz), 'day'))
+    expected = asyncio.run(mongodb.aggregate_by_intervals(to_utc(intervals)))
+    assert cache.is_closed(intervals[-1])
+    client = TestClient(app.app)
+    for response in (client.get('/aggregated_data/', params=params),
+                     client.post('/aggregated_data/', json=params)):
+        assert response.status_code == 200
+        assert response.json()["dataset"] == expected
+        assert response.json()["labels"][0] == "2022-09-01T00:00:00" + suffix
+    response = client.post('/aggregated_data/', json={**params, "metrics": "count"})
+    assert response.status_code == (200 if offset == 0 else 422)
+
+
+def test_stream_does_not_fill_bucket_cache(standin):
+    # потоковый ответ читает кэш сумм по интервалам, но не записывает в него суммы длинного периода
+    from fastapi.testclient import TestClient
+    import app
+    from utils.encoding import loads
+    from benchmarks.generator import generate_salaries
+    standin(generate_salaries(datetime.datetime(2022, 1, 1), datetime.datetime(2022, 12, 31, 23, 59), 3000))
+    client = TestClient(app.app)
+    params = {"dt_from": "2022-01-01T00:00:00", "dt_upto": "2022-12-31T23:59:00", "group_type": "hour"}
+    streamed = client.get('/aggregated_data/', params={**params, "stream": "ndjson"}).text.splitlines()
+    assert len(streamed) == 365 * 24 and cache.bucket_cache.stats()["entries"] == 0
+    day = {"dt_from": "2022-03-01T00:00:00", "dt_upto": "2022-03-01T23:59:00", "group_type": "hour"}
+    dataset = client.get('/aggregated_data/', params=day).json()["dataset"]
+    assert cache.bucket_cache.stats()["entries"] == 24
+    hits = cache.bucket_cache.stats()["hits"]
+    again = client.get('/aggregated_data/', params={**day, "stream": "ndjson"}).text.splitlines()
+    assert [loads(line)["value"] for line in again] == dataset
+    assert cache.bucket_cache.stats()["hits"] == hits + 24
+
+
+@pytest.mark.asyncio()
+async def test_async_period_key(monkeypatch):
+    # ключ по входным данным совпадает с ключом по интервалам, при попадании в кэш интервалы не формируются
+    moscow = datetime.timezone(datetime.timedelta(hours=3))
+    for dt_from, dt_upto in ((datetime.datetime(2022, 9, 15, 12, 0, 30), datetime.datetime(2023, 10, 2)),
+                             (datetime.datetime(2022, 9, 1, tzinfo=moscow), datetime.datetime(2022, 9, 1, 5, tzinfo=moscow))):
+        for group_type in ('year', 'quarter', 'month', 'week', 'day', 'hour'):
+            assert cache.period_key(dt_from, dt_upto, group_type) == await get_key(dt_from, dt_upto, group_type)
+    compiled = []
+
+    async def aggregate_intervals(intervals, group_type):
+        return [0] * len(intervals)
+
+    async def compile_intervals_spy(dt_from, dt_upto, group_type):
+        compiled.append(group_type)
+        return await compile_intervals(dt_from, dt_upto, group_type)
+
+    monkeypatch.setattr(cache, 'aggregate_intervals', aggregate_intervals)
+    monkeypatch.setattr(cache, 'compile_intervals', compile_intervals_spy)
+    monkeypatch.setattr(cache, 'bucket_cache', BucketCache(max_entries=0))
+    monkeypatch.setattr(cache, 'response_cache', ResponseCache(ttl=60))
+    for _ in range(3):
+        await cached_aggregate_json(datetime.datetime(2020, 1, 1), datetime.datetime(2022, 12, 31, 23, 59), 'hour')
+    assert compiled == ['hour']
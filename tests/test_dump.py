@@ -0,0 +1,125 @@
+import datetime
+import subprocess
+import sys
+from pathlib import Path
+
+import bson
+import pytest
+
+from utils import dump
+from utils.dump import aggregate, iter_documents
+from utils.mongodb import do_aggregate
+from utils.snapshot import Snapshot
+from utils.intervals import iter_intervals
+from benchmarks.generator import generate_salaries
+
+documents = generate_salaries(datetime.datetime(2022, 9, 1), datetime.datetime(2022, 12, 31, 23, 59), 5000)
+requests = [
+    (datetime.datetime(2022, 9, 1), datetime.datetime(2022, 12, 31, 23, 59), 'month'),
+    (datetime.datetime(2022, 10, 1), datetime.datetime(2022, 11, 30, 23, 59), 'week'),
+    (datetime.datetime(2022, 10, 1, 0, 0, 30), datetime.datetime(2022, 10, 15), 'day'),
+    (datetime.datetime(2022, 11, 1), datetime.datetime(2022, 11, 2), 'hour'),
+]
+
+
+@pytest.fixture()
+def dump_path(tmp_path):
+    path = tmp_path / "salaries.bson"
+    with open(path, 'wb') as file:
+        for document in documents:
+            file.write(bson.encode(document))
+    return path
+
+
+def test_iter_documents(dump_path):
+    assert [document["dt"] for document in iter_documents(dump_path)] == [document["dt"] for document in documents]
+
+
+async def test_async_aggregate_dump(dump_path, standin, monkeypatch):
+    # результаты по выгрузке совпадают с результатами запросов к коллекции
+    standin(documents)
+    monkeypatch.setattr(dump, 'DUMP_PATH', dump_path)
+    for dt_from, dt_upto, group_type in requests:
+        expected = await do_aggregate(dt_from, dt_upto, group_type, engine='bucket')
+        assert aggregate(dt_from, dt_upto, group_type, dump_path) == expected
+        assert await do_aggregate(dt_from, dt_upto, group_type, engine='dump') == expected
+
+
+async def test_async_aggregate_dump_aware(dump_path, standin, monkeypatch):
+    # даты со смещением UTC: интервалы по местному времени суммируются по их границам в UTC
+    standin(documents)
+    monkeypatch.setattr(dump, 'DUMP_PATH', dump_path)
+    for hours in (0, 3):
+        tz = datetime.timezone(datetime.timedelta(hours=hours))
+        dt_from, dt_upto = datetime.datetime(2022, 10, 1, tzinfo=tz), datetime.datetime(2022, 11, 30, 23, 59, tzinfo=tz)
+        for group_type in ('month', 'day'):
+            expected = await do_aggregate(dt_from, dt_upto, group_type, engine='interval')
+            assert aggregate(dt_from, dt_upto, group_type, dump_path) == expected
+            assert await do_aggregate(dt_from, dt_upto, group_type, engine='dump') == expected
+            assert await do_aggregate(dt_from, dt_upto, group_type, engine='bucket') == expected
+
+
+def test_aware_composite_endpoints(dump_path, standin):
+    # неделя, квартал и год по местному времени (+03:00) складываются из сумм дней и месяцев
+    # одинаково в GET запросе, пакетном запросе и агрегации по выгрузке
+    from fastapi.testclient import TestClient
+    import app
+    # документы внутри последней минуты дня и месяца по местному времени: не входят в суммы дней и месяцев,
+    # поэтому не входят и в суммы недели, квартала и года
+    boundary = [{"dt": datetime.datetime(2022, 9, 7, 20, 59, 30), "value": 1000000},
+                {"dt": datetime.datetime(2022, 9, 30, 20, 59, 30), "value": 2000000}]
+    with open(dump_path, 'ab') as file:
+        for document in boundary:
+            file.write(bson.encode(document))
+    standin(documents + boundary)
+    client = TestClient(app.app)
+    specs = [{"dt_from": "2022-09-05T00:00:00+03:00", "dt_upto": "2022-12-25T00:00:00+03:00", "group_type": "week"},
+             {"dt_from": "2022-09-01T00:00:00+03:00", "dt_upto": "2022-12-31T23:59:00+03:00", "group_type": "quarter"},
+             {"dt_from": "2022-09-01T00:00:00+03:00", "dt_upto": "2022-12-31T23:59:00+03:00", "group_type": "year"}]
+    batch = client.post('/aggregated_data/batch', json={"requests": specs}).json()["results"]
+    for spec, result in zip(specs, batch):
+        response = client.get('/aggregated_data/', params=spec).json()
+        dt_from, dt_upto = (datetime.datetime.fromisoformat(spec[key]) for key in ("dt_from", "dt_upto"))
+        dataset, labels = aggregate(dt_from, dt_upto, spec["group_type"], dump_path)
+        assert response == result == {"dataset": dataset, "labels": labels}, spec
+
+
+def test_dump_engine_without_mongodb(dump_path, standin, monkeypatch):
+    # приложение с движком "dump" запускается и отвечает без подключения к MongoDB и создания индексов
+    from fastapi.testclient import TestClient
+    import app
+    from utils import mongodb
+    collection = standin([])
+    calls = []
+    monkeypatch.setattr(app, 'connect', lambda: calls.append('connect'))
+    monkeypatch.setattr(app, 'ensure_indexes', lambda: calls.append('ensure_indexes'))
+    for module in (app, mongodb):
+        monkeypatch.setattr(module, 'AGGREGATION_ENGINE', 'dump')
+    monkeypatch.setattr(app, 'TELEGRAM_BOT_MODE', 'worker')
+    monkeypatch.setattr(app, 'LIVE_UPDATES', 'off')
+    monkeypatch.setattr(dump, 'DUMP_PATH', dump_path)
+    dt_from, dt_upto, group_type = requests[0]
+    with TestClient(app.app) as client:
+        response = client.get('/aggregated_data/', params={"dt_from": dt_from.isoformat(),
+                                                           "dt_upto": dt_upto.isoformat(), "group_type": group_type})
+    dataset, labels = aggregate(dt_from, dt_upto, group_type, dump_path)
+    assert response.json() == {"dataset": dataset, "labels": labels}
+    assert calls == [] and collection.round_trips == 0
+
+
+def test_aggregate_dump_snapshot(dump_path, tmp_path):
+    # за тот же проход записывается колоночный снимок всей коллекции
+    dt_from, dt_upto, group_type = requests[0]
+    dataset, labels = aggregate(dt_from, dt_upto, group_type, dump_path, tmp_path / "snapshot")
+    snapshot = Snapshot.load(tmp_path / "snapshot")
+    assert len(snapshot) == len(documents)
+    assert snapshot.aggregate(list(iter_intervals(dt_from, dt_upto, group_type))) == dataset
+
+
+def test_dump_cli(dump_path):
+    output = subprocess.run([sys.executable, "-m", "utils.dump", "2022-09-01T00:00:00", "2022-12-31T23:59:00",
+                             "month", "--path", str(dump_path)],
+                            cwd=Path(__file__).resolve().parent.parent, check=True, capture_output=True, text=True)
+    dataset, labels = aggregate(*requests[0], dump_path)
+    assert output.stdout.strip() == (
+        '{"dataset":[%s],"labels":[%s]}' % (",".join(map(str, dataset)), ",".join(f'"{label}"' for label in labels)))
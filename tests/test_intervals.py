@@ -0,0 +1,117 @@
+import datetime
+import random
+
+import pytest
+
+from benchmarks.bench_intervals import reference_intervals
+from utils import intervals as intervals_module
+from utils.intervals import (iter_intervals, interval_arrays, interval_count, expand_intervals, merge_dataset,
+                             format_labels, MINUTE)
+
+group_types = ['month', 'day', 'hour']
+spans = {'month': 800 * 86400, 'day': 60 * 86400, 'hour': 5 * 86400}
+
+
+def random_requests(count, seed):
+    '''
+    Случайные запросы: даты с секундами и микросекундами, даты на границах интервалов,
+    dt_upto раньше dt_from
+    '''
+    rnd = random.Random(seed)
+    for _ in range(count):
+        group_type = rnd.choice(group_types)
+        dt_from = datetime.datetime(2020, 1, 1) + datetime.timedelta(microseconds=rnd.randint(0, 3 * 365 * 86400 * 10**6))
+        if rnd.random() < 0.3:
+            dt_from = dt_from.replace(day=rnd.choice([1, 28]), hour=rnd.choice([0, 23]),
+                                      minute=rnd.choice([0, 59]), second=0, microsecond=0)
+        dt_upto = dt_from + datetime.timedelta(seconds=rnd.randint(-spans[group_type] // 4, spans[group_type]),
+                                               microseconds=rnd.randint(-10**6, 10**6))
+        if rnd.random() < 0.2:
+            dt_upto = dt_upto.replace(day=1, hour=0, minute=0, second=dt_from.second, microsecond=dt_from.microsecond)
+        yield dt_from, dt_upto, group_type
+
+
+def test_iter_intervals_matches_reference():
+    for dt_from, dt_upto, group_type in random_requests(1000, seed=0):
+        intervals = reference_intervals(dt_from, dt_upto, group_type)
+        assert list(iter_intervals(dt_from, dt_upto, group_type)) == intervals, (dt_from, dt_upto, group_type)
+        assert interval_count(dt_from, dt_upto, group_type) == len(intervals)
+
+
+def test_format_labels_matches_isoformat():
+    for dt_from, dt_upto, group_type in random_requests(300, seed=2):
+        intervals = list(iter_intervals(dt_from, dt_upto, group_type))
+        assert format_labels(intervals) == [interval[0].isoformat() for interval in intervals]
+    # даты со смещением UTC: смещение сохраняется в метке
+    moscow = datetime.timezone(datetime.timedelta(hours=3))
+    intervals = list(iter_intervals(datetime.datetime(2022, 9, 1, tzinfo=moscow),
+                                    datetime.datetime(2022, 9, 2, tzinfo=moscow), 'hour'))
+    assert format_labels(intervals) == [interval[0].isoformat() for interval in intervals]
+    assert format_labels(intervals)[0] == '2022-09-01T00:00:00+03:00'
+
+
+def test_interval_arrays_matches_reference():
+    for dt_from, dt_upto, group_type in random_requests(300, seed=1):
+        intervals = reference_intervals(dt_from, dt_upto, group_type)
+        starts, ends = interval_arrays(dt_from, dt_upto, group_type)
+        assert starts.tolist() == [interval[0] for interval in intervals], (dt_from, dt_upto, group_type)
+        assert ends.tolist() == [interval[1] for interval in intervals], (dt_from, dt_upto, group_type)
+
+
+def test_iter_intervals_is_lazy():
+    # первый интервал 1000-летнего почасового периода доступен без формирования остальных
+    intervals = iter_intervals(datetime.datetime(2000, 1, 1), datetime.datetime(2999, 1, 1), 'hour')
+    assert next(intervals) == (datetime.datetime(2000, 1, 1, 0, 0), datetime.datetime(2000, 1, 1, 0, 59))
+
+
+def test_iter_intervals_invalid_group_type():
+    with pytest.raises(ValueError):
+        next(iter_intervals(datetime.datetime(2022, 9, 1), datetime.datetime(2022, 9, 2), 'minute'))
+    with pytest.raises(ValueError):
+        interval_count(datetime.datetime(2022, 9, 1), datetime.datetime(2022, 9, 2), 'minute')
+
+
+def test_composite_intervals(monkeypatch):
+    # неделя начинается в день WEEK_START, квартал и год - с первого месяца квартала и года,
+    # секунды dt_from сохраняются
+    dt_from = datetime.datetime(2022, 2, 16, 10, 5, 30)
+    dt_upto = datetime.datetime(2023, 1, 3)
+    weeks = list(iter_intervals(dt_from, dt_upto, 'week'))
+    assert weeks[0] == (datetime.datetime(2022, 2, 14, 0, 0, 30), datetime.datetime(2022, 2, 20, 23, 59, 30))
+    assert weeks[-1][0] == datetime.datetime(2023, 1, 2, 0, 0, 30)
+    quarters = list(iter_intervals(dt_from, dt_upto, 'quarter'))
+    assert [interval[0].month for interval in quarters] == [1, 4, 7, 10, 1]
+    assert quarters[0][1] == datetime.datetime(2022, 3, 31, 23, 59, 30)
+    years = list(iter_intervals(dt_from, dt_upto, 'year'))
+    assert years == [(datetime.datetime(2022, 1, 1, 0, 0, 30), datetime.datetime(2022, 12, 31, 23, 59, 30)),
+                     (datetime.datetime(2023, 1, 1, 0, 0, 30), datetime.datetime(2023, 12, 31, 23, 59, 30))]
+    for group_type, intervals in (('week', weeks), ('quarter', quarters), ('year', years)):
+        assert interval_count(dt_from, dt_upto, group_type) == len(intervals)
+        starts, ends = interval_arrays(dt_from, dt_upto, group_type)
+        assert starts.tolist() == [interval[0] for interval in intervals]
+        assert ends.tolist() == [interval[1] for interval in intervals]
+    monkeypatch.setattr(intervals_module, 'WEEK_START', 7)
+    assert next(iter_intervals(dt_from, dt_upto, 'week'))[0] == datetime.datetime(2022, 2, 13, 0, 0, 30)
+
+
+def test_expand_intervals():
+    # интервалы составного типа делятся на интервалы базового типа без пропусков и перекрытий
+    quarters = list(iter_intervals(datetime.datetime(2022, 1, 1), datetime.datetime(2022, 12, 31), 'quarter'))
+    months, base = expand_intervals(quarters, 'quarter')
+    assert base == 'month' and months == list(iter_intervals(datetime.datetime(2022, 1, 1),
+                                                             datetime.datetime(2022, 12, 31), 'month'))
+    assert merge_dataset([interval[0].month for interval in months], 'quarter') == [6, 15, 24, 33]
+    assert expand_intervals(months, 'month') == (months, 'month')
+
+
+def test_expand_intervals_aware():
+    # интервалы с датами со смещением UTC делятся по местному времени, смещение сохраняется
+    moscow = datetime.timezone(datetime.timedelta(hours=3))
+    for group_type, base_type in (('week', 'day'), ('quarter', 'month'), ('year', 'month')):
+        dt_from, dt_upto = datetime.datetime(2022, 1, 3, tzinfo=moscow), datetime.datetime(2022, 12, 31, tzinfo=moscow)
+        intervals = list(iter_intervals(dt_from, dt_upto, group_type))
+        base_intervals, base = expand_intervals(intervals, group_type)
+        assert base == base_type
+        assert all(start.tzinfo is moscow and end.tzinfo is moscow for start, end in base_intervals)
+        assert base_intervals[0][0] == intervals[0][0] and base_intervals[-1][1] == intervals[-1][1]
+        assert all(end + MINUTE == start for (_, end), (start, _) in zip(base_intervals, base_intervals[1:]))
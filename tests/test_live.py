@@ -0,0 +1,147 @@
+import asyncio
+import datetime
+import random
+import pytest
+
+from utils import cache, live, rollup, prefix_index
+from utils.cache import cached_aggregate_json
+from utils.encoding import loads
+from utils.mongodb import compile_intervals, aggregate_by_buckets, bucket_of
+from benchmarks.generator import generate_salaries
+
+dt_from = datetime.datetime(2022, 1, 1)
+dt_upto = datetime.datetime(2022, 3, 31, 23, 59)
+
+
+def random_documents(count, seed):
+    # даты с секундами и миллисекундами, в том числе внутри последней минуты часа
+    rnd = random.Random(seed)
+    documents = []
+    for _ in range(count):
+        dt = dt_from + datetime.timedelta(minutes=rnd.randint(0, 60 * 24 * 89), seconds=rnd.randint(0, 59))
+        if rnd.random() < 0.3:
+            dt = dt.replace(minute=59, second=rnd.randint(0, 59), microsecond=rnd.randint(0, 999) * 1000)
+        documents.append({"dt": dt, "value": rnd.randint(10, 10000)})
+    return documents
+
+
+@pytest.mark.asyncio()
+async def test_async_bucket_of_matches_pipeline(standin):
+    # ключ интервала на стороне приложения совпадает с группировкой bucket_pipeline
+    documents = random_documents(3000, seed=0)
+    standin(documents)
+    for group_type in ('month', 'day', 'hour'):
+        for start in (dt_from, dt_from.replace(second=30, microsecond=250500)):
+            intervals = await compile_intervals(start, dt_upto, group_type)
+            offset = intervals[0][0] - intervals[0][0].replace(second=0, microsecond=0)
+            totals = {}
+            for document in documents:
+                key = bucket_of(document['dt'], group_type, offset)
+                totals[key] = totals.get(key, 0) + document['value']
+            expected = [totals.get(interval[0], 0) for interval in intervals]
+            assert await aggregate_by_buckets(intervals, group_type) == expected
+
+
+@pytest.mark.asyncio()
+async def test_async_poll_updates_caches(standin, monkeypatch):
+    # новые документы, в том числе задним числом, учитываются в кэше без пересчета истории
+    collection = standin(generate_salaries(dt_from, dt_upto, 3000), bucket_entries=10000, ttl=3600)
+    monkeypatch.setattr(live, '_last_id', None)
+    assert await live.poll_once() == 0
+    for group_type in ('month', 'day', 'hour'):
+        await cached_aggregate_json(dt_from, datetime.datetime(2022, 1, 3), group_type)
+    await collection.insert_many(random_documents(50, seed=1) +
+                                 [{"dt": datetime.datetime(2022, 1, 1, 5, 0), "value": 777}])
+    assert await live.poll_once() == 51
+    round_trips = collection.round_trips
+    for group_type in ('month', 'day', 'hour'):
+        cached = loads(await cached_aggregate_json(dt_from, datetime.datetime(2022, 1, 3), group_type))
+        intervals = await compile_intervals(dt_from, datetime.datetime(2022, 1, 3), group_type)
+        assert cached['dataset'] == await aggregate_by_buckets(intervals, group_type)
+    # суммы затронутых интервалов запрошены одним запросом на тип периода (еще по одному - проверка)
+    assert collection.round_trips == round_trips + 6
+
+
+@pytest.mark.asyncio()
+async def test_async_poll_race(standin, monkeypatch):
+    # сумма, вычисленная между вставкой документа и получением изменения, уже учитывает документ,
+    # а сумма, вычисление которой началось до вставки, не сохраняется в кэше после получения изменения
+    collection = standin(generate_salaries(dt_from, dt_upto, 3000), bucket_entries=10000, ttl=3600)
+    monkeypatch.setattr(live, '_last_id', None)
+    await live.poll_once()
+    period = (dt_from, datetime.datetime(2022, 1, 3), 'day')
+    intervals = await compile_intervals(*period)
+    await collection.insert_many([{"dt": datetime.datetime(2022, 1, 2, 5, 0), "value": 777}])
+    await cached_aggregate_json(*period)
+    await live.poll_once()
+    assert loads(await cached_aggregate_json(*period))['dataset'] == await aggregate_by_buckets(intervals, 'day')
+
+    generation = cache.bucket_cache.generation
+    stale = await aggregate_by_buckets(intervals, 'day')
+    await collection.insert_many([{"dt": datetime.datetime(2022, 1, 2, 6, 0), "value": 555}])
+    await live.poll_once()
+    cache.bucket_cache.store('day', intervals, stale, generation=generation)
+    assert loads(await cached_aggregate_json(*period))['dataset'] == await aggregate_by_buckets(intervals, 'day')
+
+
+@pytest.mark.asyncio()
+async def test_async_prefix_index_apply_inserts(standin, monkeypatch):
+    # документ задним числом учитывается в индексе один раз, даже если индекс построен после его вставки
+    collection = standin(generate_salaries(dt_from, dt_upto, 3000), round_trip=0)
+    monkeypatch.setattr(prefix_index, '_index', None)
+    monkeypatch.setattr(prefix_index, '_pending', None)
+    index = await prefix_index.get_index()
+    documents = random_documents(100, seed=3)
+    await collection.insert_many(documents)
+    await prefix_index.apply_inserts(documents)
+    await prefix_index.apply_inserts(documents)
+    intervals = await compile_intervals(dt_from, datetime.datetime(2022, 3, 1), 'day')
+    assert index.aggregate(intervals) == await aggregate_by_buckets(intervals, 'day')
+
+
+@pytest.mark.asyncio()
+async def test_async_rollup_apply_inserts(standin):
+    # часы документов задним числом пересчитываются в витрине
+    collection = standin(generate_salaries(dt_from, dt_upto, 3000))
+    await rollup.refresh_rollup(rebuild=True)
+    documents = random_documents(100, seed=2)
+    await collection.insert_many(documents)
+    assert await rollup.apply_inserts(documents) > 0
+    # повторное получение тех же изменений не меняет витрину
+    await rollup.apply_inserts(documents)
+    for group_type in ('month', 'day', 'hour'):
+        intervals = await compile_intervals(dt_from, datetime.datetime(2022, 1, 10), group_type)
+        assert await rollup.aggregate_from_rollup(intervals, group_type) == \
+            await aggregate_by_buckets(intervals, group_type)
+
+
+@pytest.mark.asyncio()
+async def test_async_unrelated_inserts_keep_caches(standin, monkeypatch):
+    # документы вне периодов кэша не удаляют записи и не отменяют сохранение вычисляемых результатов,
+    # документ в вычисляемом периоде - отменяет
+    collection = standin(generate_salaries(dt_from, dt_upto, 3000), round_trip=0.01)
+    period = (dt_from, datetime.datetime(2022, 1, 3), 'day')
+    await cached_aggregate_json(*period)
+    outside = [{"dt": datetime.datetime(2022, 3, 1, 5, 0), "value": 1}]
+    # периоды двух запросов лежат по обе стороны от документа
+    later = (datetime.datetime(2022, 3, 20), datetime.datetime(2022, 3, 25), 'day')
+    pending = asyncio.ensure_future(cached_aggregate_json(*later))
+    # запрос к базе данных уже выполняется
+    await asyncio.sleep(0.005)
+    await collection.insert_many(outside)
+    cache.apply_inserts(outside)
+    await pending
+    assert cache.response_cache.stats()["entries"] == 2 and cache.bucket_cache.stats()["entries"] == 3 + 6
+    round_trips = collection.round_trips
+    await cached_aggregate_json(*period)
+    await cached_aggregate_json(*later)
+    assert collection.round_trips == round_trips
+
+    inside = [{"dt": datetime.datetime(2022, 2, 10, 5, 0), "value": 1}]
+    february = (datetime.datetime(2022, 2, 1), datetime.datetime(2022, 2, 20), 'day')
+    pending = asyncio.ensure_future(cached_aggregate_json(*february))
+    await asyncio.sleep(0.005)
+    await collection.insert_many(inside)
+    cache.apply_inserts(inside)
+    await pending
+    assert cache.response_cache.stats()["entries"] == 2 and cache.bucket_cache.stats()["entries"] == 3 + 6
@@ -0,0 +1,83 @@
+import datetime
+import random
+import pytest
+
+from utils import mongodb
+from utils.metrics import parse_metrics, QuantileSketch, BucketStats
+from utils.mongodb import compile_intervals, aggregate_metrics, aggregate_intervals
+from benchmarks.generator import generate_salaries
+
+dt_from = datetime.datetime(2022, 9, 1)
+dt_upto = datetime.datetime(2022, 9, 30, 23, 59)
+
+
+def exact_quantile(values, rank):
+    return sorted(values)[int(rank * (len(values) - 1))]
+
+
+def test_parse_metrics():
+    assert parse_metrics("count, avg,p90,count") == ("count", "avg", "p90")
+    assert parse_metrics(["min", "max", "p99.9"]) == ("min", "max", "p99.9")
+    for metrics in ("sum", "p101", "pxx", "", 5):
+        with pytest.raises(ValueError):
+            parse_metrics(metrics)
+
+
+def test_sketch_merge():
+    # процентили эскиза отличаются от точных не более чем на заданную относительную ошибку,
+    # объединенные эскизы частей равны эскизу всех значений
+    generator = random.Random(0)
+    values = [generator.lognormvariate(10, 1) for _ in range(10000)]
+    whole, first, second = QuantileSketch(0.01), QuantileSketch(0.01), QuantileSketch(0.01)
+    for value in values:
+        whole.add(value)
+    for value in values[:3000]:
+        first.add(value)
+    for value in values[3000:]:
+        second.add(value)
+    merged = first.merge(second)
+    assert merged.bins == whole.bins and merged.count == whole.count
+    for rank in (0, 0.5, 0.9, 0.99, 1):
+        exact = exact_quantile(values, rank)
+        assert abs(whole.quantile(rank) - exact) <= 0.01 * exact
+    assert QuantileSketch().quantile(0.5) is None
+
+
+@pytest.mark.asyncio()
+async def test_async_aggregate_metrics(standin):
+    # статистики вычисляются одним запросом, суммы совпадают с ответом без статистик
+    documents = generate_salaries(dt_from, dt_upto, 3000)
+    collection = standin(documents)
+    intervals = await compile_intervals(dt_from, dt_upto, 'day')
+    metrics = parse_metrics("count,avg,min,max,p50,p90")
+    dataset, values = await aggregate_metrics(intervals, 'day', metrics)
+    assert collection.round_trips == 1
+    assert dataset == await aggregate_intervals(intervals, 'day', engine='bucket', use_rollup=False)
+    for number, (start, end) in enumerate(intervals):
+        bucket = [document['value'] for document in documents if start <= document['dt'] <= end]
+        assert values['count'][number] == len(bucket)
+        assert values['min'][number] == min(bucket) and values['max'][number] == max(bucket)
+        assert values['avg'][number] == pytest.approx(sum(bucket) / len(bucket))
+        for metric, rank in (('p50', 0.5), ('p90', 0.9)):
+            exact = exact_quantile(bucket, rank)
+            assert abs(values[metric][number] - exact) <= 0.01 * exact
+
+
+def test_bucket_stats_empty():
+    stats = BucketStats()
+    assert [stats.value(metric) for metric in ("count", "avg", "min", "max", "p50")] == [0, None, None, None, None]
+
+
+def test_metrics_unsupported_engine(standin, monkeypatch):
+    # движки без MongoDB не вычисляют статистики: запрос отклоняется без обращения к базе данных
+    from fastapi.testclient import TestClient
+    import app
+    collection = standin(generate_salaries(dt_from, dt_upto, 100))
+    client = TestClient(app.app)
+    params = {"dt_from": "2022-09-01T00:00:00", "dt_upto": "2022-09-30T23:59:00", "group_type": "day",
+              "metrics": "count"}
+    for engine in ('numpy', 'dump'):
+        monkeypatch.setattr(mongodb, 'AGGREGATION_ENGINE', engine)
+        response = client.get('/aggregated_data/', params=params)
+        assert response.status_code == 422 and engine in response.json()["detail"]
+    assert collection.round_trips == 0
@@ -2,7 +2,12 @@ import datetime
 import pytest
 import asyncio
 
-from utils.mongodb import do_aggregate, compile_intervals
+from benchmarks.generator import generate_salaries
+from benchmarks.standin import InProcessCollection
+from utils import mongodb
+from utils.mongodb import (do_aggregate, compile_intervals, ensure_indexes, plan_stages,
+                           bucket_pipeline, salaries, iter_intervals, iter_aggregate,
+                           aggregate_by_intervals)
 
 test_input_data_month = {
     "dt_from": "2022-09-01T00:00:00",
@@ -107,3 +112,85 @@ async def test_async_do_aggregate():
     assert dataset == test_output_data_month['dataset']
     assert labels == test_output_data_month['labels']
 
+
+
+async def test_async_do_aggregate_engines():
+    # оба движка агрегации должны возвращать одинаковые данные
+    for input_data, output_data in ((test_input_data_month, test_output_data_month),
+                                    (test_input_data_day, test_output_data_day),
+                                    (test_input_data_hour, test_output_data_hour)):
+        dt_from = datetime.datetime.fromisoformat(input_data['dt_from'])
+        dt_upto = datetime.datetime.fromisoformat(input_data['dt_upto'])
+        for engine in ('interval', 'bucket'):
+            dataset, labels = await do_aggregate(dt_from, dt_upto, input_data['group_type'], engine=engine)
+            assert dataset == output_data['dataset']
+            assert labels == output_data['labels']
+
+
+def test_plan_stages():
+    explain = {"stages": [{"$cursor": {"queryPlanner": {
+        "winningPlan": {"stage": "PROJECTION_COVERED", "inputStage": {"stage": "IXSCAN"}},
+        "rejectedPlans": [{"stage": "COLLSCAN"}]}}}]}
+    assert plan_stages(explain) == {"PROJECTION_COVERED", "IXSCAN"}
+
+
+async def test_async_ensure_indexes():
+    # после создания индексов запрос по периоду выполняется по индексу и покрывается им
+    await ensure_indexes()
+    assert await ensure_indexes() == []
+    dt_from = datetime.datetime.fromisoformat(test_input_data_month['dt_from'])
+    dt_upto = datetime.datetime.fromisoformat(test_input_data_month['dt_upto'])
+    intervals = await compile_intervals(dt_from, dt_upto, 'month')
+    pipeline, offset = bucket_pipeline(intervals, 'month')
+    explain = await salaries.database.command(
+        "explain", {"aggregate": salaries.name, "pipeline": pipeline, "cursor": {}})
+    stages = plan_stages(explain)
+    assert 'IXSCAN' in stages
+    assert 'COLLSCAN' not in stages and 'FETCH' not in stages
+
+
+async def test_async_iter_aggregate():
+    # генератор выдает интервалы порциями и в том же порядке, что compile_intervals
+    dt_from = datetime.datetime.fromisoformat(test_input_data_hour['dt_from'])
+    dt_upto = datetime.datetime.fromisoformat(test_input_data_hour['dt_upto'])
+    intervals = await compile_intervals(dt_from, dt_upto, 'hour')
+    assert list(iter_intervals(dt_from, dt_upto, 'hour')) == intervals
+    chunks = []
+
+    async def aggregate(chunk, group_type):
+        chunks.append(len(chunk))
+        return [interval[0].hour for interval in chunk]
+
+    result = [item async for item in iter_aggregate(dt_from, dt_upto, 'hour', chunk_size=3, aggregate=aggregate)]
+    assert result == list(zip(test_output_data_hour['labels'], [0, 1, 2, 3]))
+    assert chunks == [3, 1]
+
+
+async def test_async_aggregate_by_intervals_concurrency(monkeypatch):
+    # одновременных запросов не больше заданного, порядок интервалов сохраняется
+    dt_from = datetime.datetime.fromisoformat(test_input_data_day['dt_from'])
+    dt_upto = datetime.datetime.fromisoformat(test_input_data_day['dt_upto'])
+    collection = InProcessCollection(generate_salaries(dt_from, dt_upto, 1000), round_trip=0.001)
+    monkeypatch.setattr(mongodb, 'salaries', collection)
+    intervals = await compile_intervals(dt_from, dt_upto, 'hour')
+    sequential = await aggregate_by_intervals(intervals, concurrency=1)
+    assert collection.max_in_flight == 1
+    assert await aggregate_by_intervals(intervals, concurrency=8) == sequential
+    assert collection.max_in_flight == 8
+
+
+async def test_async_composite_group_types(monkeypatch):
+    # суммы за неделю, квартал и год равны суммам входящих в них дней и месяцев на всех движках
+    dt_from, dt_upto = datetime.datetime(2022, 1, 1), datetime.datetime(2022, 12, 31, 23, 59)
+    monkeypatch.setattr(mongodb, 'salaries', InProcessCollection(generate_salaries(dt_from, dt_upto, 5000)))
+    days, labels = await do_aggregate(dt_from, dt_upto, 'day', engine='interval', use_rollup=False)
+    months, labels = await do_aggregate(dt_from, dt_upto, 'month', engine='interval', use_rollup=False)
+    for engine in ('bucket', 'interval'):
+        dataset, labels = await do_aggregate(dt_from, dt_upto, 'quarter', engine=engine, use_rollup=False)
+        assert dataset == [sum(months[index:index + 3]) for index in range(0, 12, 3)]
+        dataset, labels = await do_aggregate(dt_from, dt_upto, 'year', engine=engine, use_rollup=False)
+        assert dataset == [sum(months)] and labels == ["2022-01-01T00:00:00"]
+        dataset, labels = await do_aggregate(dt_from, dt_upto, 'week', engine=engine, use_rollup=False)
+        # 2022-01-01 - суббота, первая неделя начинается 2021-12-27
+        assert labels[0] == "2021-12-27T00:00:00" and dataset[0] == sum(days[:2])
+        assert sum(dataset) == sum(days)
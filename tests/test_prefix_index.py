@@ -0,0 +1,87 @@
+import asyncio
+import datetime
+import random
+import pytest
+
+from benchmarks.generator import generate_salaries
+from benchmarks.standin import InProcessCollection
+from utils import mongodb, prefix_index
+from utils.mongodb import compile_intervals, aggregate_by_intervals, do_aggregate
+from utils.prefix_index import PrefixSumIndex, build_index, refresh_index, get_index
+from tests.test_mongodb import (test_input_data_month, test_output_data_month,
+                                test_input_data_day, test_output_data_day,
+                                test_input_data_hour, test_output_data_hour)
+
+dt_from = datetime.datetime(2022, 1, 1)
+dt_upto = datetime.datetime(2022, 4, 1)
+boundary_documents = [{"dt": dt, "value": 7} for dt in (datetime.datetime(2022, 2, 1, 0, 59),
+                                                        datetime.datetime(2022, 2, 1, 0, 59, 30),
+                                                        datetime.datetime(2022, 2, 1, 1, 0),
+                                                        datetime.datetime(2022, 2, 28, 23, 59, 59))]
+
+
+def random_windows(count, seed):
+    rnd = random.Random(seed)
+    for _ in range(count):
+        start = dt_from - datetime.timedelta(days=3) + datetime.timedelta(minutes=rnd.randint(0, 100 * 1440))
+        end = start + datetime.timedelta(minutes=rnd.randint(0, 40 * 1440))
+        yield start, end, rnd.choice(['month', 'day', 'hour'])
+
+
+@pytest.mark.asyncio()
+async def test_async_prefix_index_matches_intervals(monkeypatch):
+    # суммы по индексу совпадают с запросами по каждому интервалу на случайных периодах
+    documents = sorted(generate_salaries(dt_from, dt_upto, 5000) + boundary_documents,
+                       key=lambda document: document["dt"])
+    monkeypatch.setattr(mongodb, 'salaries', InProcessCollection(documents[:3000], round_trip=0))
+    index = await build_index()
+    await mongodb.salaries.insert_many(documents[3000:])
+    await refresh_index(index)
+    for start, end, group_type in random_windows(100, seed=1):
+        intervals = await compile_intervals(start, end, group_type)
+        assert index.aggregate(intervals) == await aggregate_by_intervals(intervals), (start, end, group_type)
+
+
+@pytest.mark.asyncio()
+async def test_async_prefix_index_add():
+    index = PrefixSumIndex(capacity=1)
+    index.add(datetime.datetime(2022, 2, 1, 1, 0), 8, 8)
+    # минуты до начала и внутри индекса добавляются без перестройки индекса
+    index.add(datetime.datetime(2022, 2, 1, 0, 0), 1, 1)
+    index.add(datetime.datetime(2022, 2, 1, 0, 59), 6, 2)
+    index.add(datetime.datetime(2022, 2, 1, 3, 59), 16)
+    intervals = await compile_intervals(datetime.datetime(2022, 2, 1, 0, 0),
+                                        datetime.datetime(2022, 2, 1, 3, 59), 'hour')
+    assert index.aggregate(intervals) == [3, 8, 0, 0]
+    assert index.nbytes >= (index.length * 2 + 1) * 8
+    # границы интервалов с секундами индекс не обрабатывает
+    intervals = await compile_intervals(datetime.datetime(2022, 2, 1, 0, 0, 30),
+                                        datetime.datetime(2022, 2, 1, 3, 59), 'hour')
+    assert index.aggregate(intervals) is None
+
+
+async def test_async_do_aggregate_prefix():
+    for input_data, output_data in ((test_input_data_month, test_output_data_month),
+                                    (test_input_data_day, test_output_data_day),
+                                    (test_input_data_hour, test_output_data_hour)):
+        dataset, labels = await do_aggregate(datetime.datetime.fromisoformat(input_data['dt_from']),
+                                             datetime.datetime.fromisoformat(input_data['dt_upto']),
+                                             input_data['group_type'], engine='prefix')
+        assert dataset == output_data['dataset']
+        assert labels == output_data['labels']
+
+
+@pytest.mark.asyncio()
+async def test_async_get_index_concurrent(monkeypatch):
+    # одновременные запросы после срока обновления дополняют индекс один раз
+    documents = sorted(generate_salaries(dt_from, dt_upto, 5000), key=lambda document: document["dt"])
+    monkeypatch.setattr(mongodb, 'salaries', InProcessCollection(documents[:3000], round_trip=0.01))
+    monkeypatch.setattr(prefix_index, '_index', None)
+    monkeypatch.setattr(prefix_index, '_pending', None)
+    monkeypatch.setattr(prefix_index, 'PREFIX_INDEX_REFRESH', 0)
+    indexes = await asyncio.gather(*[get_index() for _ in range(3)])
+    assert indexes[0] is indexes[1] is indexes[2]
+    await mongodb.salaries.insert_many(documents[3000:])
+    index = (await asyncio.gather(*[get_index() for _ in range(3)]))[0]
+    intervals = await compile_intervals(dt_from, dt_upto - datetime.timedelta(minutes=1), 'month')
+    assert index.aggregate(intervals) == await aggregate_by_intervals(intervals)
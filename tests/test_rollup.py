@@ -0,0 +1,34 @@
+import datetime
+import pytest
+
+from benchmarks.generator import generate_salaries
+from utils.mongodb import do_aggregate
+from utils.rollup import refresh_rollup, check_consistency, get_rollup, get_state, ROLLUP_COLLECTION
+from tests.test_mongodb import test_input_data_month, test_input_data_day
+
+# витрина строится в базе данных коллекции в памяти процесса (см. фикстуру standin),
+# а не в базе данных, заданной MONGODB_URI
+documents = generate_salaries(datetime.datetime(2022, 9, 1), datetime.datetime(2022, 12, 31, 23, 59), 5000)
+
+
+@pytest.mark.asyncio()
+async def test_async_refresh_rollup(standin):
+    # повторное обновление витрины не меняет отметку о прогрессе
+    collection = standin([dict(document) for document in documents])
+    high_water_mark = await refresh_rollup()
+    assert await refresh_rollup() == high_water_mark
+    assert await check_consistency(10, seed=0) == []
+    assert get_rollup().database is get_state().database is collection.database
+    assert ROLLUP_COLLECTION in collection.database.collections
+
+
+@pytest.mark.asyncio()
+async def test_async_do_aggregate_rollup(standin):
+    standin([dict(document) for document in documents])
+    await refresh_rollup()
+    assert get_rollup().documents
+    for input_data in (test_input_data_month, test_input_data_day):
+        dt_from = datetime.datetime.fromisoformat(input_data['dt_from'])
+        dt_upto = datetime.datetime.fromisoformat(input_data['dt_upto'])
+        expected = await do_aggregate(dt_from, dt_upto, input_data['group_type'], use_rollup=False)
+        assert await do_aggregate(dt_from, dt_upto, input_data['group_type'], use_rollup=True) == expected
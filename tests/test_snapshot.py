@@ -0,0 +1,59 @@
+import datetime
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+from utils import snapshot
+from utils.mongodb import compile_intervals, do_aggregate
+from utils.snapshot import Snapshot, write_snapshot, export_snapshot, to_epoch_ms
+from tests.test_mongodb import (test_input_data_month, test_output_data_month,
+                                test_input_data_day, test_output_data_day,
+                                test_input_data_hour, test_output_data_hour)
+
+documents = [
+    (datetime.datetime(2022, 2, 1, 0, 0), 1),
+    (datetime.datetime(2022, 2, 1, 0, 59), 2),
+    # внутри последней минуты часа: не входит ни в один интервал "час"
+    (datetime.datetime(2022, 2, 1, 0, 59, 30), 4),
+    (datetime.datetime(2022, 2, 1, 1, 0), 8),
+    (datetime.datetime(2022, 2, 1, 3, 59), 16),
+]
+
+
+@pytest.mark.asyncio()
+async def test_async_snapshot_aggregate(tmp_path):
+    write_snapshot(tmp_path, [to_epoch_ms(dt) for dt, value in reversed(documents)],
+                   [value for dt, value in reversed(documents)])
+    intervals = await compile_intervals(datetime.datetime(2022, 2, 1, 0, 0),
+                                        datetime.datetime(2022, 2, 1, 3, 59), 'hour')
+    assert Snapshot.load(tmp_path).aggregate(intervals) == [3, 8, 0, 16]
+    intervals = await compile_intervals(datetime.datetime(2022, 2, 1, 0, 0),
+                                        datetime.datetime(2022, 2, 1, 3, 59), 'day')
+    assert Snapshot.load(tmp_path).aggregate(intervals) == [31]
+
+
+@pytest.mark.asyncio()
+async def test_async_do_aggregate_numpy(tmp_path, monkeypatch):
+    # результаты по снимку совпадают с результатами запросов к базе данных
+    await export_snapshot(tmp_path)
+    monkeypatch.setattr(snapshot, '_snapshot', Snapshot.load(tmp_path))
+    for input_data, output_data in ((test_input_data_month, test_output_data_month),
+                                    (test_input_data_day, test_output_data_day),
+                                    (test_input_data_hour, test_output_data_hour)):
+        dt_from = datetime.datetime.fromisoformat(input_data['dt_from'])
+        dt_upto = datetime.datetime.fromisoformat(input_data['dt_upto'])
+        dataset, labels = await do_aggregate(dt_from, dt_upto, input_data['group_type'], engine='numpy')
+        assert dataset == output_data['dataset']
+        assert labels == output_data['labels']
+
+
+def test_empty_snapshot_path():
+    # пустое значение переменной (SNAPSHOT_PATH= в .env-example) - каталог по умолчанию
+    root = Path(__file__).resolve().parent.parent
+    code = "from utils import snapshot; print(snapshot.SNAPSHOT_PATH)"
+    output = subprocess.run([sys.executable, "-c", code], cwd=root, env={**os.environ, "SNAPSHOT_PATH": ""},
+                            check=True, capture_output=True, text=True).stdout
+    assert Path(output.strip()) == root / "snapshot"
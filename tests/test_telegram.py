@@ -3,6 +3,7 @@ import json
 
 import aiogram
 import pytest
+from aiogram import Bot
 
 from utils.telegram import *
 
@@ -48,3 +49,63 @@ async def test_async_get_input_vars():
     assert error == "Некорректная структура данных JSON"
     error = await get_input_vars(missed_arg)
     assert error == "Недостаточно данных для запроса"
+    *_, metrics = await get_input_vars(input_message[:-1] + ', "metrics": "count,avg,p90"}')
+    assert metrics == ("count", "avg", "p90")
+    error = await get_input_vars(input_message[:-1] + ', "metrics": "sum"}')
+    assert error == "Неподдерживаемые статистики: sum"
+
+
+@pytest.mark.asyncio()
+async def test_async_fetch_aggregated_data():
+    dt_from, dt_upto, group_type = await get_input_vars(input_message)
+    dataset, labels = await fetch_aggregated_data(dt_from, dt_upto, group_type)
+    assert dataset == [5906586, 5515874, 5889803, 6092634]
+    assert labels == ["2022-09-01T00:00:00", "2022-10-01T00:00:00", "2022-11-01T00:00:00", "2022-12-01T00:00:00"]
+
+
+class FakeMessage:
+    content_type = "text"
+
+    def __init__(self, text):
+        self.text = text
+        self.answers = []
+
+    async def answer(self, text):
+        self.answers.append(text)
+
+
+@pytest.mark.asyncio()
+async def test_async_metrics_error_api(standin, monkeypatch):
+    # ответ 422 от API сервиса приводит к тому же сообщению об ошибке, что и агрегация в процессе бота
+    from aiohttp import web
+    from aiohttp.test_utils import TestServer
+    from fastapi import HTTPException
+    import app
+    from utils import mongodb, telegram
+    standin([])
+    monkeypatch.setattr(mongodb, 'AGGREGATION_ENGINE', 'dump')
+    text = input_message[:-1] + ', "metrics": "count,avg"}'
+    in_process = FakeMessage(text)
+    await message_handler(in_process)
+
+    async def get_data(request):
+        query = request.query
+        try:
+            return await app.aggregated_response(datetime.datetime.fromisoformat(query['dt_from']),
+                                                 datetime.datetime.fromisoformat(query['dt_upto']),
+                                                 query['group_type'], query['metrics'])
+        except HTTPException as error:
+            return web.json_response({"detail": error.detail}, status=error.status_code)
+
+    api = web.Application()
+    api.router.add_get('/aggregated_data/', get_data)
+    server = TestServer(api)
+    await server.start_server()
+    try:
+        monkeypatch.setattr(telegram, 'BOT_API_URL', str(server.make_url('/')))
+        worker = FakeMessage(text)
+        await message_handler(worker)
+    finally:
+        await server.close()
+    assert worker.answers == in_process.answers
+    assert in_process.answers[0].startswith("Статистики не вычислены: ") and "dump" in in_process.answers[0]
@@ -0,0 +1,101 @@
+import datetime
+
+from fastapi.testclient import TestClient
+
+import app
+from utils import mongodb, tracing
+from utils.cache import cached_aggregate_json
+from utils.tracing import Registry, Trace, trace_request
+from benchmarks.generator import generate_salaries
+
+dt_from = datetime.datetime(2022, 9, 1)
+dt_upto = datetime.datetime(2022, 9, 30, 23, 59)
+
+
+def use_standin(standin, monkeypatch):
+    documents = generate_salaries(dt_from, dt_upto, 3000)
+    collection = standin(documents, bucket_entries=0)
+    registry = Registry()
+    monkeypatch.setattr(tracing, 'registry', registry)
+    monkeypatch.setattr(app, 'registry', registry)
+    return documents, collection
+
+
+async def test_async_trace_request(standin, monkeypatch):
+    # в трассировке учитываются этапы, запросы к базе данных, прочитанные документы и интервалы
+    documents, collection = use_standin(standin, monkeypatch)
+    with trace_request('GET', 'day') as trace:
+        await cached_aggregate_json(dt_from, dt_upto, 'day')
+    assert set(trace.stages) == {'compile', 'db', 'encode'}
+    assert trace.round_trips == collection.round_trips == 1
+    # документы внутри последней минуты дня не входят ни в один интервал
+    assert trace.documents == sum(mongodb.bucket_of(document["dt"], 'day') is not None for document in documents)
+    assert trace.buckets == 30
+    assert trace.duration >= sum(trace.stages.values())
+    # повторный запрос обслуживается кэшем ответов без обращения к базе данных
+    with trace_request('GET', 'day') as trace:
+        await cached_aggregate_json(dt_from, dt_upto, 'day')
+    assert trace.round_trips == 0 and 'db' not in trace.stages
+    assert tracing.registry.requests[(("entry", "GET"), ("group_type", "day"))].count == 2
+
+
+def test_registry_render():
+    registry = Registry()
+    trace = Trace('POST', 'month')
+    trace.stages = {'db': 0.02, 'encode': 0.001}
+    trace.round_trips, trace.documents, trace.buckets, trace.duration = 2, 500, 3, 0.03
+    registry.record(trace)
+    lines = registry.render().splitlines()
+    labels = 'entry="POST",group_type="month"'
+    assert "# TYPE salary_request_duration_seconds histogram" in lines
+    assert f'salary_request_duration_seconds_bucket{{{labels},le="0.025"}} 0' in lines
+    assert f'salary_request_duration_seconds_bucket{{{labels},le="0.05"}} 1' in lines
+    assert f'salary_request_duration_seconds_bucket{{{labels},le="+Inf"}} 1' in lines
+    assert f'salary_request_duration_seconds_count{{{labels}}} 1' in lines
+    assert 'salary_stage_duration_seconds_sum{entry="POST",stage="db"} 0.02' in lines
+    assert f'salary_db_queries_total{{{labels}}} 2' in lines
+    assert f'salary_db_documents_total{{{labels}}} 500' in lines
+    assert trace.server_timing() == 'db;dur=20.00, encode;dur=1.00, queries;desc="2 queries, 500 documents", total;dur=30.00'
+
+
+def test_server_timing_and_metrics_endpoint(standin, monkeypatch):
+    use_standin(standin, monkeypatch)
+    monkeypatch.setattr(app, 'SERVER_TIMING', True)
+    client = TestClient(app.app)
+    params = {"dt_from": "2022-09-01T00:00:00", "dt_upto": "2022-09-30T23:59:00", "group_type": "day"}
+    response = client.get('/aggregated_data/', params=params)
+    assert response.status_code == 200
+    timing = response.headers['Server-Timing']
+    assert 'db;dur=' in timing and 'total;dur=' in timing
+    metrics = client.get('/metrics').text
+    assert 'salary_request_duration_seconds_count{entry="GET",group_type="day"} 1' in metrics
+    assert 'salary_buckets_total{entry="GET",group_type="day"} 30' in metrics
+
+
+def test_unknown_group_type_label(standin, monkeypatch):
+    # неизвестный тип периода не создает новых рядов метрик
+    use_standin(standin, monkeypatch)
+    with trace_request('GET', 'zzz') as trace:
+        pass
+    assert trace.group_type == 'other'
+    metrics = tracing.registry.render()
+    assert 'zzz' not in metrics
+    assert 'salary_request_duration_seconds_count{entry="GET",group_type="other"} 1' in metrics
+
+
+async def test_async_trace_bot_request(standin, monkeypatch):
+    # запрос пользователя Телеграм-бота учитывается в метриках с точкой входа bot
+    from utils.telegram import message_handler
+    use_standin(standin, monkeypatch)
+    answers = []
+
+    class Message:
+        content_type = "text"
+        text = '{"dt_from": "2022-09-01T00:00:00", "dt_upto": "2022-09-30T23:59:00", "group_type": "day"}'
+
+        async def answer(self, text):
+            answers.append(text)
+
+    await message_handler(Message())
+    assert answers[0].startswith("{'dataset': [")
+    assert 'salary_request_duration_seconds_count{entry="bot",group_type="day"} 1' in tracing.registry.render()
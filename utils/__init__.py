@@ -0,0 +1,7 @@
+from pathlib import Path
+
+from dotenv import load_dotenv
+
+# настройки модулей пакета читаются из переменных окружения при импорте модулей,
+# поэтому файл .env загружается до импорта любого из них (в том числе при запуске python -m utils.<модуль>)
+load_dotenv(Path(__file__).resolve().parent.parent / ".env")
@@ -0,0 +1,139 @@
+import asyncio
+import datetime
+import logging
+import os
+
+from utils import mongodb, tracing
+from utils.intervals import GROUP_TYPES, MINUTE, expand_intervals, merge_dataset, format_labels
+from utils.mongodb import compile_intervals, aggregate_intervals, bucket_pipeline, fill_buckets, supports_date_trunc
+
+# максимальное количество запросов в одном пакете
+BATCH_MAX_SPECS = int(os.getenv("BATCH_MAX_SPECS", 100))
+
+logger = logging.getLogger(__name__)
+
+
+def parse_spec(spec):
+    '''
+    Проверяет и разбирает один запрос пакета
+    :param spec: словарь {"dt_from": ..., "dt_upto": ..., "group_type": ...}
+    :return: dt_from, dt_upto, group_type, при некорректном запросе - исключение ValueError
+    '''
+    if not isinstance(spec, dict) or not (spec.get('dt_from') and spec.get('dt_upto') and spec.get('group_type')):
+        raise ValueError("Not enough data for request")
+    dt_from = datetime.datetime.fromisoformat(spec['dt_from'])
+    dt_upto = datetime.datetime.fromisoformat(spec['dt_upto'])
+    group_type = spec['group_type']
+    if dt_from > dt_upto:
+        raise ValueError(f"Invalid dates of period: {dt_from} > {dt_upto}")
+    if group_type not in GROUP_TYPES:
+        raise ValueError(f"Invalid type of interval: '{group_type}'")
+    return dt_from, dt_upto, group_type
+
+
+def plan_batch(requests):
+    '''
+    Объединяет запросы пакета: запросы одного типа периода с одинаковой сеткой интервалов
+    (одинаковые, вложенные, пересекающиеся или смежные) покрываются одним общим периодом.
+    Запросы с разным смещением UTC (в том числе с датами без смещения) не объединяются
+    :param requests: список (номер запроса, интервалы, тип периода)
+    :return: список групп (тип периода, интервалы общего периода, [(номер запроса, интервалы запроса)])
+    '''
+    grids = {}
+    for number, intervals, group_type in requests:
+        first_start = intervals[0][0]
+        offset = first_start - first_start.replace(second=0, microsecond=0)
+        # даты со смещением UTC и без него не сравниваются, интервалы по разному местному времени не совпадают
+        grids.setdefault((group_type, offset, first_start.utcoffset()), []).append((number, intervals))
+    groups = []
+    for (group_type, *_), members in grids.items():
+        members.sort(key=lambda member: member[1][0][0])
+        current = None
+        for number, intervals in members:
+            if current and intervals[0][0] <= current['end'] + MINUTE:
+                current['members'].append((number, intervals))
+                current['end'] = max(current['end'], intervals[-1][1])
+                current['last_start'] = max(current['last_start'], intervals[-1][0])
+            else:
+                current = {'start': intervals[0][0], 'last_start': intervals[-1][0], 'end': intervals[-1][1],
+                           'members': [(number, intervals)]}
+                groups.append((group_type, current))
+    return [(group_type, group['start'], group['last_start'], group['members']) for group_type, group in groups]
+
+
+async def aggregate_facet(groups):
+    '''
+    Суммирует интервалы всех групп одним запросом к базе данных: выборка документов
+    по объединению периодов групп и отдельная ветвь $facet для каждой группы.
+    Составные типы периода (неделя, квартал, год) суммируются по интервалам базового типа
+    :param groups: список (тип периода, интервалы общего периода)
+    :return: список сумм зарплат по интервалам для каждой группы
+    '''
+    date_trunc = await supports_date_trunc()
+    facets, bases = {}, []
+    for number, (group_type, intervals) in enumerate(groups):
+        base_intervals, base_type = expand_intervals(intervals, group_type)
+        pipeline, offset = bucket_pipeline(base_intervals, base_type, date_trunc)
+        facets[str(number)] = pipeline
+        bases.append((base_intervals, offset))
+    windows = [facet[0]["$match"] for facet in facets.values()]
+    with tracing.stage('db'):
+        cursor = mongodb.salaries.aggregate([{"$match": {"$or": windows}}, {"$facet": facets}])
+        result = (await cursor.to_list())[0]
+    tracing.record_query(sum(document["count"] for documents in result.values() for document in documents))
+    return [merge_dataset(fill_buckets(base_intervals, offset, result[str(number)]), group_type)
+            for number, ((group_type, intervals), (base_intervals, offset)) in enumerate(zip(groups, bases))]
+
+
+async def aggregate_batch(specs):
+    '''
+    Функция выполняет пакет запросов агрегации. Запросы объединяются (см. plan_batch),
+    при движке "bucket" все группы с датами без смещения UTC вычисляются одним запросом к базе данных,
+    при ошибке этого запроса - отдельным запросом на каждую группу.
+    Ошибка в одном запросе или группе не влияет на остальные
+    :param specs: список запросов {"dt_from": ..., "dt_upto": ..., "group_type": ...}
+    :return: список результатов в порядке запросов: {"dataset": ..., "labels": ...} или {"error": ...}
+    '''
+    results = [None] * len(specs)
+    requests = []
+    for number, spec in enumerate(specs):
+        try:
+            dt_from, dt_upto, group_type = parse_spec(spec)
+            # интервалы у границы диапазона дат (9999 год) не строятся
+            intervals = await compile_intervals(dt_from, dt_upto, group_type)
+        except (ValueError, TypeError, OverflowError) as error:
+            results[number] = {"error": str(error)}
+            continue
+        requests.append((number, intervals, group_type))
+        tracing.record_buckets(len(intervals))
+    planned = plan_batch(requests)
+    groups = [(group_type, await compile_intervals(start, last_start, group_type))
+              for group_type, start, last_start, members in planned]
+    datasets = [None] * len(groups)
+    if mongodb.AGGREGATION_ENGINE == 'bucket' and not mongodb.USE_ROLLUP:
+        # границы интервалов со смещением UTC не совпадают с усечением дат в запросе $facet
+        facet = [number for number, (group_type, intervals) in enumerate(groups) if intervals[0][0].tzinfo is None]
+        if facet:
+            try:
+                for number, dataset in zip(facet, await aggregate_facet([groups[number] for number in facet])):
+                    datasets[number] = dataset
+            except Exception:
+                logger.exception("Ошибка общего запроса пакета, группы вычисляются по отдельности")
+    pending = [number for number, dataset in enumerate(datasets) if dataset is None]
+    computed = await asyncio.gather(*[aggregate_intervals(groups[number][1], groups[number][0]) for number in pending],
+                                    return_exceptions=True)
+    for number, dataset in zip(pending, computed):
+        datasets[number] = dataset
+    for (group_type, group_intervals), dataset, (*_, members) in zip(groups, datasets, planned):
+        if isinstance(dataset, BaseException):
+            for number, intervals in members:
+                results[number] = {"error": str(dataset)}
+            continue
+        positions = {interval[0]: position for position, interval in enumerate(group_intervals)}
+        for number, intervals in members:
+            first = positions[intervals[0][0]]
+            results[number] = {
+                "dataset": dataset[first:first + len(intervals)],
+                "labels": format_labels(intervals),
+            }
+    return results
@@ -0,0 +1,425 @@
+import asyncio
+import bisect
+import datetime
+import os
+import sys
+import time
+from collections import OrderedDict
+
+from utils import tracing
+from utils.encoding import encode_aggregated
+from utils.intervals import (expand_intervals, merge_dataset, format_labels, intervals_end, to_utc, to_naive_utc,
+                             start_of_first_interval, interval_count)
+from utils.mongodb import aggregate_intervals, aggregate_metrics, compile_intervals, bucket_of
+
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", 1024))
+CACHE_MAX_BYTES = int(os.getenv("CACHE_MAX_BYTES", 64 * 1024 * 1024))
+# время жизни записи в секундах, 0 - кэширование выключено
+CACHE_TTL = float(os.getenv("CACHE_TTL", 60))
+# кэш сумм по интервалам: количество записей (0 - выключен) и время жизни (в секундах)
+# записи незавершенного интервала, завершенные интервалы хранятся бессрочно
+BUCKET_CACHE_MAX_ENTRIES = int(os.getenv("BUCKET_CACHE_MAX_ENTRIES", 500000))
+BUCKET_CACHE_OPEN_TTL = float(os.getenv("BUCKET_CACHE_OPEN_TTL", 5))
+
+MINUTE = datetime.timedelta(minutes=1)
+
+
+def utc_now():
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+
+def is_closed(interval, now=None):
+    '''
+    Интервал завершен, если его последняя минута уже прошла:
+    новые документы в него больше не поступают (дата со смещением UTC сравнивается в UTC)
+    '''
+    return to_naive_utc(interval[1]) + MINUTE <= (now or utc_now())
+
+
+def estimate_size(value):
+    '''
+    Приблизительный размер результата агрегации в памяти (в байтах)
+    :param value: результат (dataset, labels), (dataset, labels, статистики) или ответ в байтах JSON
+    :return: int
+    '''
+    size = sys.getsizeof(value)
+    if isinstance(value, bytes):
+        return size
+    for items in value:
+        if isinstance(items, dict):
+            size += estimate_size(items.values())
+        else:
+            size += sys.getsizeof(items) + sum(sys.getsizeof(item) for item in items)
+    return size
+
+
+class ResponseCache:
+    '''
+    Кэш результатов агрегации в памяти процесса с вытеснением давно не использованных
+    записей (LRU) при превышении количества записей или их суммарного размера
+    и временем жизни записи (TTL).
+    Одновременные запросы с одинаковым ключом объединяются: вычисление выполняется
+    один раз, остальные запросы ожидают его результат
+    '''
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES, max_bytes=CACHE_MAX_BYTES, ttl=CACHE_TTL):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._in_flight = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def stats(self):
+        return {"entries": len(self._entries), "bytes": self.size, "hits": self.hits,
+                "misses": self.misses, "coalesced": self.coalesced,
+                "evictions": self.evictions, "expirations": self.expirations,
+                "invalidations": self.invalidations}
+
+    def clear(self):
+        self._entries.clear()
+        self.size = 0
+
+    def _remove(self, key):
+        value, size, expires = self._entries.pop(key)
+        self.size -= size
+
+    def _store(self, key, value, ttl):
+        size = estimate_size(value)
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (value, size, time.monotonic() + ttl)
+        self.size += size
+        while len(self._entries) > self.max_entries or self.size > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[2] <= time.monotonic():
+            self._remove(key)
+            self.expirations += 1
+            return None
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def invalidate(self, predicate):
+        '''
+        Удаляет записи, ключи которых удовлетворяют условию. Результаты вычислений
+        с такими ключами, начатых до инвалидации, в кэш не сохраняются (они могли не учесть новые документы),
+        вычисления с другими ключами не затрагиваются
+        :param predicate: функция от ключа записи
+        :return: количество удаленных записей
+        '''
+        keys = [key for key in self._entries if predicate(key)]
+        for key in keys:
+            self._remove(key)
+        # следующие запросы не присоединяются к вычислениям, начатым до инвалидации
+        for key in [key for key in self._in_flight if predicate(key)]:
+            del self._in_flight[key]
+        self.invalidations += len(keys)
+        return len(keys)
+
+    def _finish(self, key, task, ttl):
+        if self._in_flight.get(key) is not task:
+            # вычисление исключено из ожидаемых при инвалидации
+            return
+        del self._in_flight[key]
+        if task.cancelled():
+            return
+        if task.exception() is None:
+            self._store(key, task.result(), ttl)
+
+    async def get_or_compute(self, key, compute, ttl=None):
+        '''
+        Возвращает результат из кэша или вычисляет его функцией compute
+        :param key: ключ записи
+        :param compute: функция без аргументов, возвращающая корутину
+        :param ttl: время жизни записи, если оно должно быть меньше заданного для кэша
+        :return: результат вычисления
+        '''
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0:
+            return await compute()
+        value = self.get(key)
+        if value is not None:
+            self.hits += 1
+            return value
+        task = self._in_flight.get(key)
+        if task is None:
+            self.misses += 1
+            task = asyncio.ensure_future(compute())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda done: self._finish(key, done, ttl))
+        else:
+            self.coalesced += 1
+        # отмена одного из ожидающих запросов не прерывает общее вычисление
+        return await asyncio.shield(task)
+
+
+class BucketCache:
+    '''
+    Кэш сумм по отдельным интервалам с ключом (тип периода, начало интервала).
+    Суммы завершенных интервалов хранятся бессрочно (до вытеснения при превышении
+    количества записей), сумма незавершенного интервала - open_ttl секунд
+    '''
+    def __init__(self, max_entries=BUCKET_CACHE_MAX_ENTRIES, open_ttl=BUCKET_CACHE_OPEN_TTL):
+        self.max_entries = max_entries
+        self.open_ttl = open_ttl
+        self._entries = OrderedDict()
+        # сетки интервалов в кэше: (тип периода, сдвиг границ интервалов)
+        self._grids = set()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        # номер поколения: увеличивается, когда новые документы попадают в интервалы кэша
+        # или вычисляемые интервалы, суммы, вычисленные в прежнем поколении, в кэш не сохраняются
+        self.generation = 0
+        # вычисляемые диапазоны: (тип периода, сдвиг границ интервалов, начало первого и последнего интервала)
+        self._computing = []
+
+    def stats(self):
+        return {"entries": len(self._entries), "hits": self.hits,
+                "misses": self.misses, "evictions": self.evictions, "invalidations": self.invalidations}
+
+    def clear(self):
+        self._entries.clear()
+        self._grids.clear()
+
+    def lookup(self, group_type, intervals):
+        '''
+        Возвращает суммы интервалов из кэша, None - для отсутствующих в кэше интервалов
+        '''
+        dataset = []
+        now = time.monotonic()
+        for interval in intervals:
+            key = (group_type, interval[0])
+            entry = self._entries.get(key)
+            if entry is not None and (entry[1] is None or entry[1] > now):
+                self._entries.move_to_end(key)
+                dataset.append(entry[0])
+                self.hits += 1
+            else:
+                dataset.append(None)
+                self.misses += 1
+        return dataset
+
+    def store(self, group_type, intervals, dataset, now=None, generation=None):
+        '''
+        Сохраняет суммы интервалов. Суммы, вычисленные в прежнем поколении (generation -
+        номер поколения на момент начала вычисления), не сохраняются
+        '''
+        if generation is not None and generation != self.generation:
+            return
+        now = now or utc_now()
+        expires = time.monotonic() + self.open_ttl
+        for interval, total in zip(intervals, dataset):
+            key = (group_type, interval[0])
+            self._entries[key] = (total, None if is_closed(interval, now) else expires)
+            self._entries.move_to_end(key)
+        if intervals:
+            start = intervals[0][0]
+            self._grids.add((group_type, start - start.replace(second=0, microsecond=0)))
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def begin(self, group_type, intervals):
+        '''
+        Регистрирует вычисление сумм интервалов: новые документы в этих интервалах
+        до окончания вычисления (end) делают его результат устаревшим (см. invalidate_documents)
+        :return: отметка вычисления для end
+        '''
+        start = intervals[0][0]
+        computing = (group_type, start - start.replace(second=0, microsecond=0), start, intervals[-1][0])
+        self._computing.append(computing)
+        return computing
+
+    def end(self, computing):
+        self._computing.remove(computing)
+
+    def invalidate_documents(self, dates):
+        '''
+        Удаляет суммы интервалов, в которые входят новые документы (правило вхождения -
+        как в bucket_pipeline, см. bucket_of). Суммы не дополняются на месте: сумма,
+        вычисленная между вставкой документа и получением изменения, уже учитывает документ.
+        Поколение увеличивается, только если документ попал в интервал кэша или вычисляемый интервал:
+        документы вне кэша не мешают сохранению сумм других интервалов
+        :param dates: даты новых документов
+        :return: количество удаленных сумм
+        '''
+        invalidations, stale = self.invalidations, False
+        for dt in dates:
+            for group_type, offset in self._grids:
+                if self._entries.pop((group_type, bucket_of(dt, group_type, offset)), None) is not None:
+                    self.invalidations += 1
+            for group_type, offset, first, last in self._computing:
+                key = bucket_of(dt, group_type, offset)
+                stale = stale or (key is not None and first <= key <= last)
+        if stale or self.invalidations > invalidations:
+            self.generation += 1
+        return self.invalidations - invalidations
+
+
+response_cache = ResponseCache()
+bucket_cache = BucketCache()
+
+
+def request_key(intervals, group_type):
+    '''
+    Нормализованный ключ запроса: запросы, которые приводят к одинаковым интервалам
+    агрегации, получают одинаковый ключ
+    :return: (тип периода, начало первого интервала, количество интервалов, смещение UTC):
+    одинаковые моменты с разным смещением UTC дают разные метки интервалов
+    '''
+    return group_type, intervals[0][0], len(intervals), intervals[0][0].utcoffset()
+
+
+def period_key(dt_from, dt_upto, group_type):
+    '''
+    Ключ запроса, равный request_key, вычисленный по входным данным без формирования интервалов:
+    при попадании в кэш результатов список интервалов длинного периода не создается
+    '''
+    start = start_of_first_interval(dt_from, group_type)
+    return group_type, start, interval_count(dt_from, dt_upto, group_type), start.utcoffset()
+
+
+def covers(key, dates):
+    '''
+    Попадает ли хотя бы одна из дат в период записи кэша результатов (ключ из request_key)
+    :param dates: упорядоченный список дат
+    '''
+    group_type, start, count = key[:3]
+    end = to_naive_utc(intervals_end(start, count, group_type)) + MINUTE
+    index = bisect.bisect_left(dates, to_naive_utc(start))
+    return index < len(dates) and dates[index] < end
+
+
+def apply_inserts(documents):
+    '''
+    Учитывает новые документы коллекции salaries в кэшах: из кэша сумм удаляются суммы интервалов,
+    в которые попадают документы, из кэша результатов - записи с периодом, в который попадают документы.
+    При следующем запросе суммы этих интервалов запрашиваются из базы данных одним запросом,
+    остальные берутся из кэша. Результаты вычислений, начатых до получения изменений, в кэши
+    не сохраняются, поэтому документ не теряется и не учитывается дважды
+    :param documents: новые документы {"dt": ..., "value": ...}
+    '''
+    if not documents:
+        return
+    bucket_cache.invalidate_documents(document['dt'] for document in documents)
+    # запись удаляется, только если в ее период попал новый документ (а не любой документ между первым и последним)
+    dates = sorted(document['dt'] for document in documents)
+    response_cache.invalidate(lambda key: covers(key, dates))
+
+
+async def aggregate_with_bucket_cache(intervals, group_type, store=True):
+    '''
+    Функция берет из кэша суммы уже вычисленных интервалов, а недостающие интервалы
+    получает одним запросом к базе данных по непрерывному диапазону
+    от первого до последнего недостающего интервала.
+    Суммы составных типов периода (неделя, квартал, год) складываются из сумм
+    базового типа (дня или месяца), которые берутся из того же кэша
+    :param intervals: список интервалов из compile_intervals
+    :param group_type: тип периода агрегации
+    :param store: сохранять вычисленные суммы в кэше (потоковый ответ только читает кэш,
+    чтобы длинный период не вытеснял из него суммы других запросов)
+    :return: список сумм зарплат по интервалам
+    '''
+    base_intervals, base_type = expand_intervals(intervals, group_type)
+    if base_type != group_type:
+        return merge_dataset(await aggregate_with_bucket_cache(base_intervals, base_type, store), group_type)
+    if intervals and intervals[0][0].tzinfo is not None:
+        if intervals[0][0].utcoffset():
+            # суммы интервалов, сдвинутых относительно сетки UTC, в кэше сумм не хранятся
+            return await aggregate_intervals(intervals, group_type)
+        intervals = to_utc(intervals)
+    if bucket_cache.max_entries <= 0:
+        return await aggregate_intervals(intervals, group_type)
+    dataset = bucket_cache.lookup(group_type, intervals)
+    missing = [index for index, total in enumerate(dataset) if total is None]
+    if missing:
+        first, last = missing[0], missing[-1] + 1
+        generation = bucket_cache.generation
+        computing = bucket_cache.begin(group_type, intervals[first:last])
+        try:
+            totals = await aggregate_intervals(intervals[first:last], group_type)
+        finally:
+            bucket_cache.end(computing)
+        if store:
+            bucket_cache.store(group_type, intervals[first:last], totals, generation=generation)
+        dataset[first:last] = totals
+    return dataset
+
+
+async def cached_aggregate(dt_from, dt_upto, group_type):
+    '''
+    Функция возвращает результат агрегации из кэша результатов, при отсутствии
+    в кэше - вычисляет его (с использованием кэша сумм по интервалам) и сохраняет в кэш.
+    Результат с незавершенным интервалом хранится не дольше BUCKET_CACHE_OPEN_TTL
+    :param dt_from:
+    :param dt_upto:
+    :param group_type:
+    :return: dataset, labels
+    '''
+    key = period_key(dt_from, dt_upto, group_type)
+    start, count = key[1:3]
+    tracing.record_buckets(count)
+
+    async def compute():
+        intervals = await compile_intervals(dt_from, dt_upto, group_type)
+        dataset = await aggregate_with_bucket_cache(intervals, group_type)
+        return dataset, format_labels(intervals)
+
+    ttl = None if is_closed((start, intervals_end(start, count, group_type))) else BUCKET_CACHE_OPEN_TTL
+    return await response_cache.get_or_compute(key, compute, ttl)
+
+
+async def cached_aggregate_json(dt_from, dt_upto, group_type):
+    '''
+    Функция возвращает ответ с агрегированными данными, закодированный в байты JSON
+    (см. encode_aggregated). В кэше результатов хранится уже закодированный ответ,
+    поэтому при попадании в кэш ответ отдается без повторного кодирования
+    :return: bytes
+    '''
+    key = period_key(dt_from, dt_upto, group_type) + ('json',)
+    start, count = key[1:3]
+    tracing.record_buckets(count)
+
+    async def compute():
+        intervals = await compile_intervals(dt_from, dt_upto, group_type)
+        dataset = await aggregate_with_bucket_cache(intervals, group_type)
+        with tracing.stage('encode'):
+            return encode_aggregated(dataset, format_labels(intervals))
+
+    ttl = None if is_closed((start, intervals_end(start, count, group_type))) else BUCKET_CACHE_OPEN_TTL
+    return await response_cache.get_or_compute(key, compute, ttl)
+
+
+async def cached_aggregate_metrics(dt_from, dt_upto, group_type, metrics):
+    '''
+    Функция возвращает суммы зарплат и дополнительные статистики по интервалам
+    (см. aggregate_metrics) с кэшированием результата, как cached_aggregate
+    :param metrics: кортеж названий статистик из parse_metrics
+    :return: dataset, labels, {название статистики: список значений по интервалам}
+    '''
+    key = period_key(dt_from, dt_upto, group_type) + (metrics,)
+    start, count = key[1:3]
+    tracing.record_buckets(count)
+
+    async def compute():
+        intervals = await compile_intervals(dt_from, dt_upto, group_type)
+        dataset, values = await aggregate_metrics(intervals, group_type, metrics)
+        return dataset, format_labels(intervals), values
+
+    ttl = None if is_closed((start, intervals_end(start, count, group_type))) else BUCKET_CACHE_OPEN_TTL
+    return await response_cache.get_or_compute(key, compute, ttl)
@@ -0,0 +1,133 @@
+import argparse
+import asyncio
+import bisect
+import datetime
+import os
+from array import array
+from pathlib import Path
+
+from utils.intervals import GROUP_TYPES, iter_intervals, expand_intervals, merge_dataset, format_labels, to_utc
+from utils.mongodb import bucket_of, bucket_offset, fill_buckets, _to_bson_precision
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+# BSON-выгрузка коллекции salaries (файл mongodump: документы BSON подряд)
+DUMP_PATH = Path(os.getenv("DUMP_PATH") or BASE_DIR / "dump" / "salary_box" / "salaries.bson")
+
+
+def iter_documents(path=None):
+    '''
+    Читает документы из BSON-выгрузки по одному: в памяти находится только текущий документ,
+    поэтому объем памяти не зависит от размера файла
+    :param path: файл выгрузки (по умолчанию - DUMP_PATH)
+    :return: генератор документов {"dt": ..., "value": ...}
+    '''
+    from bson import decode_file_iter
+    with open(path or DUMP_PATH, 'rb') as file:
+        yield from decode_file_iter(file)
+
+
+def aggregate_dump(intervals, group_type, path=None, snapshot_path=None):
+    '''
+    Суммирует размер зарплат в каждом интервале за один проход по BSON-выгрузке.
+    Ключ интервала документа вычисляется тем же правилом, что в bucket_pipeline (см. bucket_of),
+    поэтому результат совпадает с результатом запроса к MongoDB, загруженной из этой выгрузки.
+    В памяти хранятся только суммы интервалов
+    :param intervals: список интервалов из compile_intervals (тип периода - час, день или месяц)
+    :param group_type: тип периода агрегации
+    :param path: файл выгрузки (по умолчанию - DUMP_PATH)
+    :param snapshot_path: каталог, в который за тот же проход записывается колоночный снимок
+    всей коллекции (см. utils/snapshot.py); даты и размеры зарплат при этом накапливаются в памяти
+    :return: список сумм зарплат по интервалам
+    '''
+    offset = bucket_offset(intervals)
+    first, last = _to_bson_precision(intervals[0][0]), _to_bson_precision(intervals[-1][1])
+    totals = {}
+    timestamps, values = array('q'), []
+    if snapshot_path is not None:
+        from utils.snapshot import to_epoch_ms
+    for document in iter_documents(path):
+        dt, value = document.get("dt"), document.get("value", 0)
+        if not isinstance(dt, datetime.datetime):
+            continue
+        if snapshot_path is not None:
+            timestamps.append(to_epoch_ms(dt))
+            values.append(value)
+        if first <= dt <= last:
+            key = bucket_of(dt, group_type, offset)
+            if key is not None:
+                totals[key] = totals.get(key, 0) + value
+    if snapshot_path is not None:
+        import numpy as np
+        from utils.snapshot import write_snapshot
+        write_snapshot(snapshot_path, np.frombuffer(timestamps, dtype=np.int64), values)
+    return fill_buckets(intervals, offset, [{"_id": key - offset, "total": total} for key, total in totals.items()])
+
+
+def aggregate_dump_ranges(intervals, path=None):
+    '''
+    Суммирует размер зарплат в каждом интервале [начало, конец] за один проход по BSON-выгрузке,
+    интервал документа находится двоичным поиском по началам интервалов. Применяется к интервалам,
+    не совпадающим с сеткой дат UTC (даты запроса с ненулевым смещением UTC)
+    :param intervals: список интервалов в наивных датах UTC
+    :param path: файл выгрузки (по умолчанию - DUMP_PATH)
+    :return: список сумм зарплат по интервалам
+    '''
+    starts = [_to_bson_precision(start) for start, end in intervals]
+    ends = [_to_bson_precision(end) for start, end in intervals]
+    dataset = [0] * len(intervals)
+    for document in iter_documents(path):
+        dt = document.get("dt")
+        if not isinstance(dt, datetime.datetime):
+            continue
+        index = bisect.bisect_right(starts, dt) - 1
+        if index >= 0 and dt <= ends[index]:
+            dataset[index] += document.get("value", 0)
+    return dataset
+
+
+async def aggregate_from_dump(intervals, group_type=None):
+    '''
+    Движок агрегации "dump": чтение выгрузки DUMP_PATH в отдельном потоке, не блокируя цикл событий
+    (без group_type - по границам интервалов, см. aggregate_dump_ranges)
+    '''
+    if group_type is None:
+        return await asyncio.to_thread(aggregate_dump_ranges, intervals)
+    return await asyncio.to_thread(aggregate_dump, intervals, group_type)
+
+
+def aggregate(dt_from, dt_upto, group_type, path=None, snapshot_path=None):
+    '''
+    Агрегация по BSON-выгрузке с теми же входными данными и результатом, что у do_aggregate
+    (суммы составных типов периода складываются из сумм базового типа)
+    :param path: файл выгрузки (по умолчанию - DUMP_PATH)
+    :param snapshot_path: каталог для колоночного снимка коллекции (см. aggregate_dump)
+    :return: dataset, labels
+    '''
+    intervals = list(iter_intervals(dt_from, dt_upto, group_type))
+    base_intervals, base_type = expand_intervals(intervals, group_type)
+    if intervals[0][0].tzinfo is not None and intervals[0][0].utcoffset():
+        # интервалы со смещением UTC не совпадают с сеткой дат UTC - суммы по границам интервалов
+        # базового типа, как в aggregate_intervals
+        if snapshot_path is not None:
+            raise ValueError("Snapshot export requires dates without a UTC offset")
+        dataset = aggregate_dump_ranges(to_utc(base_intervals), path)
+    else:
+        dataset = aggregate_dump(to_utc(base_intervals), base_type, path, snapshot_path)
+    return merge_dataset(dataset, group_type), format_labels(intervals)
+
+
+if __name__ == '__main__':
+    # агрегация без MongoDB: python -m utils.dump 2022-09-01T00:00:00 2022-12-31T23:59:00 month
+    parser = argparse.ArgumentParser(description="Агрегация зарплат по BSON-выгрузке коллекции salaries")
+    parser.add_argument('dt_from', type=datetime.datetime.fromisoformat)
+    parser.add_argument('dt_upto', type=datetime.datetime.fromisoformat)
+    parser.add_argument('group_type', choices=GROUP_TYPES)
+    parser.add_argument('--path', default=DUMP_PATH, help="файл выгрузки salaries.bson")
+    parser.add_argument('--snapshot', help="каталог для колоночного снимка коллекции (AGGREGATION_ENGINE=numpy)")
+    arguments = parser.parse_args()
+    if arguments.dt_from > arguments.dt_upto:
+        parser.error("dt_from must not be later than dt_upto")
+    from utils.encoding import encode_aggregated
+    dataset, labels = aggregate(arguments.dt_from, arguments.dt_upto, arguments.group_type,
+                                arguments.path, arguments.snapshot)
+    print(encode_aggregated(dataset, labels).decode())
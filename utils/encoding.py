@@ -0,0 +1,41 @@
+import orjson
+
+
+def loads(raw):
+    '''
+    Разбор тела запроса в формате JSON (orjson)
+    :param raw: bytes или str
+    :return: данные Python, при некорректном JSON - исключение ValueError
+    '''
+    return orjson.loads(raw)
+
+
+def dumps(value):
+    '''
+    Кодирование ответа в байты JSON (orjson)
+    :return: bytes
+    '''
+    return orjson.dumps(value)
+
+
+def encode_aggregated(dataset, labels, values=None):
+    '''
+    Кодирует ответ с агрегированными данными сразу в байты JSON (orjson),
+    минуя jsonable_encoder и стандартный модуль json
+    :param dataset: суммы зарплат по интервалам
+    :param labels: метки интервалов (строки ISO, см. format_labels)
+    :param values: дополнительные статистики по интервалам (если запрошены)
+    :return: bytes
+    '''
+    response = {"dataset": dataset, "labels": labels}
+    if values is not None:
+        response["metrics"] = values
+    return orjson.dumps(response)
+
+
+def encode_line(label, value):
+    '''
+    Строка потокового ответа NDJSON {"label": ..., "value": ...}
+    :return: bytes
+    '''
+    return orjson.dumps({"label": label, "value": value}) + b"\n"
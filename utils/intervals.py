@@ -0,0 +1,189 @@
+import datetime
+import os
+
+# допустимые типы периода агрегации
+GROUP_TYPES = ('year', 'quarter', 'month', 'week', 'day', 'hour')
+# день начала недели по ISO: 1 - понедельник, ..., 7 - воскресенье
+WEEK_START = int(os.getenv("WEEK_START", 1))
+# составные типы периода: сумма за период складывается из сумм за несколько
+# последовательных интервалов базового типа (тип, количество интервалов)
+BASE_GROUP_TYPES = {'week': ('day', 7), 'quarter': ('month', 3), 'year': ('month', 12)}
+
+MINUTE = datetime.timedelta(minutes=1)
+STEPS = {'week': datetime.timedelta(days=7), 'day': datetime.timedelta(days=1), 'hour': datetime.timedelta(hours=1)}
+# длина периода в месяцах
+MONTHS = {'month': 1, 'quarter': 3, 'year': 12}
+
+
+def start_of_first_interval(dt_from, group_type):
+    '''
+    Начало первого интервала: dt_from, усеченная до начала года, квартала, месяца, недели
+    (дня недели WEEK_START), дня или часа (секунды и микросекунды dt_from сохраняются),
+    для неизвестного типа периода - исключение ValueError
+    '''
+    if group_type in MONTHS:
+        month = (dt_from.month - 1) // MONTHS[group_type] * MONTHS[group_type] + 1
+        return dt_from.replace(month=month, day=1, hour=0, minute=0)
+    if group_type == 'week':
+        day = dt_from.replace(hour=0, minute=0)
+        return day - datetime.timedelta(days=(day.isoweekday() - WEEK_START) % 7)
+    if group_type == 'day':
+        return dt_from.replace(hour=0, minute=0)
+    if group_type == 'hour':
+        return dt_from.replace(minute=0)
+    raise ValueError(f"Invalid type of interval: '{group_type}'")
+
+
+def interval_count(dt_from, dt_upto, group_type):
+    '''
+    Количество интервалов агрегации: первый интервал формируется всегда,
+    далее - по одному на каждый полный период от начала первого интервала до dt_upto
+    :return: int
+    '''
+    start = start_of_first_interval(dt_from, group_type)
+    if group_type in MONTHS:
+        months = (dt_upto.year - start.year) * 12 + dt_upto.month - start.month
+        if months > 0 and (dt_upto.day, dt_upto.time()) < (start.day, start.time()):
+            months -= 1
+        elif months < 0 and (dt_upto.day, dt_upto.time()) > (start.day, start.time()):
+            months += 1
+        return max(months, 0) // MONTHS[group_type] + 1
+    return max((dt_upto - start) // STEPS[group_type], 0) + 1
+
+
+def _month_start(index, start):
+    # index - номер месяца от начала летоисчисления (год * 12 + месяц - 1)
+    return start.replace(year=index // 12, month=index % 12 + 1)
+
+
+def iter_intervals(dt_from, dt_upto, group_type):
+    '''
+    Генератор интервалов агрегации: границы интервалов вычисляются арифметически
+    (для часа, дня и недели - сдвигом на целое число шагов, для месяца, квартала и года -
+    через номер месяца год * 12 + месяц),
+    интервалы формируются по одному по мере обращения к генератору
+    :param dt_from: дата начала сбора статистики
+    :param dt_upto: дата окончания сбора статистики
+    :param group_type: тип периода сбора статистики
+    :return: интервалы (начало, конец) для запроса к бд
+    '''
+    start = start_of_first_interval(dt_from, group_type)
+    count = interval_count(dt_from, dt_upto, group_type)
+    if group_type in MONTHS:
+        months = MONTHS[group_type]
+        first = start.year * 12 + start.month - 1
+        for index in range(first, first + count * months, months):
+            yield _month_start(index, start), _month_start(index + months, start) - MINUTE
+    else:
+        step = STEPS[group_type]
+        for index in range(count):
+            start_of_period = start + index * step
+            yield start_of_period, start_of_period + step - MINUTE
+
+
+def interval_arrays(dt_from, dt_upto, group_type):
+    '''
+    Векторная форма интервалов агрегации: массивы NumPy начал и концов интервалов
+    (datetime64 с точностью до микросекунды)
+    :param dt_from: дата начала сбора статистики
+    :param dt_upto: дата окончания сбора статистики
+    :param group_type: тип периода сбора статистики
+    :return: starts, ends
+    '''
+    import numpy as np
+
+    start = start_of_first_interval(dt_from, group_type)
+    count = interval_count(dt_from, dt_upto, group_type)
+    if group_type in MONTHS:
+        offset = np.timedelta64(start - start.replace(second=0, microsecond=0), 'us')
+        months = np.arange(count + 1) * MONTHS[group_type] + np.datetime64(start.strftime('%Y-%m'), 'M')
+        edges = months.astype('datetime64[us]') + offset
+        return edges[:-1], edges[1:] - np.timedelta64(1, 'm')
+    step = np.timedelta64(STEPS[group_type], 'us')
+    starts = np.datetime64(start, 'us') + np.arange(count) * step
+    return starts, starts + step - np.timedelta64(1, 'm')
+
+
+def intervals_end(start, count, group_type):
+    '''
+    Конец последнего из count последовательных интервалов типа group_type,
+    первый из которых начинается в start
+    '''
+    if group_type in MONTHS:
+        return _month_start(start.year * 12 + start.month - 1 + count * MONTHS[group_type], start) - MINUTE
+    return start + count * STEPS[group_type] - MINUTE
+
+
+def to_naive_utc(dt):
+    '''
+    Дата со смещением UTC (например, из ISO 8601 "2022-09-01T00:00:00+03:00") - в наивную дату UTC,
+    как даты хранятся в MongoDB. Наивная дата возвращается без изменений
+    '''
+    if dt.tzinfo is None:
+        return dt
+    return dt.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+
+
+def to_utc(intervals):
+    '''
+    Интервалы с датами со смещением UTC - в наивных датах UTC (см. to_naive_utc)
+    '''
+    if not intervals or intervals[0][0].tzinfo is None:
+        return intervals
+    return [(to_naive_utc(start), to_naive_utc(end)) for start, end in intervals]
+
+
+def expand_intervals(intervals, group_type):
+    '''
+    Интервалы базового типа для составного типа периода (неделя - дни, квартал и год - месяцы):
+    каждый интервал составного типа делится на BASE_GROUP_TYPES[group_type][1] интервалов базового
+    :param intervals: список интервалов из compile_intervals
+    :param group_type: тип периода агрегации
+    :return: интервалы базового типа, базовый тип (для остальных типов - те же интервалы и тип)
+    '''
+    if group_type not in BASE_GROUP_TYPES or not intervals:
+        return intervals, group_type
+    base = BASE_GROUP_TYPES[group_type][0]
+    return list(iter_intervals(intervals[0][0], intervals[-1][1], base)), base
+
+
+def merge_dataset(dataset, group_type, merge=sum):
+    '''
+    Объединяет результаты по интервалам базового типа (см. expand_intervals)
+    в результаты по интервалам составного типа
+    :param dataset: результаты по интервалам базового типа
+    :param merge: функция объединения результатов нескольких интервалов
+    :return: список результатов по интервалам типа group_type
+    '''
+    if group_type not in BASE_GROUP_TYPES:
+        return dataset
+    size = BASE_GROUP_TYPES[group_type][1]
+    return [merge(dataset[index:index + size]) for index in range(0, len(dataset), size)]
+
+
+def format_labels(intervals):
+    '''
+    Метки интервалов - начала интервалов в формате ISO (как datetime.isoformat).
+    Дата и время форматируются по одному разу: у почасовых интервалов дата повторяется
+    24 раза, а время начала интервала - одно из 24 значений, поэтому метка собирается
+    из двух готовых строк
+    :param intervals: список интервалов
+    :return: список строк
+    '''
+    dates, times = {}, {}
+    labels = []
+    for start, _ in intervals:
+        if start.tzinfo is not None:
+            # дата со смещением UTC (например, 2022-09-01T00:00:00+03:00) - смещение входит в метку
+            labels.append(start.isoformat())
+            continue
+        date = start.date()
+        prefix = dates.get(date)
+        if prefix is None:
+            prefix = dates[date] = date.isoformat() + 'T'
+        key = (start.hour, start.minute, start.second, start.microsecond)
+        suffix = times.get(key)
+        if suffix is None:
+            suffix = times[key] = start.time().isoformat()
+        labels.append(prefix + suffix)
+    return labels
@@ -0,0 +1,118 @@
+import asyncio
+import logging
+import os
+
+from utils import mongodb
+from utils import cache
+
+# обновление кэшей и витрины по мере поступления документов в коллекцию salaries:
+# "off" - выключено, "auto" - поток изменений MongoDB (change stream), а если сервер его
+# не поддерживает (не набор реплик) - опрос коллекции, "change_stream" - только поток изменений,
+# "poll" - только опрос
+LIVE_UPDATES = os.getenv("LIVE_UPDATES", "off")
+# интервал опроса коллекции (в секундах) и наибольшее количество документов в одной порции
+LIVE_POLL_INTERVAL = float(os.getenv("LIVE_POLL_INTERVAL", 1))
+LIVE_BATCH_SIZE = int(os.getenv("LIVE_BATCH_SIZE", 1000))
+# код ошибки MongoDB: поток изменений поддерживается только набором реплик
+CHANGE_STREAMS_UNSUPPORTED = 40573
+
+logger = logging.getLogger(__name__)
+
+# позиция в потоке изменений и последний обработанный _id при опросе:
+# после перезапуска чтения изменения продолжаются с этого места
+_resume_token = None
+_last_id = None
+
+
+async def apply_inserts(documents):
+    '''
+    Учитывает новые документы коллекции salaries в кэшах, индексе накопленных сумм и витрине
+    (в каждом - только те документы, которые не будут прочитаны им самим при обновлении)
+    :param documents: новые документы {"dt": ..., "value": ...}
+    '''
+    if not documents:
+        return
+    cache.apply_inserts(documents)
+    if mongodb.AGGREGATION_ENGINE == 'prefix':
+        from utils import prefix_index
+        await prefix_index.apply_inserts(documents)
+    if mongodb.USE_ROLLUP:
+        from utils import rollup
+        await rollup.apply_inserts(documents)
+
+
+async def watch_changes():
+    '''
+    Читает поток изменений коллекции salaries (только вставки) и учитывает новые документы
+    порциями до LIVE_BATCH_SIZE. Требует набор реплик, на отдельном сервере -
+    исключение OperationFailure при открытии потока
+    '''
+    global _resume_token
+    pipeline = [{"$match": {"operationType": "insert"}}]
+    async with mongodb.salaries.watch(pipeline, resume_after=_resume_token) as stream:
+        while stream.alive:
+            documents = []
+            while len(documents) < LIVE_BATCH_SIZE:
+                change = await stream.try_next()
+                if change is None:
+                    break
+                documents.append(change["fullDocument"])
+            await apply_inserts(documents)
+            _resume_token = stream.resume_token
+
+
+async def poll_once():
+    '''
+    Один опрос коллекции salaries: документы с _id больше последнего обработанного
+    (_id документов, созданных драйвером, возрастают со временем вставки)
+    :return: количество обработанных документов
+    '''
+    global _last_id
+    from bson import ObjectId
+    if _last_id is None:
+        last = await mongodb.salaries.find_one({}, sort=[("_id", -1)])
+        # в пустой коллекции новыми считаются все документы
+        _last_id = last["_id"] if last else ObjectId(b"\0" * 12)
+    cursor = mongodb.salaries.find({"_id": {"$gt": _last_id}}, sort=[("_id", 1)])
+    documents = await cursor.to_list(LIVE_BATCH_SIZE)
+    if documents:
+        _last_id = documents[-1]["_id"]
+        await apply_inserts(documents)
+    return len(documents)
+
+
+async def poll_changes():
+    '''
+    Опрашивает коллекцию каждые LIVE_POLL_INTERVAL секунд
+    (без паузы, пока новые документы поступают полными порциями)
+    '''
+    while True:
+        if await poll_once() < LIVE_BATCH_SIZE:
+            await asyncio.sleep(LIVE_POLL_INTERVAL)
+
+
+async def run_live_updates(mode=None):
+    '''
+    Фоновая задача обновления кэшей и витрины по новым документам (запускается в lifespan приложения).
+    После ошибки чтение изменений продолжается с последней обработанной позиции
+    :param mode: режим (по умолчанию - LIVE_UPDATES)
+    '''
+    from pymongo.errors import OperationFailure
+    mode = mode or LIVE_UPDATES
+    while mode != 'poll':
+        try:
+            await watch_changes()
+        except OperationFailure as error:
+            if error.code == CHANGE_STREAMS_UNSUPPORTED and mode == 'auto':
+                logger.info("Поток изменений недоступен (%s), используется опрос коллекции", error)
+                break
+            logger.exception("Ошибка чтения потока изменений коллекции salaries")
+        except Exception:
+            logger.exception("Ошибка чтения потока изменений коллекции salaries")
+        await asyncio.sleep(LIVE_POLL_INTERVAL)
+    while True:
+        try:
+            await poll_changes()
+        except Exception:
+            logger.exception("Ошибка опроса коллекции salaries")
+            await asyncio.sleep(LIVE_POLL_INTERVAL)
@@ -0,0 +1,172 @@
+import math
+import os
+
+# относительная ошибка приближенных процентилей (значение процентиля отличается
+# от точного не более чем на эту долю)
+METRICS_RELATIVE_ERROR = float(os.getenv("METRICS_RELATIVE_ERROR", 0.01))
+# статистики, вычисляемые точно
+BASIC_METRICS = ('count', 'avg', 'min', 'max')
+
+
+def parse_metrics(metrics):
+    '''
+    Проверяет и нормализует список дополнительных статистик:
+    "count", "avg", "min", "max" и процентили вида "p50", "p90", "p99.9"
+    :param metrics: строка через запятую ("count,avg,p90") или список строк
+    :return: кортеж названий статистик без повторов, при некорректном названии - исключение ValueError
+    '''
+    if isinstance(metrics, str):
+        metrics = metrics.split(',')
+    if not isinstance(metrics, (list, tuple)):
+        raise ValueError("Metrics must be a comma separated string or a list")
+    result = []
+    for metric in metrics:
+        metric = str(metric).strip()
+        if metric not in BASIC_METRICS and percentile_rank(metric) is None:
+            raise ValueError(f"Unsupported metric: '{metric}'")
+        if metric not in result:
+            result.append(metric)
+    if not result:
+        raise ValueError("Empty list of metrics")
+    return tuple(result)
+
+
+def percentile_rank(metric):
+    '''
+    Доля для процентиля: "p90" -> 0.9
+    :return: float или None, если metric не процентиль
+    '''
+    if not metric.startswith('p'):
+        return None
+    try:
+        rank = float(metric[1:])
+    except ValueError:
+        return None
+    return rank / 100 if 0 <= rank <= 100 else None
+
+
+class QuantileSketch:
+    '''
+    Эскиз распределения для приближенных процентилей (логарифмическая гистограмма, как в DDSketch):
+    значение v > 0 попадает в корзину ceil(log(v) / log(gamma)), gamma = (1 + e) / (1 - e),
+    неположительные значения учитываются в отдельной корзине нуля.
+    Эскизы с одинаковой точностью объединяются сложением счетчиков корзин,
+    поэтому эскизы интервалов можно хранить в кэше или витрине и складывать
+    '''
+
+    def __init__(self, relative_error=None):
+        self.relative_error = relative_error or METRICS_RELATIVE_ERROR
+        self.gamma = (1 + self.relative_error) / (1 - self.relative_error)
+        self.bins = {}
+        self.zeros = 0
+        self.count = 0
+
+    def key(self, value):
+        return math.ceil(math.log(value) / math.log(self.gamma)) if value > 0 else None
+
+    def add_bin(self, key, count=1):
+        # key - номер корзины (см. bin_expression), None - корзина нуля
+        if key is None:
+            self.zeros += count
+        else:
+            self.bins[key] = self.bins.get(key, 0) + count
+        self.count += count
+
+    def add(self, value, count=1):
+        self.add_bin(self.key(value), count)
+
+    def merge(self, other):
+        for key, count in other.bins.items():
+            self.bins[key] = self.bins.get(key, 0) + count
+        self.zeros += other.zeros
+        self.count += other.count
+        return self
+
+    def quantile(self, rank):
+        '''
+        Приближенное значение процентиля: середина корзины, в которую попадает элемент
+        с номером rank * (count - 1) в порядке возрастания
+        :param rank: доля от 0 до 1
+        :return: float или None для пустого эскиза
+        '''
+        if not self.count:
+            return None
+        position = rank * (self.count - 1)
+        seen = self.zeros
+        if position < seen:
+            return 0
+        for key in sorted(self.bins):
+            seen += self.bins[key]
+            if position < seen:
+                return 2 * self.gamma ** key / (self.gamma + 1)
+        return 2 * self.gamma ** max(self.bins) / (self.gamma + 1)
+
+
+def bin_expression(value, relative_error=None):
+    '''
+    Выражение агрегационного конвейера MongoDB: номер корзины QuantileSketch для значения
+    (null для неположительных значений)
+    :param value: выражение значения, например "$value"
+    '''
+    gamma = QuantileSketch(relative_error).gamma
+    return {"$cond": [{"$gt": [value, 0]},
+                      {"$ceil": {"$divide": [{"$ln": value}, math.log(gamma)]}},
+                      None]}
+
+
+class BucketStats:
+    '''
+    Статистики одного интервала: сумма, количество, минимум, максимум и эскиз распределения.
+    Статистики нескольких интервалов объединяются (merge), например,
+    при сложении интервалов из кэша или витрины
+    '''
+
+    def __init__(self, relative_error=None):
+        self.total = 0
+        self.count = 0
+        self.min = None
+        self.max = None
+        self.sketch = QuantileSketch(relative_error)
+
+    def add_group(self, document, key=None):
+        '''
+        Учитывает документ $group конвейера metrics_pipeline
+        :param document: {"total", "count", "min", "max"}
+        :param key: номер корзины эскиза, если вычисляются процентили
+        '''
+        self.merge_values(document['total'], document['count'], document['min'], document['max'])
+        self.sketch.add_bin(key, document['count'])
+
+    def merge_values(self, total, count, minimum, maximum):
+        self.total += total
+        self.count += count
+        if minimum is not None and (self.min is None or minimum < self.min):
+            self.min = minimum
+        if maximum is not None and (self.max is None or maximum > self.max):
+            self.max = maximum
+
+    def merge(self, other):
+        self.merge_values(other.total, other.count, other.min, other.max)
+        self.sketch.merge(other.sketch)
+        return self
+
+    def value(self, metric):
+        if metric == 'count':
+            return self.count
+        if metric == 'avg':
+            return self.total / self.count if self.count else None
+        if metric in ('min', 'max'):
+            return getattr(self, metric)
+        quantile = self.sketch.quantile(percentile_rank(metric))
+        # процентиль не выходит за пределы точных минимума и максимума
+        return None if quantile is None else min(max(quantile, self.min), self.max)
+
+
+def summarize(stats, metrics):
+    '''
+    Значения статистик по интервалам
+    :param stats: список BucketStats по интервалам
+    :param metrics: кортеж названий статистик из parse_metrics
+    :return: {название статистики: список значений по интервалам}
+    '''
+    return {metric: [bucket.value(metric) for bucket in stats] for metric in metrics}
@@ -1,12 +1,173 @@
+import asyncio
 import datetime
-from dateutil.relativedelta import relativedelta
+import functools
+import logging
 import os
-from motor import motor_asyncio
+
+from utils.intervals import (iter_intervals, expand_intervals, merge_dataset, format_labels,
+                             start_of_first_interval, to_utc, MINUTE)
+from utils.metrics import BucketStats, bin_expression, percentile_rank, summarize
+from utils import tracing
 
 URI = os.getenv("MONGODB_URI")
-client = motor_asyncio.AsyncIOMotorClient(URI)
-db = client.get_database("salary_box")
-salaries = db.get_collection("salaries")
+# настройки пула соединений клиента MongoDB: параметр клиента - переменная окружения
+# (незаданные переменные не передаются, действуют значения из MONGODB_URI или по умолчанию)
+CLIENT_OPTIONS = {
+    "maxPoolSize": "MONGODB_MAX_POOL_SIZE",
+    "minPoolSize": "MONGODB_MIN_POOL_SIZE",
+    "maxIdleTimeMS": "MONGODB_MAX_IDLE_TIME_MS",
+    "waitQueueTimeoutMS": "MONGODB_WAIT_QUEUE_TIMEOUT_MS",
+    "connectTimeoutMS": "MONGODB_CONNECT_TIMEOUT_MS",
+    "socketTimeoutMS": "MONGODB_SOCKET_TIMEOUT_MS",
+    "serverSelectionTimeoutMS": "MONGODB_SERVER_SELECTION_TIMEOUT_MS",
+}
+
+
+def client_options():
+    '''
+    Параметры пула соединений клиента MongoDB из переменных окружения
+    :return: словарь параметров для AsyncIOMotorClient
+    '''
+    return {option: int(os.getenv(variable)) for option, variable in CLIENT_OPTIONS.items()
+            if os.getenv(variable)}
+
+
+def connect():
+    '''
+    Создает клиент MongoDB и объекты базы данных и коллекции salaries (атрибуты модуля client, db, salaries).
+    Вызывается при запуске приложения, а вне приложения (бот, тесты, сценарии) - при первом обращении
+    к атрибуту: импорт модуля не загружает драйвер и не создает клиент до появления цикла событий.
+    Уже заданная коллекция (например, замененная в тестах) не пересоздается
+    :return: коллекция salaries
+    '''
+    global client, db, salaries
+    if 'salaries' not in globals():
+        from motor import motor_asyncio
+        client = motor_asyncio.AsyncIOMotorClient(URI, **client_options())
+        db = client.get_database("salary_box")
+        salaries = db.get_collection("salaries")
+    return salaries
+
+
+def close():
+    '''
+    Закрывает клиент MongoDB, созданный connect (вызывается при остановке приложения).
+    При следующем обращении клиент будет создан заново
+    '''
+    if 'client' in globals():
+        globals().pop('client').close()
+        globals().pop('db', None)
+        globals().pop('salaries', None)
+
+
+def __getattr__(name):
+    # client, db и salaries создаются при первом обращении к ним (см. connect)
+    if name in ('client', 'db', 'salaries'):
+        connect()
+        return globals()[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def get_salaries():
+    '''
+    Коллекция salaries для функций модуля (с созданием клиента при первом обращении)
+    '''
+    return globals()['salaries'] if 'salaries' in globals() else connect()
+
+# Движок агрегации: "bucket" - один конвейер на запрос с группировкой по ключу интервала,
+# "interval" - отдельный запрос к базе данных для каждого интервала,
+# "numpy" - колоночный снимок коллекции в файлах .npy без обращения к базе данных (см. utils/snapshot.py),
+# "prefix" - индекс накопленных сумм по минутам в памяти процесса (см. utils/prefix_index.py),
+# "dump" - потоковое чтение BSON-выгрузки коллекции (salaries.bson) без MongoDB (см. utils/dump.py)
+AGGREGATION_ENGINE = os.getenv("AGGREGATION_ENGINE", "bucket")
+# использовать витрину почасовых сумм salaries_hourly (см. utils/rollup.py)
+USE_ROLLUP = os.getenv("USE_ROLLUP", "0") == "1"
+# движок "interval": сколько запросов по интервалам одного запроса пользователя
+# выполняются одновременно (1 - последовательно). Ограничение действует на каждый запрос
+# пользователя отдельно, поэтому один длинный запрос не занимает весь пул соединений
+INTERVAL_CONCURRENCY = int(os.getenv("INTERVAL_CONCURRENCY", 1))
+# количество интервалов, обрабатываемых за один запрос к базе данных в потоковом режиме
+STREAM_CHUNK_SIZE = int(os.getenv("STREAM_CHUNK_SIZE", 500))
+
+# диагностика планов запросов: "off" - выключена, "log" - записывать в журнал
+# запросы без индекса (COLLSCAN) или без покрытия индексом (FETCH), "strict" - отклонять такие запросы
+EXPLAIN_MODE = os.getenv("EXPLAIN_MODE", "off")
+
+# индексы коллекции salaries, необходимые для запросов по периоду:
+# {dt: 1, value: 1} позволяет выполнять запросы по dt без чтения документов (покрывающий индекс)
+SALARIES_INDEXES = [[("dt", 1), ("value", 1)]]
+
+logger = logging.getLogger(__name__)
+
+_date_trunc_supported = None
+_explained_plans = {}
+
+
+class QueryPlanError(Exception):
+    pass
+
+
+async def ensure_indexes():
+    '''
+    Функция проверяет наличие индексов, необходимых для агрегации по периоду,
+    и создает отсутствующие. Вызывается при запуске приложения
+    :return: список созданных индексов
+    '''
+    existing = [index['key'] for index in (await get_salaries().index_information()).values()]
+    created = []
+    for keys in SALARIES_INDEXES:
+        if keys not in existing:
+            created.append(await get_salaries().create_index(keys))
+            logger.info("Создан индекс %s коллекции salaries", created[-1])
+    return created
+
+
+def plan_stages(explain):
+    '''
+    Функция собирает названия всех стадий плана запроса из ответа команды explain
+    :param explain: ответ команды explain
+    :return: множество названий стадий
+    '''
+    stages = set()
+    if isinstance(explain, dict):
+        for key, value in explain.items():
+            if key == 'stage' and isinstance(value, str):
+                stages.add(value)
+            elif key not in ('rejectedPlans', 'executionStats'):
+                stages |= plan_stages(value)
+    elif isinstance(explain, list):
+        for item in explain:
+            stages |= plan_stages(item)
+    return stages
+
+
+async def explain_guard(pipeline, key):
+    '''
+    Диагностический режим (EXPLAIN_MODE): выполняет explain конвейера и проверяет,
+    что выборка по dt выполняется по индексу (IXSCAN) и покрывается им (без FETCH).
+    План проверяется один раз для каждого вида запроса (key)
+    :param pipeline: конвейер агрегации коллекции salaries
+    :param key: вид запроса, например движок и тип периода агрегации
+    :return: None, в режиме "strict" при плохом плане - исключение QueryPlanError
+    '''
+    if EXPLAIN_MODE not in ('log', 'strict'):
+        return
+    if key not in _explained_plans:
+        collection = get_salaries()
+        explain = await collection.database.command(
+            "explain", {"aggregate": collection.name, "pipeline": pipeline, "cursor": {}},
+            verbosity="queryPlanner")
+        stages = plan_stages(explain)
+        problem = None
+        if 'COLLSCAN' in stages:
+            problem = "полный просмотр коллекции (COLLSCAN)"
+        elif 'FETCH' in stages:
+            problem = "чтение документов (запрос не покрыт индексом)"
+        _explained_plans[key] = problem
+        if problem:
+            logger.warning("План запроса %s: %s, стадии: %s", key, problem, sorted(stages))
+    if EXPLAIN_MODE == 'strict' and _explained_plans[key]:
+        raise QueryPlanError(f"Запрос {key} отклонен: {_explained_plans[key]}")
 
 
 async def compile_intervals(dt_from, dt_upto, group_type):
@@ -18,56 +179,374 @@ async def compile_intervals(dt_from, dt_upto, group_type):
     :param group_type: тип периода сбора статистики
     :return: список временных интервалов для запроса к бд
     '''
-    intervals = []
-    if group_type == 'month':
-        months, days, hours = (1, 0, 0)
-        start_of_period = dt_from + relativedelta(day=1, hour=0, minute=0)
-        loop_count = (relativedelta(dt_upto, start_of_period).years * 12 +
-                      relativedelta(dt_upto, start_of_period).months + 1)
-    elif group_type == 'day':
-        months, days, hours = (0, 1, 0)
-        start_of_period = dt_from + relativedelta(hour=0, minute=0)
-        loop_count = (dt_upto - start_of_period).days + 1
+    with tracing.stage('compile'):
+        return list(iter_intervals(dt_from, dt_upto, group_type))
+
+
+def _truncate_date(expr, unit, date_trunc):
+    '''
+    Формирует выражение конвейера, усекающее дату до начала единицы времени (unit).
+    На серверах MongoDB 5.0+ используется оператор $dateTrunc, на более старых -
+    разбор даты на составляющие ($dateToParts) и сборка обратно ($dateFromParts)
+    :param expr: выражение с датой
+    :param unit: единица усечения: month, day, hour, minute
+    :param date_trunc: поддерживает ли сервер $dateTrunc
+    :return: выражение конвейера
+    '''
+    if date_trunc:
+        return {"$dateTrunc": {"date": expr, "unit": unit}}
+    fields = ['year', 'month', 'day', 'hour', 'minute']
+    parts = fields[:fields.index(unit) + 1]
+    return {"$let": {"vars": {"parts": {"$dateToParts": {"date": expr}}},
+                     "in": {"$dateFromParts": {part: f"$$parts.{part}" for part in parts}}}}
+
+
+async def supports_date_trunc():
+    '''
+    Проверяет (один раз за время работы процесса), поддерживает ли сервер MongoDB
+    оператор $dateTrunc (версия 5.0 и выше)
+    :return: bool
+    '''
+    global _date_trunc_supported
+    if _date_trunc_supported is None:
+        info = await get_salaries().database.command("buildInfo")
+        _date_trunc_supported = info["versionArray"][0] >= 5
+    return _date_trunc_supported
+
+
+def _to_bson_precision(value):
+    '''
+    Даты в BSON хранятся с точностью до миллисекунды, приводим к ней дату Python
+    '''
+    return value.replace(microsecond=value.microsecond // 1000 * 1000)
+
+
+async def run_pipeline(pipeline, collection=None, count_field="count"):
+    '''
+    Выполняет конвейер агрегации одним запросом к базе данных и учитывает запрос в трассировке
+    (этап db). Количество прочитанных документов - сумма поля count_field в результате
+    (количество документов в группах $group), при count_field=None - количество документов результата
+    :param pipeline: конвейер агрегации
+    :param collection: коллекция (по умолчанию - salaries)
+    :return: список документов результата
+    '''
+    with tracing.stage('db'):
+        cursor = (get_salaries() if collection is None else collection).aggregate(pipeline)
+        documents = await cursor.to_list()
+    tracing.record_query(len(documents) if count_field is None else
+                         sum(document.get(count_field, 0) for document in documents))
+    return documents
+
+
+def bucket_of(dt, group_type, offset=datetime.timedelta(0)):
+    '''
+    Ключ интервала для одного документа - то же правило, что в bucket_pipeline, на стороне приложения:
+    начало интервала типа group_type (часа, дня или месяца) со сдвигом offset, в который входит
+    документ с датой dt
+    :param dt: дата документа
+    :param offset: сдвиг границ интервалов (секунды и микросекунды начала интервала)
+    :return: начало интервала или None, если документ внутри последней минуты интервала
+    и не входит ни в один интервал
+    '''
+    shifted = _to_bson_precision(dt) - (offset - datetime.timedelta(microseconds=offset.microseconds % 1000))
+    minute = shifted.replace(second=0, microsecond=0)
+    next_minute = minute + MINUTE
+    if shifted != minute and start_of_first_interval(next_minute, group_type) == next_minute:
+        return None
+    return start_of_first_interval(minute, group_type) + offset
+
+
+def bucket_offset(intervals):
+    '''
+    Сдвиг границ интервалов относительно начала минуты: секунды и миллисекунды начала первого интервала
+    (границы из compile_intervals содержат секунды из dt_from)
+    :param intervals: список интервалов из compile_intervals
+    :return: timedelta
+    '''
+    first_start = _to_bson_precision(intervals[0][0])
+    return first_start - first_start.replace(second=0, microsecond=0)
+
+
+def bucket_pipeline(intervals, group_type, date_trunc=True, after=None):
+    '''
+    Функция формирует единый конвейер агрегации для всех интервалов запроса:
+    выборка документов за весь период (от начала первого интервала до конца последнего),
+    вычисление ключа интервала для каждого документа и суммирование по ключу.
+    Границы интервалов из compile_intervals могут содержать секунды из dt_from,
+    поэтому перед усечением дата документа сдвигается на эту величину.
+    Интервал включает документы до начала своей последней минуты включительно ($lte),
+    поэтому документы внутри последней минуты интервала (с ненулевыми секундами)
+    отбрасываются так же, как при запросе по каждому интервалу отдельно
+    :param intervals: список интервалов из compile_intervals
+    :param group_type: тип периода агрегации
+    :param date_trunc: поддерживает ли сервер $dateTrunc
+    :param after: учитывать только документы с датой строго позже этой
+    :return: конвейер агрегации, сдвиг границ интервалов (timedelta)
+    '''
+    offset = bucket_offset(intervals)
+    offset_ms = offset // datetime.timedelta(milliseconds=1)
+    shifted = {"$subtract": ["$dt", offset_ms]} if offset_ms else "$dt"
+    next_minute = {"$add": ["$$minute", 60000]}
+    if after is not None and after >= intervals[0][0]:
+        window = {"$gt": after, "$lte": intervals[-1][1]}
     else:
-        months, days, hours = (0, 0, 1)
-        start_of_period = dt_from + relativedelta(minute=0)
-        delta = dt_upto - start_of_period
-        loop_count = (delta.days * 24) + (delta.seconds // 3600) + 1
-    end_of_period = start_of_period + relativedelta(months=+months, days=+days, hours=+hours, minutes=-1)
-    intervals.append((start_of_period, end_of_period))
-    for index in range(2, loop_count+1):
-        start_of_period += relativedelta(months=+months, days=+days, hours=+hours)
-        end_of_period = start_of_period + relativedelta(months=+months, days=+days, hours=+hours, minutes=-1)
-        intervals.append((start_of_period, end_of_period))
-    return intervals
+        window = {"$gte": intervals[0][0], "$lte": intervals[-1][1]}
+    pipeline = [
+        {"$match": {"dt": window}},
+        {"$project": {"_id": 0, "value": 1, "shifted": shifted}},
+        {"$project": {
+            "value": 1,
+            "bucket": _truncate_date("$shifted", group_type, date_trunc),
+            "inside": {"$let": {
+                "vars": {"minute": _truncate_date("$shifted", 'minute', date_trunc)},
+                "in": {"$or": [
+                    {"$eq": ["$shifted", "$$minute"]},
+                    {"$ne": [_truncate_date(next_minute, group_type, date_trunc), next_minute]},
+                ]},
+            }},
+        }},
+        {"$match": {"inside": True}},
+        {"$group": {"_id": "$bucket", "total": {"$sum": "$value"}, "count": {"$sum": 1}}},
+    ]
+    return pipeline, offset
 
 
-async def do_aggregate(dt_from, dt_upto, group_type):
+async def aggregate_by_buckets(intervals, group_type, after=None):
+    '''
+    Функция выполняет один запрос к базе данных на все интервалы и раскладывает
+    полученные суммы по интервалам. Интервалы без документов заполняются нулями
+    :param intervals: список интервалов из compile_intervals
+    :param group_type: тип периода агрегации
+    :param after: учитывать только документы с датой строго позже этой
+    :return: список сумм зарплат по интервалам
+    '''
+    pipeline, offset = bucket_pipeline(intervals, group_type, await supports_date_trunc(), after)
+    await explain_guard(pipeline, ('bucket', group_type))
+    return fill_buckets(intervals, offset, await run_pipeline(pipeline))
+
+
+def fill_buckets(intervals, offset, documents):
+    '''
+    Раскладывает результат конвейера bucket_pipeline по интервалам,
+    интервалы без документов заполняются нулями
+    :param intervals: список интервалов
+    :param offset: сдвиг границ интервалов из bucket_pipeline
+    :param documents: документы {"_id": ключ интервала, "total": сумма, "count": количество}
+    :return: список сумм зарплат по интервалам
+    '''
+    totals = {document['_id'] + offset: document['total'] for document in documents}
+    return [totals.get(_to_bson_precision(interval[0]), 0) for interval in intervals]
+
+
+def metrics_pipeline(intervals, group_type, metrics, date_trunc=True):
+    '''
+    Конвейер агрегации для дополнительных статистик: тот же проход по документам, что и
+    bucket_pipeline, но $group кроме суммы считает количество, минимум и максимум.
+    При запросе процентилей документы группируются по интервалу и корзине эскиза распределения
+    (см. QuantileSketch), корзины складываются в эскиз интервала уже в приложении
+    :param metrics: кортеж названий статистик из parse_metrics
+    :return: конвейер агрегации, сдвиг границ интервалов (timedelta)
+    '''
+    pipeline, offset = bucket_pipeline(intervals, group_type, date_trunc)
+    key = {"bucket": "$bucket"}
+    if any(percentile_rank(metric) is not None for metric in metrics):
+        key["bin"] = bin_expression("$value")
+    pipeline[-1] = {"$group": {
+        "_id": key,
+        "total": {"$sum": "$value"},
+        "count": {"$sum": 1},
+        "min": {"$min": "$value"},
+        "max": {"$max": "$value"},
+    }}
+    return pipeline, offset
+
+
+async def aggregate_metrics(intervals, group_type, metrics, engine=None):
+    '''
+    Функция вычисляет суммы зарплат и дополнительные статистики по интервалам
+    одним запросом к базе данных (см. metrics_pipeline). Статистики составных типов периода
+    (неделя, квартал, год) получаются объединением статистик интервалов базового типа
+    :param intervals: список интервалов из compile_intervals
+    :param group_type: тип периода агрегации
+    :param metrics: кортеж названий статистик из parse_metrics
+    :param engine: движок агрегации (по умолчанию - AGGREGATION_ENGINE)
+    :return: dataset, {название статистики: список значений по интервалам},
+    при движке без MongoDB (numpy, dump) или датах с ненулевым смещением UTC - исключение ValueError
+    '''
+    engine = engine or AGGREGATION_ENGINE
+    if engine in ('numpy', 'dump'):
+        # снимок и выгрузка хранят только даты и суммы, статистики вычисляются запросом к MongoDB
+        raise ValueError(f"Metrics are not supported by aggregation engine '{engine}'")
+    if intervals and intervals[0][0].tzinfo is not None:
+        if intervals[0][0].utcoffset():
+            raise ValueError("Metrics are supported only for dates without a UTC offset or in UTC")
+        intervals = to_utc(intervals)
+    base_intervals, base_type = expand_intervals(intervals, group_type)
+    pipeline, offset = metrics_pipeline(base_intervals, base_type, metrics, await supports_date_trunc())
+    await explain_guard(pipeline, ('metrics', base_type))
+    stats = {_to_bson_precision(interval[0]): BucketStats() for interval in base_intervals}
+    for document in await run_pipeline(pipeline):
+        bucket = stats.get(document['_id']['bucket'] + offset)
+        if bucket is not None:
+            bucket.add_group(document, document['_id'].get('bin'))
+    stats = merge_dataset(list(stats.values()), group_type,
+                          lambda buckets: functools.reduce(BucketStats.merge, buckets, BucketStats()))
+    return [bucket.total for bucket in stats], summarize(stats, metrics)
+
+
+async def aggregate_interval(interval):
+    '''
+    Функция запрашивает из базы данных сумму зарплат в одном интервале
+    :param interval: интервал (начало, конец)
+    :return: сумма зарплат
+    '''
+    pipeline = [
+        {"$match": {"dt": {"$gte": interval[0], "$lte": interval[1]}}},
+        {"$group": {"_id": "null", "total": {"$sum": "$value"}, "count": {"$sum": 1}}},
+    ]
+    await explain_guard(pipeline, ('interval',))
+    result = await run_pipeline(pipeline)
+    try:
+        return result[0]['total']
+    except IndexError:
+        return 0
+
+
+async def aggregate_by_intervals(intervals, concurrency=None):
+    '''
+    Функция по каждому интервалу производит отдельный запрос к базе данных
+    и суммирует размер зарплат в интервале. Одновременно выполняется не более
+    concurrency запросов, порядок результатов совпадает с порядком интервалов
+    :param intervals: список интервалов из compile_intervals
+    :param concurrency: количество одновременных запросов (по умолчанию - INTERVAL_CONCURRENCY)
+    :return: список сумм зарплат по интервалам
+    '''
+    concurrency = concurrency or INTERVAL_CONCURRENCY
+    if concurrency <= 1:
+        return [await aggregate_interval(interval) for interval in intervals]
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def bounded(interval):
+        async with semaphore:
+            return await aggregate_interval(interval)
+
+    return list(await asyncio.gather(*[bounded(interval) for interval in intervals]))
+
+
+async def aggregate_shifted_intervals(intervals, engine=None):
+    '''
+    Суммы интервалов, границы которых сдвинуты относительно сетки UTC (даты запроса с ненулевым
+    смещением UTC, например, сутки по московскому времени). Группировка по усеченной дате документа
+    (движок "bucket", витрина) к ним неприменима, поэтому сумма каждого интервала вычисляется
+    по его границам: по снимку, выгрузке, индексу накопленных сумм или запросом на каждый интервал
+    :param intervals: список интервалов в наивных датах UTC
+    :param engine: движок агрегации (по умолчанию - AGGREGATION_ENGINE)
+    :return: список сумм зарплат по интервалам
+    '''
+    engine = engine or AGGREGATION_ENGINE
+    if engine == 'numpy':
+        from utils import snapshot
+        return snapshot.aggregate_from_snapshot(intervals)
+    if engine == 'dump':
+        from utils import dump
+        return await dump.aggregate_from_dump(intervals)
+    if engine == 'prefix':
+        from utils import prefix_index
+        dataset = await prefix_index.aggregate_from_index(intervals)
+        if dataset is not None:
+            return dataset
+    return await aggregate_by_intervals(intervals)
+
+
+async def aggregate_intervals(intervals, group_type, engine=None, use_rollup=None):
+    '''
+    Функция суммирует размер зарплат в каждом интервале по витрине почасовых сумм
+    (если она включена и применима) или выбранным движком агрегации.
+    Интервалы, не выровненные по минутам, движок "prefix" передает движку "bucket".
+    Интервалы с датами со смещением UTC переводятся в UTC (см. aggregate_shifted_intervals).
+    Суммы составных типов периода (неделя, квартал, год) складываются из сумм базового типа
+    :param intervals: список интервалов из compile_intervals
+    :param group_type: тип периода агрегации
+    :param engine: "bucket" - один запрос на все интервалы, "interval" - запрос на каждый интервал,
+    "numpy" - колоночный снимок коллекции, "prefix" - индекс накопленных сумм,
+    "dump" - чтение BSON-выгрузки коллекции без MongoDB
+    :param use_rollup: использовать витрину salaries_hourly (по умолчанию - USE_ROLLUP)
+    :return: список сумм зарплат по интервалам
+    '''
+    base_intervals, base_type = expand_intervals(intervals, group_type)
+    if base_type != group_type:
+        return merge_dataset(await aggregate_intervals(base_intervals, base_type, engine, use_rollup), group_type)
+    if intervals and intervals[0][0].tzinfo is not None:
+        # даты со смещением UTC: документы хранятся в UTC, интервалы переводятся в UTC
+        # (составные типы периода уже разложены на интервалы базового типа)
+        if intervals[0][0].utcoffset():
+            return await aggregate_shifted_intervals(to_utc(intervals), engine)
+        return await aggregate_intervals(to_utc(intervals), group_type, engine, use_rollup)
+    engine = engine or AGGREGATION_ENGINE
+    use_rollup = USE_ROLLUP if use_rollup is None else use_rollup
+    if engine == 'numpy':
+        from utils import snapshot
+        return snapshot.aggregate_from_snapshot(intervals)
+    if engine == 'dump':
+        from utils import dump
+        return await dump.aggregate_from_dump(intervals, group_type)
+    dataset = None
+    if engine == 'prefix':
+        from utils import prefix_index
+        dataset = await prefix_index.aggregate_from_index(intervals)
+    if dataset is None and use_rollup:
+        from utils import rollup
+        dataset = await rollup.aggregate_from_rollup(intervals, group_type)
+    if dataset is None and engine == 'interval':
+        dataset = await aggregate_by_intervals(intervals)
+    elif dataset is None:
+        dataset = await aggregate_by_buckets(intervals, group_type)
+    return dataset
+
+
+async def do_aggregate(dt_from, dt_upto, group_type, engine=None, use_rollup=None):
     '''
     Функция принимает на вход: начальное время, конечное время агрегации данных,
-    тип периода агрегации (месяц, день, час), по каждому интервалу производит запрос
-    к базе данных и суммирует размер зарплат в каждом интервале.
+    тип периода агрегации (месяц, день, час), формирует интервалы и суммирует
+    размер зарплат в каждом интервале (см. aggregate_intervals).
     Возвращает два списка данных: суммы зарплат в каждом временном интервале и список
     временных меток для каждого интервала
     :param dt_from:
     :param dt_upto:
     :param group_type:
+    :param engine: "bucket" - один запрос на все интервалы, "interval" - запрос на каждый интервал,
+    "numpy" - колоночный снимок коллекции, "prefix" - индекс накопленных сумм,
+    "dump" - чтение BSON-выгрузки коллекции без MongoDB
+    :param use_rollup: использовать витрину salaries_hourly (по умолчанию - USE_ROLLUP)
     :return: dataset, labels - наботы выходных данных
     '''
-    dataset = []
-    labels = []
     intervals = await compile_intervals(dt_from, dt_upto, group_type)
-    for interval in intervals:
-        cursor = db.salaries.aggregate([
-            {"$match": {"dt": {"$gte": interval[0], "$lte": interval[1]}}},
-            {"$group": {"_id": "null", "total": {"$sum": "$value"}}},
-        ])
-        result = await cursor.to_list()
-        try:
-            result_sum = result[0]['total']
-            dataset.append(result_sum)
-        except IndexError:
-            dataset.append(0)
-        labels.append(datetime.datetime.isoformat(interval[0]))
-    return dataset, labels
+    dataset = await aggregate_intervals(intervals, group_type, engine, use_rollup)
+    return dataset, format_labels(intervals)
 
+
+async def iter_aggregate(dt_from, dt_upto, group_type, chunk_size=None, aggregate=None):
+    '''
+    Асинхронный генератор результатов агрегации для потоковой передачи ответа:
+    интервалы формируются лениво и обрабатываются порциями по chunk_size интервалов,
+    пары (метка интервала, сумма) выдаются по мере вычисления каждой порции.
+    Объем памяти не зависит от длины периода
+    :param dt_from:
+    :param dt_upto:
+    :param group_type:
+    :param chunk_size: количество интервалов в порции (по умолчанию - STREAM_CHUNK_SIZE)
+    :param aggregate: функция суммирования порции интервалов (по умолчанию - aggregate_intervals)
+    :return: пары (метка интервала, сумма зарплат)
+    '''
+    chunk_size = chunk_size or STREAM_CHUNK_SIZE
+    aggregate = aggregate or aggregate_intervals
+    chunk = []
+    for interval in iter_intervals(dt_from, dt_upto, group_type):
+        chunk.append(interval)
+        if len(chunk) == chunk_size:
+            for label, total in zip(format_labels(chunk), await aggregate(chunk, group_type)):
+                yield label, total
+            chunk = []
+    if chunk:
+        for label, total in zip(format_labels(chunk), await aggregate(chunk, group_type)):
+            yield label, total
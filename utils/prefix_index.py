@@ -0,0 +1,283 @@
+import asyncio
+import datetime
+import logging
+import os
+import time
+
+import numpy as np
+
+from utils import mongodb
+from utils.mongodb import _truncate_date, supports_date_trunc, _to_bson_precision
+
+MINUTE = datetime.timedelta(minutes=1)
+# как часто (в секундах) индекс дополняется новыми документами коллекции salaries
+PREFIX_INDEX_REFRESH = float(os.getenv("PREFIX_INDEX_REFRESH", 5))
+
+logger = logging.getLogger(__name__)
+
+_index = None
+_refreshed = 0.0
+# построение или дополнение индекса, общее для одновременных запросов
+_pending = None
+
+
+class PrefixSumIndex:
+    '''
+    Индекс накопленных сумм зарплат с разрешением в одну минуту.
+    cumsum[i] - сумма зарплат всех документов в минутах до i-й (от base),
+    exact[i] - сумма зарплат документов, дата которых точно совпадает с началом i-й минуты.
+    Интервал [начало, конец] включает все минуты от начала до конца (не включая)
+    и документы точно в начале последней минуты, поэтому его сумма равна
+    cumsum[конец] - cumsum[начало] + exact[конец] и не зависит от количества документов
+    '''
+    def __init__(self, base=None, capacity=1024):
+        self.base = base
+        self.length = 0
+        self.high_water_mark = None
+        self._cumsum = np.zeros(capacity + 1, dtype=np.int64)
+        self._exact = np.zeros(capacity, dtype=np.int64)
+
+    @property
+    def nbytes(self):
+        '''
+        Объем памяти, занятой массивами индекса (в байтах)
+        '''
+        return self._cumsum.nbytes + self._exact.nbytes
+
+    @property
+    def end(self):
+        '''
+        Начало минуты, следующей за последней минутой индекса
+        '''
+        return self.base + self.length * MINUTE if self.base is not None else None
+
+    def _reserve(self, length):
+        if length <= len(self._exact):
+            return
+        capacity = max(length, 2 * len(self._exact))
+        cumsum = np.zeros(capacity + 1, dtype=np.int64)
+        exact = np.zeros(capacity, dtype=np.int64)
+        cumsum[:self.length + 1] = self._cumsum[:self.length + 1]
+        exact[:self.length] = self._exact[:self.length]
+        self._cumsum, self._exact = cumsum, exact
+
+    def add(self, minute, total, exact=0):
+        '''
+        Добавляет в индекс сумму зарплат документов одной минуты.
+        Минуты после конца индекса дописываются без перестройки индекса,
+        минута раньше конца индекса требует пересчета накопленных сумм после нее
+        :param minute: начало минуты
+        :param total: сумма зарплат документов минуты
+        :param exact: сумма зарплат документов точно в начале минуты
+        '''
+        if self.base is None:
+            self.base = minute
+        if minute < self.base:
+            # минута раньше начала индекса - сдвигаем начало индекса
+            shift = (self.base - minute) // MINUTE
+            self._reserve(self.length + shift)
+            self._exact[shift:self.length + shift] = self._exact[:self.length]
+            self._exact[:shift] = 0
+            self._cumsum[shift:self.length + shift + 1] = self._cumsum[:self.length + 1]
+            self._cumsum[:shift] = 0
+            self.base, self.length = minute, self.length + shift
+        position = (minute - self.base) // MINUTE
+        if position >= self.length:
+            self._reserve(position + 1)
+            self._cumsum[self.length + 1:position + 2] = self._cumsum[self.length]
+            self.length = position + 1
+        self._exact[position] += exact
+        self._cumsum[position + 1:self.length + 1] += total
+
+    def minute(self, minute):
+        '''
+        Суммы одной минуты индекса
+        :return: (сумма зарплат документов минуты, сумма зарплат документов точно в начале минуты)
+        '''
+        if self.base is None or not self.base <= minute < self.end:
+            return 0, 0
+        position = (minute - self.base) // MINUTE
+        return int(self._cumsum[position + 1] - self._cumsum[position]), int(self._exact[position])
+
+    def set(self, minute, total, exact=0):
+        '''
+        Заменяет суммы одной минуты индекса (в отличие от add, повторный вызов не меняет индекс)
+        '''
+        current_total, current_exact = self.minute(minute)
+        self.add(minute, total - current_total, exact - current_exact)
+
+    def extend(self, minutes, totals, exacts):
+        '''
+        Добавляет в индекс суммы зарплат по минутам (минуты упорядочены по возрастанию).
+        Минуты после конца индекса дописываются одной векторной операцией
+        '''
+        if not minutes:
+            return
+        if self.base is not None and minutes[0] < self.end - MINUTE:
+            for minute, total, exact in zip(minutes, totals, exacts):
+                self.add(minute, total, exact)
+            return
+        if self.base is None:
+            self.base = minutes[0]
+        positions = np.array([(minute - self.base) // MINUTE for minute in minutes], dtype=np.int64)
+        if positions[0] < self.length:
+            # первая минута совпадает с последней минутой индекса
+            self.add(minutes[0], totals[0], exacts[0])
+            positions, totals, exacts = positions[1:], totals[1:], exacts[1:]
+            if not len(positions):
+                return
+        length = int(positions[-1]) + 1
+        self._reserve(length)
+        per_minute = np.zeros(length - self.length, dtype=np.int64)
+        per_minute[positions - self.length] = totals
+        self._exact[positions] = exacts
+        self._cumsum[self.length + 1:length + 1] = self._cumsum[self.length] + np.cumsum(per_minute)
+        self.length = length
+
+    def aggregate(self, intervals):
+        '''
+        Суммирует размер зарплат в каждом интервале по индексу
+        :param intervals: список интервалов из compile_intervals
+        :return: список сумм зарплат по интервалам или None, если границы интервалов
+        не выровнены по минутам
+        '''
+        first_start = intervals[0][0]
+        if first_start.second or first_start.microsecond:
+            return None
+        if self.base is None:
+            return [0] * len(intervals)
+        offsets = np.array([[(start - self.base) // MINUTE, (end - self.base) // MINUTE]
+                            for start, end in intervals], dtype=np.int64)
+        starts = np.clip(offsets[:, 0], 0, self.length)
+        ends = np.clip(offsets[:, 1], 0, self.length)
+        inside = (offsets[:, 1] >= 0) & (offsets[:, 1] < self.length)
+        exact = np.where(inside, self._exact[np.clip(offsets[:, 1], 0, max(self.length - 1, 0))], 0)
+        return (self._cumsum[ends] - self._cumsum[starts] + exact).tolist()
+
+
+def minutes_pipeline(after=None, date_trunc=True):
+    '''
+    Конвейер, суммирующий документы коллекции salaries по минутам
+    :param after: учитывать только документы с датой строго позже этой
+    :param date_trunc: поддерживает ли сервер $dateTrunc
+    :return: конвейер агрегации
+    '''
+    minute = _truncate_date("$dt", 'minute', date_trunc)
+    return [
+        {"$match": {"dt": {"$gt": after}} if after is not None else {}},
+        {"$project": {"_id": 0, "dt": 1, "value": 1, "minute": minute}},
+        {"$group": {
+            "_id": "$minute",
+            "total": {"$sum": "$value"},
+            "exact": {"$sum": {"$cond": [{"$eq": ["$dt", "$minute"]}, "$value", 0]}},
+            "last": {"$max": "$dt"},
+        }},
+        {"$sort": {"_id": 1}},
+    ]
+
+
+async def refresh_index(index):
+    '''
+    Дополняет индекс документами коллекции salaries с датой позже отметки о прогрессе индекса
+    :param index: индекс накопленных сумм
+    :return: индекс
+    '''
+    pipeline = minutes_pipeline(index.high_water_mark, await supports_date_trunc())
+    minutes, totals, exacts = [], [], []
+    high_water_mark = index.high_water_mark
+    async for document in mongodb.salaries.aggregate(pipeline):
+        minutes.append(document["_id"])
+        totals.append(document["total"])
+        exacts.append(document["exact"])
+        if high_water_mark is None or document["last"] > high_water_mark:
+            high_water_mark = document["last"]
+    # отметка о прогрессе сдвигается только вместе с добавлением минут (после ошибки чтения индекс не меняется)
+    index.extend(minutes, totals, exacts)
+    index.high_water_mark = high_water_mark
+    return index
+
+
+async def build_index():
+    '''
+    Строит индекс накопленных сумм по всей коллекции salaries
+    '''
+    return await refresh_index(PrefixSumIndex())
+
+
+async def update_index():
+    '''
+    Строит индекс или дополняет его новыми документами
+    '''
+    global _index, _refreshed
+    if _index is None:
+        _index = await build_index()
+        logger.info("Индекс накопленных сумм построен: %d минут, %d байт", _index.length, _index.nbytes)
+    else:
+        await refresh_index(_index)
+    _refreshed = time.monotonic()
+
+
+async def get_index():
+    '''
+    Возвращает индекс (строится при первом обращении), не чаще чем раз
+    в PREFIX_INDEX_REFRESH секунд дополняя его новыми документами.
+    Одновременные запросы ожидают одно общее обновление: иначе каждый из них
+    добавил бы в индекс одни и те же минуты
+    '''
+    global _pending
+    if _index is None or time.monotonic() - _refreshed >= PREFIX_INDEX_REFRESH:
+        if _pending is not None and not _pending.done():
+            # дожидаемся изменения индекса, начатого раньше, и проверяем срок обновления заново
+            await asyncio.wait([_pending])
+        if _index is None or time.monotonic() - _refreshed >= PREFIX_INDEX_REFRESH:
+            if _pending is None or _pending.done():
+                _pending = asyncio.ensure_future(update_index())
+            # отмена одного из ожидающих запросов не прерывает общее обновление
+            await asyncio.shield(_pending)
+    return _index
+
+
+async def aggregate_from_index(intervals):
+    return (await get_index()).aggregate(intervals)
+
+
+async def reread_minutes(index, minutes):
+    '''
+    Заново читает из коллекции salaries суммы минут (только документы не позднее отметки
+    о прогрессе индекса) и заменяет ими суммы этих минут в индексе
+    :param index: индекс накопленных сумм
+    :param minutes: начала минут
+    '''
+    windows = [{"dt": {"$gte": minute, "$lt": minute + MINUTE, "$lte": index.high_water_mark}} for minute in minutes]
+    pipeline = [{"$match": {"$or": windows}}] + minutes_pipeline(None, await supports_date_trunc())[1:]
+    found = {document["_id"]: document async for document in mongodb.salaries.aggregate(pipeline)}
+    for minute in minutes:
+        document = found.get(minute)
+        index.set(minute, *((document["total"], document["exact"]) if document else (0, 0)))
+
+
+async def apply_inserts(documents):
+    '''
+    Учитывает в индексе новые документы с датой не позднее его отметки о прогрессе
+    (refresh_index читает только документы позже отметки): суммы минут этих документов
+    читаются из коллекции заново и заменяются, поэтому документ, уже учтенный при построении
+    или обновлении индекса, не учитывается дважды. Изменения индекса выполняются по очереди
+    с его построением и обновлением (см. get_index), отметка о прогрессе проверяется после них
+    :param documents: новые документы {"dt": ..., "value": ...}
+    '''
+    global _pending
+    dates = [_to_bson_precision(document["dt"]) for document in documents]
+    previous = _pending
+
+    async def update():
+        if previous is not None and not previous.done():
+            await asyncio.wait([previous])
+        if _index is None or _index.high_water_mark is None:
+            # индекс еще не построен: построение прочитает документы само
+            return
+        minutes = sorted({dt.replace(second=0, microsecond=0) for dt in dates if dt <= _index.high_water_mark})
+        if minutes:
+            await reread_minutes(_index, minutes)
+
+    _pending = asyncio.ensure_future(update())
+    await asyncio.shield(_pending)
@@ -0,0 +1,214 @@
+import argparse
+import asyncio
+import datetime
+import os
+import random
+
+from utils import mongodb
+from utils.mongodb import compile_intervals, _truncate_date, supports_date_trunc, _to_bson_precision
+
+ROLLUP_COLLECTION = "salaries_hourly"
+STATE_COLLECTION = "rollup_state"
+# обновление витрины выполняется порциями по CHUNK_HOURS часов,
+# после каждой порции сохраняется отметка о прогрессе
+CHUNK_HOURS = int(os.getenv("ROLLUP_CHUNK_HOURS", 24 * 31))
+HOUR = datetime.timedelta(hours=1)
+
+
+def get_rollup():
+    return mongodb.salaries.database.get_collection(ROLLUP_COLLECTION)
+
+
+def get_state():
+    return mongodb.salaries.database.get_collection(STATE_COLLECTION)
+
+
+def _truncate_hour(value):
+    return value.replace(minute=0, second=0, microsecond=0)
+
+
+async def get_high_water_mark():
+    '''
+    Возвращает отметку о прогрессе витрины: все документы коллекции salaries
+    с датой не позднее этой отметки учтены в витрине
+    :return: datetime или None, если витрина не построена
+    '''
+    state = await get_state().find_one({"_id": ROLLUP_COLLECTION})
+    return state["dt"] if state else None
+
+
+def rollup_pipeline(dt_from, dt_upto, date_trunc=True):
+    '''
+    Формирует конвейер, который суммирует документы коллекции salaries за период
+    [dt_from, dt_upto] по часам и записывает результат в витрину ($merge).
+    Документы внутри последней минуты часа (с ненулевыми секундами) учитываются отдельно
+    в полях tail_total/tail_count: в интервал "час" они не входят,
+    а в интервалы "день" и "месяц" входят, если час не последний в интервале
+    :param dt_from: начало периода (начало часа)
+    :param dt_upto: конец периода
+    :param date_trunc: поддерживает ли сервер $dateTrunc
+    :return: конвейер агрегации
+    '''
+    tail = {"$let": {
+        "vars": {"minute": _truncate_date("$dt", 'minute', date_trunc)},
+        "in": {"$and": [{"$ne": ["$dt", "$$minute"]}, {"$eq": [{"$minute": "$dt"}, 59]}]},
+    }}
+    return [
+        {"$match": {"dt": {"$gte": dt_from, "$lte": dt_upto}}},
+        {"$project": {"_id": 0, "value": 1, "hour": _truncate_date("$dt", 'hour', date_trunc), "tail": tail}},
+        {"$group": {
+            "_id": "$hour",
+            "total": {"$sum": {"$cond": ["$tail", 0, "$value"]}},
+            "count": {"$sum": {"$cond": ["$tail", 0, 1]}},
+            "tail_total": {"$sum": {"$cond": ["$tail", "$value", 0]}},
+            "tail_count": {"$sum": {"$cond": ["$tail", 1, 0]}},
+        }},
+        {"$merge": {"into": ROLLUP_COLLECTION, "on": "_id",
+                    "whenMatched": "replace", "whenNotMatched": "insert"}},
+    ]
+
+
+async def refresh_rollup(rebuild=False):
+    '''
+    Инкрементально обновляет витрину salaries_hourly: пересчитывает часы, начиная с часа,
+    в котором находится отметка о прогрессе, до последнего документа коллекции salaries.
+    Часы пересчитываются целиком и заменяют прежние записи, поэтому повторный запуск
+    (в том числе после сбоя посреди обновления) дает тот же результат.
+    Документы, добавленные с датой раньше отметки о прогрессе, не учитываются -
+    для них нужна полная перестройка витрины (rebuild=True) или пересчет их часов по потоку изменений (apply_inserts)
+    :param rebuild: перестроить витрину с начала коллекции
+    :return: новая отметка о прогрессе
+    '''
+    date_trunc = await supports_date_trunc()
+    if rebuild:
+        await get_rollup().delete_many({})
+        await get_state().delete_one({"_id": ROLLUP_COLLECTION})
+    high_water_mark = await get_high_water_mark()
+    if high_water_mark is None:
+        first = await mongodb.salaries.find_one({}, sort=[("dt", 1)])
+        if first is None:
+            return None
+        start = _truncate_hour(first["dt"])
+    else:
+        start = _truncate_hour(high_water_mark)
+    last = await mongodb.salaries.find_one({}, sort=[("dt", -1)])
+    upto = last["dt"]
+    while start <= upto:
+        end = start + HOUR * CHUNK_HOURS
+        # документы, добавленные во время обновления позже upto, учтем при следующем обновлении
+        high_water_mark = min(end - datetime.timedelta(milliseconds=1), upto)
+        cursor = mongodb.salaries.aggregate(rollup_pipeline(start, high_water_mark, date_trunc))
+        await cursor.to_list()
+        await get_state().update_one({"_id": ROLLUP_COLLECTION},
+                                     {"$set": {"dt": high_water_mark}}, upsert=True)
+        start = end
+    return high_water_mark
+
+
+async def aggregate_from_rollup(intervals, group_type):
+    '''
+    Суммирует интервалы по записям витрины salaries_hourly вместо исходных документов.
+    Витрина применима, если границы интервалов выровнены по минутам.
+    Документы с датой позже отметки о прогрессе витрины досчитываются по исходной коллекции
+    :param intervals: список интервалов из compile_intervals
+    :param group_type: тип периода агрегации
+    :return: список сумм зарплат по интервалам или None, если витрина неприменима
+    '''
+    first_start = intervals[0][0]
+    if first_start.second or first_start.microsecond:
+        return None
+    high_water_mark = await get_high_water_mark()
+    if high_water_mark is None:
+        return None
+    date_trunc = await supports_date_trunc()
+    next_hour = {"$add": ["$_id", 3600000]}
+    documents = await mongodb.run_pipeline([
+        {"$match": {"_id": {"$gte": first_start, "$lte": min(intervals[-1][1], high_water_mark)}}},
+        {"$project": {
+            "bucket": _truncate_date("$_id", group_type, date_trunc),
+            # хвост последней минуты часа не входит в интервал, если час в нем последний
+            "total": {"$cond": [{"$eq": [_truncate_date(next_hour, group_type, date_trunc), next_hour]},
+                                "$total", {"$add": ["$total", "$tail_total"]}]},
+        }},
+        {"$group": {"_id": "$bucket", "total": {"$sum": "$total"}, "hours": {"$sum": 1}}},
+    ], get_rollup(), count_field="hours")
+    totals = {document['_id']: document['total'] for document in documents}
+    dataset = [totals.get(interval[0], 0) for interval in intervals]
+    if high_water_mark < intervals[-1][1]:
+        # документы позже отметки о прогрессе еще не попали в витрину - досчитываем их по коллекции
+        fresh = await mongodb.aggregate_by_buckets(intervals, group_type, after=high_water_mark)
+        dataset = [total + delta for total, delta in zip(dataset, fresh)]
+    return dataset
+
+
+async def apply_inserts(documents):
+    '''
+    Учитывает в витрине новые документы с датой не позднее отметки о прогрессе
+    (такие документы обновление витрины уже не прочитает): часы этих документов пересчитываются
+    по коллекции и заменяют прежние записи, поэтому документ, уже учтенный при обновлении витрины,
+    не учитывается дважды. Документы позже отметки учитываются обновлением витрины,
+    а до него - досчитываются по исходной коллекции при запросе
+    :param documents: новые документы {"dt": ..., "value": ...}
+    :return: количество пересчитанных часов
+    '''
+    high_water_mark = await get_high_water_mark()
+    if high_water_mark is None:
+        return 0
+    hours = sorted({_truncate_hour(_to_bson_precision(document["dt"])) for document in documents
+                    if _to_bson_precision(document["dt"]) <= high_water_mark})
+    date_trunc = await supports_date_trunc()
+    for hour in hours:
+        upto = min(hour + HOUR - datetime.timedelta(milliseconds=1), high_water_mark)
+        cursor = mongodb.salaries.aggregate(rollup_pipeline(hour, upto, date_trunc))
+        await cursor.to_list()
+    return len(hours)
+
+
+async def check_consistency(samples=20, seed=None):
+    '''
+    Сравнивает ответы по витрине с ответами по исходной коллекции
+    для случайных периодов внутри покрытого витриной диапазона
+    :param samples: количество случайных периодов
+    :param seed: зерно генератора случайных чисел
+    :return: список расхождений (dt_from, dt_upto, group_type)
+    '''
+    high_water_mark = await get_high_water_mark()
+    first = await mongodb.salaries.find_one({}, sort=[("dt", 1)])
+    if high_water_mark is None or first is None:
+        return []
+    rnd = random.Random(seed)
+    span = int((high_water_mark - first["dt"]).total_seconds() // 60)
+    mismatches = []
+    for _ in range(samples):
+        group_type = rnd.choice(['month', 'day', 'hour'])
+        dt_from = _truncate_hour(first["dt"]) + datetime.timedelta(minutes=rnd.randint(0, span))
+        length = {'month': 60 * 24 * 90, 'day': 60 * 24 * 14, 'hour': 60 * 48}[group_type]
+        dt_upto = dt_from + datetime.timedelta(minutes=rnd.randint(0, length))
+        intervals = await compile_intervals(dt_from, dt_upto, group_type)
+        from_rollup = await aggregate_from_rollup(intervals, group_type)
+        if from_rollup is None:
+            continue
+        from_raw = await mongodb.aggregate_by_buckets(intervals, group_type)
+        if from_rollup != from_raw:
+            mismatches.append((dt_from, dt_upto, group_type))
+    return mismatches
+
+
+async def main(command, samples):
+    if command == 'build':
+        print(f"Витрина построена до {await refresh_rollup(rebuild=True)}")
+    elif command == 'refresh':
+        print(f"Витрина обновлена до {await refresh_rollup()}")
+    else:
+        mismatches = await check_consistency(samples)
+        for mismatch in mismatches:
+            print("Расхождение:", *mismatch)
+        print(f"Проверено периодов: {samples}, расхождений: {len(mismatches)}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Витрина почасовых сумм зарплат salaries_hourly")
+    parser.add_argument('command', choices=['build', 'refresh', 'check'])
+    parser.add_argument('--samples', type=int, default=20)
+    arguments = parser.parse_args()
+    asyncio.run(main(arguments.command, arguments.samples))
@@ -0,0 +1,118 @@
+import argparse
+import asyncio
+import datetime
+import os
+from array import array
+from pathlib import Path
+
+import numpy as np
+
+from utils import mongodb
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+SNAPSHOT_PATH = Path(os.getenv("SNAPSHOT_PATH") or BASE_DIR / "snapshot")
+EPOCH = datetime.datetime(1970, 1, 1)
+MILLISECOND = datetime.timedelta(milliseconds=1)
+
+_snapshot = None
+
+
+def to_epoch_ms(value):
+    '''
+    Переводит дату в количество миллисекунд от начала эпохи Unix.
+    Миллисекунды - точность хранения дат в BSON, поэтому границы интервалов
+    сравниваются с датами документов так же, как в запросах к MongoDB
+    '''
+    return (value - EPOCH) // MILLISECOND
+
+
+def write_snapshot(path, timestamps, values):
+    '''
+    Записывает колоночный снимок коллекции salaries в каталог path:
+    dt.npy - отсортированные даты документов (int64, миллисекунды от начала эпохи),
+    value.npy - размеры зарплат, cumsum.npy - накопленные суммы зарплат (с ведущим нулем)
+    :param path: каталог снимка
+    :param timestamps: даты документов
+    :param values: размеры зарплат
+    :return: количество документов
+    '''
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    timestamps = np.asarray(timestamps, dtype=np.int64)
+    values = np.asarray(values)
+    if values.dtype.kind in 'iub':
+        values = values.astype(np.int64)
+    order = np.argsort(timestamps, kind='stable')
+    timestamps, values = timestamps[order], values[order]
+    cumsum = np.concatenate([np.zeros(1, dtype=values.dtype), np.cumsum(values)])
+    np.save(path / "dt.npy", timestamps)
+    np.save(path / "value.npy", values)
+    np.save(path / "cumsum.npy", cumsum)
+    return len(timestamps)
+
+
+async def export_snapshot(path=SNAPSHOT_PATH, batch_size=10000):
+    '''
+    Выгружает коллекцию salaries в колоночный снимок (см. write_snapshot)
+    :param path: каталог снимка
+    :param batch_size: количество документов, получаемых из базы данных за одно обращение
+    :return: количество документов
+    '''
+    timestamps, values = array('q'), []
+    cursor = mongodb.salaries.find({}, {"_id": 0, "dt": 1, "value": 1}, batch_size=batch_size)
+    async for document in cursor:
+        timestamps.append(to_epoch_ms(document["dt"]))
+        values.append(document.get("value", 0))
+    return write_snapshot(path, np.frombuffer(timestamps, dtype=np.int64), values)
+
+
+class Snapshot:
+    '''
+    Колоночный снимок коллекции salaries, отображенный в память (memory-mapped).
+    Сумма интервала вычисляется как разность накопленных сумм на его границах,
+    границы находятся двоичным поиском (searchsorted) по отсортированным датам
+    '''
+    def __init__(self, timestamps, cumsum):
+        self.timestamps = timestamps
+        self.cumsum = cumsum
+
+    @classmethod
+    def load(cls, path=SNAPSHOT_PATH):
+        path = Path(path)
+        return cls(np.load(path / "dt.npy", mmap_mode='r'), np.load(path / "cumsum.npy", mmap_mode='r'))
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def aggregate(self, intervals):
+        '''
+        Суммирует размер зарплат в каждом интервале [начало, конец] (конец включительно)
+        :param intervals: список интервалов из compile_intervals
+        :return: список сумм зарплат по интервалам
+        '''
+        edges = np.array([[to_epoch_ms(start), to_epoch_ms(end)] for start, end in intervals], dtype=np.int64)
+        left = np.searchsorted(self.timestamps, edges[:, 0], side='left')
+        right = np.searchsorted(self.timestamps, edges[:, 1], side='right')
+        return (self.cumsum[right] - self.cumsum[left]).tolist()
+
+
+def get_snapshot():
+    '''
+    Возвращает снимок из каталога SNAPSHOT_PATH (загружается при первом обращении)
+    '''
+    global _snapshot
+    if _snapshot is None:
+        _snapshot = Snapshot.load(SNAPSHOT_PATH)
+    return _snapshot
+
+
+def aggregate_from_snapshot(intervals):
+    return get_snapshot().aggregate(intervals)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Колоночный снимок коллекции salaries")
+    parser.add_argument('command', choices=['export'])
+    parser.add_argument('--path', default=SNAPSHOT_PATH)
+    arguments = parser.parse_args()
+    print(f"Выгружено документов: {asyncio.run(export_snapshot(arguments.path))}")
@@ -1,28 +1,30 @@
 import asyncio
 import os
-from pathlib import Path
 
-from aiogram import Bot, Dispatcher
-from aiogram.filters import CommandStart
 import json
 import datetime
 
-from dotenv import load_dotenv
-
-from utils.mongodb import do_aggregate, compile_intervals
-
-BASE_DIR = Path(__file__).resolve().parent.parent
-load_dotenv(BASE_DIR / ".env")
+# файл .env загружается при импорте пакета utils (см. utils/__init__.py), до импорта utils.cache
+from utils.cache import cached_aggregate, cached_aggregate_metrics
+from utils.intervals import GROUP_TYPES
+from utils.metrics import parse_metrics
+from utils.tracing import trace_request
 
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
+# адрес API сервиса (например, http://127.0.0.1:8000): бот, запущенный отдельным процессом,
+# получает данные через API. Если адрес не задан, бот агрегирует данные сам
+BOT_API_URL = os.getenv("BOT_API_URL")
+# сколько запросов пользователей бот обрабатывает одновременно, остальные ожидают очереди
+BOT_CONCURRENCY = int(os.getenv("BOT_CONCURRENCY", 4))
 
-dp = Dispatcher()
+bot_semaphore = asyncio.Semaphore(BOT_CONCURRENCY)
 
 
 async def get_input_vars(message):
     '''
     Функция принимает на вход текстовое сообщение от пользователя в json строке,
-    преобразует в формат данных Python и возвращает список переменных в вызывающую функцию.
+    преобразует в формат данных Python и возвращает список переменных в вызывающую функцию
+    (при наличии поля "metrics" четвертым элементом списка добавляются названия статистик).
     В случае некорректных данных возвращается ответ с текстом ошибки.
     :param message: json row
     :return: Union[list, str]
@@ -35,11 +37,16 @@ async def get_input_vars(message):
         return "Некорректная структура данных JSON"
     if data:
         if data.get('dt_from') and data.get('dt_upto') and data.get('group_type'):
-            if data['group_type'] in ['month', 'day', 'hour']:
+            if data['group_type'] in GROUP_TYPES:
                 # все входные данные в наличии, устанавливаем значения переменных
                 dt_from = datetime.datetime.fromisoformat(data['dt_from'])
                 dt_upto = datetime.datetime.fromisoformat(data['dt_upto'])
                 group_type = data['group_type']
+                if data.get('metrics'):
+                    try:
+                        return [dt_from, dt_upto, group_type, parse_metrics(data['metrics'])]
+                    except ValueError:
+                        return f"Неподдерживаемые статистики: {data['metrics']}"
                 return [dt_from, dt_upto, group_type]
             else:
                 return f"Неподдерживаемый тип интервала данных: {data['group_type']}"
@@ -47,7 +54,52 @@ async def get_input_vars(message):
             return "Недостаточно данных для запроса"
 
 
-@dp.message(CommandStart())
+async def request_api(params):
+    '''
+    Функция запрашивает агрегированные данные у API сервиса (BOT_API_URL).
+    Ответ 422 (некорректный запрос, например статистики не вычисляются движком сервиса)
+    преобразуется в исключение ValueError с текстом ошибки из ответа API - так же,
+    как эта ошибка возникает при агрегации в процессе бота
+    :param params: параметры GET запроса
+    :return: dict
+    '''
+    import aiohttp
+    async with aiohttp.ClientSession() as session:
+        async with session.get(f"{BOT_API_URL.rstrip('/')}/aggregated_data/", params=params) as response:
+            if response.status == 422:
+                raise ValueError((await response.json())["detail"])
+            response.raise_for_status()
+            return await response.json()
+
+
+async def fetch_aggregated_data(dt_from, dt_upto, group_type):
+    '''
+    Функция получает агрегированные данные для ответа пользователю: через API сервиса,
+    если задан BOT_API_URL, иначе - агрегирует данные в процессе бота
+    :return: dataset, labels
+    '''
+    if not BOT_API_URL:
+        return await cached_aggregate(dt_from, dt_upto, group_type)
+    params = {"dt_from": dt_from.isoformat(), "dt_upto": dt_upto.isoformat(), "group_type": group_type}
+    data = await request_api(params)
+    return data["dataset"], data["labels"]
+
+
+async def fetch_aggregated_metrics(dt_from, dt_upto, group_type, metrics):
+    '''
+    Функция получает агрегированные данные и дополнительные статистики по интервалам
+    для ответа пользователю (через API сервиса, если задан BOT_API_URL)
+    :param metrics: кортеж названий статистик из parse_metrics
+    :return: dataset, labels, {название статистики: список значений по интервалам}
+    '''
+    if not BOT_API_URL:
+        return await cached_aggregate_metrics(dt_from, dt_upto, group_type, metrics)
+    params = {"dt_from": dt_from.isoformat(), "dt_upto": dt_upto.isoformat(), "group_type": group_type,
+              "metrics": ",".join(metrics)}
+    data = await request_api(params)
+    return data["dataset"], data["labels"], data["metrics"]
+
+
 async def command_start_handler(message) -> None:
     """
     Функция обрабатывает команду "/start", введенную пользователем
@@ -62,7 +114,6 @@ async def command_start_handler(message) -> None:
                         '"group_type": "month"}')
 
 
-@dp.message()
 async def message_handler(message) -> None:
     """
     Функция обрабатывает текстовые сообщения от пользователя в Телеграм-боте,
@@ -79,10 +130,27 @@ async def message_handler(message) -> None:
             dt_from = input_data[0]
             dt_upto = input_data[1]
             group_type = input_data[2]
-            dataset, labels = await do_aggregate(dt_from, dt_upto, group_type) # получим выходные данные
-            message_text = str({"dataset": dataset, "labels": labels}) # строковое представление словаря для отображения
-            index = message_text.index("'labels'")
-            message_text = message_text[:index] + "\n" + message_text[index:]
+            # ограничим количество одновременно обрабатываемых запросов, время ответа учитывается в /metrics
+            async with bot_semaphore:
+                with trace_request('bot', group_type):
+                    if len(input_data) > 3:
+                        try:
+                            dataset, labels, values = await fetch_aggregated_metrics(dt_from, dt_upto, group_type,
+                                                                                     input_data[3])
+                        except ValueError as error:
+                            # статистики не вычисляются движками без MongoDB и для дат с ненулевым смещением UTC,
+                            # при BOT_API_URL ошибка приходит из API ответом 422 (см. request_api)
+                            await message.answer(f"Статистики не вычислены: {error}")
+                            return
+                        result = {"dataset": dataset, "labels": labels, "metrics": values}
+                    else:
+                        dataset, labels = await fetch_aggregated_data(dt_from, dt_upto, group_type) # получим выходные данные
+                        result = {"dataset": dataset, "labels": labels}
+            message_text = str(result) # строковое представление словаря для отображения
+            for key in ("'labels'", "'metrics'"):
+                if key in message_text:
+                    index = message_text.index(key)
+                    message_text = message_text[:index] + "\n" + message_text[index:]
             await message.answer(message_text) # отправим ответ пользователю
         else:
             # выводим сообщение об ошибке
@@ -91,12 +159,30 @@ async def message_handler(message) -> None:
         await message.answer("Некорректные входные данные")
 
 
+def create_dispatcher():
+    """
+    Функция создает диспетчер Телеграм-бота и регистрирует обработчики сообщений.
+    aiogram импортируется здесь, при запуске бота, а не при импорте модуля
+    :return: Dispatcher
+    """
+    from aiogram import Dispatcher
+    from aiogram.filters import CommandStart
+    dp = Dispatcher()
+    dp.message.register(command_start_handler, CommandStart())
+    dp.message.register(message_handler)
+    return dp
+
+
 async def run_telebot():
     """
     Функция создает экземпляр Телеграм-бота и запускает цикл взаимодействия
     с сервером Телеграм
     """
+    from aiogram import Bot
     bot = Bot(token=TELEGRAM_TOKEN)
-    await dp.start_polling(bot)
+    await create_dispatcher().start_polling(bot)
+
 
-# asyncio.run(run_telebot())
\ No newline at end of file
+if __name__ == '__main__':
+    # запуск бота отдельным процессом: python -m utils.telegram
+    asyncio.run(run_telebot())
@@ -0,0 +1,182 @@
+import contextlib
+import contextvars
+import logging
+import os
+import time
+
+from utils.intervals import GROUP_TYPES
+
+# добавлять к ответам API заголовок Server-Timing с длительностью этапов обработки запроса
+SERVER_TIMING = os.getenv("SERVER_TIMING", "0") == "1"
+# запросы дольше порога (в миллисекундах) записываются в журнал, 0 - выключено
+SLOW_REQUEST_MS = float(os.getenv("SLOW_REQUEST_MS", 1000))
+# границы корзин гистограмм длительности (в секундах)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# значения метки group_type в метриках: неизвестный тип периода из запроса учитывается как "other",
+# иначе каждое новое значение создавало бы новые ряды метрик
+GROUP_TYPE_LABELS = frozenset(GROUP_TYPES) | {'batch'}
+
+logger = logging.getLogger(__name__)
+
+_current = contextvars.ContextVar("trace", default=None)
+
+
+class Trace:
+    '''
+    Трассировка одного запроса: длительность этапов (compile - формирование интервалов,
+    db - запросы к базе данных, encode - кодирование ответа), количество запросов к базе данных,
+    количество документов, прочитанных базой данных для ответа, и количество интервалов.
+    Этапы параллельных запросов к базе данных суммируются
+    '''
+
+    def __init__(self, entry, group_type):
+        self.entry = entry
+        self.group_type = group_type
+        self.stages = {}
+        self.round_trips = 0
+        self.documents = 0
+        self.buckets = 0
+        self.started = time.perf_counter()
+        self.duration = None
+
+    def server_timing(self):
+        '''
+        Значение заголовка Server-Timing: этапы и общая длительность в миллисекундах
+        '''
+        parts = [f"{name};dur={seconds * 1000:.2f}" for name, seconds in self.stages.items()]
+        if self.round_trips:
+            parts.append(f'queries;desc="{self.round_trips} queries, {self.documents} documents"')
+        parts.append(f"total;dur={(self.duration or 0) * 1000:.2f}")
+        return ", ".join(parts)
+
+
+class Histogram:
+    '''
+    Гистограмма в формате Prometheus: накопительные счетчики по корзинам, сумма и количество
+    '''
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Registry:
+    '''
+    Метрики процесса: гистограммы длительности запросов (по точке входа и типу периода)
+    и этапов, счетчики запросов к базе данных, документов, интервалов и медленных запросов
+    '''
+
+    def __init__(self):
+        self.requests = {}
+        self.stages = {}
+        self.counters = {}
+
+    def record(self, trace):
+        labels = (("entry", trace.entry), ("group_type", trace.group_type))
+        self.requests.setdefault(labels, Histogram()).observe(trace.duration)
+        for name, seconds in trace.stages.items():
+            self.stages.setdefault((("entry", trace.entry), ("stage", name)), Histogram()).observe(seconds)
+        for name, value in (("db_queries_total", trace.round_trips), ("db_documents_total", trace.documents),
+                            ("buckets_total", trace.buckets)):
+            self.increment(name, labels, value)
+
+    def increment(self, name, labels, value=1):
+        key = (name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def render(self):
+        '''
+        Метрики в текстовом формате Prometheus
+        :return: str
+        '''
+        lines = []
+        for name, histograms in (("salary_request_duration_seconds", self.requests),
+                                 ("salary_stage_duration_seconds", self.stages)):
+            lines.append(f"# TYPE {name} histogram")
+            for labels, histogram in sorted(histograms.items()):
+                label_text = ",".join(f'{key}="{value}"' for key, value in labels)
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    lines.append(f'{name}_bucket{{{label_text},le="{bound}"}} {count}')
+                lines.append(f'{name}_bucket{{{label_text},le="+Inf"}} {histogram.count}')
+                lines.append(f"{name}_sum{{{label_text}}} {histogram.sum}")
+                lines.append(f"{name}_count{{{label_text}}} {histogram.count}")
+        declared = set()
+        for (name, labels), value in sorted(self.counters.items()):
+            if name not in declared:
+                lines.append(f"# TYPE salary_{name} counter")
+                declared.add(name)
+            label_text = ",".join(f'{key}="{value}"' for key, value in labels)
+            lines.append(f"salary_{name}{{{label_text}}} {value}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+@contextlib.contextmanager
+def trace_request(entry, group_type):
+    '''
+    Трассировка запроса: этапы и запросы к базе данных внутри блока (в том числе в задачах,
+    созданных в нем) учитываются в объекте Trace. По завершении блока длительность запроса
+    записывается в метрики, а запрос дольше SLOW_REQUEST_MS - в журнал
+    :param entry: точка входа: GET, POST, batch, bot
+    :param group_type: тип периода агрегации
+    :return: Trace
+    '''
+    trace = Trace(entry, group_type if group_type in GROUP_TYPE_LABELS else 'other')
+    token = _current.set(trace)
+    try:
+        yield trace
+    finally:
+        _current.reset(token)
+        trace.duration = time.perf_counter() - trace.started
+        registry.record(trace)
+        if SLOW_REQUEST_MS and trace.duration * 1000 >= SLOW_REQUEST_MS:
+            registry.increment("slow_requests_total", (("entry", trace.entry),))
+            logger.warning("Медленный запрос %s %s: %.1f мс, интервалов: %d, запросов к бд: %d, "
+                           "документов: %d, этапы: %s", trace.entry, trace.group_type, trace.duration * 1000,
+                           trace.buckets, trace.round_trips, trace.documents, trace.server_timing())
+
+
+@contextlib.contextmanager
+def stage(name):
+    '''
+    Учитывает длительность блока как этап name текущего запроса (вне трассировки ничего не делает)
+    '''
+    trace = _current.get()
+    if trace is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.stages[name] = trace.stages.get(name, 0) + time.perf_counter() - started
+
+
+def record_query(documents=0):
+    '''
+    Учитывает в текущем запросе один запрос к базе данных и количество прочитанных им документов
+    '''
+    trace = _current.get()
+    if trace is not None:
+        trace.round_trips += 1
+        trace.documents += documents
+
+
+def record_buckets(count):
+    '''
+    Учитывает в текущем запросе количество интервалов ответа
+    '''
+    trace = _current.get()
+    if trace is not None:
+        trace.buckets += count